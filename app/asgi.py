@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'app.settings')
+# the async GETs of the geography views (ex1/async_reads.py), only worth it under ASGI
+os.environ.setdefault('GEO_ASYNC_READS', '1')
 
 application = get_asgi_application()
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -49,6 +50,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'ex1.replicas.ReplicaRoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'silk.middleware.SilkyMiddleware'
@@ -83,8 +85,27 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        # keep the connection of each worker thread across requests instead of opening one per
+        # request, checked before it is reused after an error
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            # transactions take the write lock when they start: a deferred one that reads and then
+            # writes can't wait for the lock (busy_timeout doesn't apply), it fails with "database is locked"
+            'transaction_mode': 'IMMEDIATE',
+        },
+    },
+    # local stand-in for a read replica, a copy of db.sqlite3 made by `manage.py sync_replicas`
+    # (only read from when listed in DB_REPLICAS below), tests read the default db through it
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.replica.sqlite3',
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'TEST': {'MIRROR': 'default'},
+    },
 }
+DATABASE_ROUTERS = ['ex1.replicas.ReplicaRouter']
 
 
 # Password validation
@@ -109,11 +130,21 @@ AUTH_USER_MODEL = 'ex1.CustomUser'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'ex1.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    # orjson backed when it's installed, see API_JSON_BACKEND below
+    'DEFAULT_RENDERER_CLASSES': [
+        'ex1.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'ex1.renderers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
 }
 
 
@@ -138,3 +169,120 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# ex1 - geography api tuning
+
+# rows per INSERT/UPDATE for the bulk write paths (nested serializers, upserts)
+BULK_BATCH_SIZE = 500
+# how a nested country PUT/PATCH writes its states and cities
+# 'reconcile' matches them on state_code/city_code and writes only what changed
+# 'replace' deletes the whole subtree and inserts it again
+NESTED_UPDATE_MODE = 'reconcile'
+# skip the SELECTs that pre-check unique fields before a write, the db unique constraints catch
+# clashes instead and they are reported as the same field errors (ex1/serializers.py)
+OPTIMISTIC_UNIQUE_CHECKS = False
+# token -> user cache in front of TokenAuthentication (ex1/authentication.py)
+# TTL in seconds, MAX_SIZE entries kept in process memory (least recently used go first)
+# ALIAS: use this django CACHES alias instead, e.g. one shared by all the workers of the host
+# in process memory a revoked token is only evicted on the worker that revoked it, the others
+# serve it until TTL runs out - keep the TTL short, or give a shared ALIAS and a longer TTL
+TOKEN_CACHE = {
+    'TTL': 5,
+    'MAX_SIZE': 10000,
+    'ALIAS': None,
+}
+# signin checks passwords in a bounded pool (ex1/hashing.py): it bounds the CPU spent hashing,
+# the signin's request thread still waits for the result. EXECUTOR 'process' or 'thread',
+# MAX_WORKERS hashes at once, MAX_PENDING more may wait, past that signin answers 503; TIMEOUT
+# seconds to wait for a result
+SIGNIN_HASH_POOL = {
+    'EXECUTOR': 'process',
+    'MAX_WORKERS': 2,
+    'MAX_PENDING': 32,
+    'TIMEOUT': 10,
+}
+# the default ModelBackend, with its password check in that pool on the signin endpoint only -
+# the other logins (admin, session, basic auth) check inline as before
+AUTHENTICATION_BACKENDS = ['ex1.hashing.PooledModelBackend']
+# cache of the serialized GET responses of the country/state/city endpoints (ex1/response_cache.py)
+# invalidated by writes through a per-country version; TTL seconds, MAX_SIZE responses kept in
+# process memory - keyed on the GeoVersion counter too, so the writes of the other workers are
+# seen at once (one pk read per hit) - or ALIAS: a django CACHES alias shared by the workers
+GEO_RESPONSE_CACHE = {
+    'ENABLED': True,
+    'TTL': 300,
+    'MAX_SIZE': 2000,
+    'ALIAS': None,
+}
+# ETag / If-None-Match on the same endpoints, a matching tag gets an empty 304 (ex1/etags.py)
+GEO_ETAGS = True
+# rows per page of the geography lists (cursor pagination, ?page_size= up to GEO_MAX_PAGE_SIZE)
+GEO_PAGE_SIZE = 100
+GEO_MAX_PAGE_SIZE = 1000
+# countries per chunk when /api/nested/countries/?stream=1 streams the whole tree (ex1/streaming.py)
+GEO_STREAM_CHUNK_SIZE = 100
+# build the GET lists from .values() rows instead of model instances + serializers (ex1/fastread.py)
+GEO_FAST_READS = True
+# JSON encoder of the API (ex1/renderers.py): 'auto' uses orjson when installed, else the stdlib
+# 'orjson' requires it, 'stdlib' never uses it
+API_JSON_BACKEND = 'auto'
+# CSV/NDJSON imports (ex1/imports.py): rows per batch (one transaction each), and how many failed
+# rows the report lists at most
+IMPORT_BATCH_SIZE = 1000
+IMPORT_MAX_ERRORS = 1000
+# rows per fetch / per written piece of the geography export (ex1/exports.py)
+EXPORT_CHUNK_SIZE = 2000
+# stats endpoints read the per state/country rollup rows kept up to date on every city write
+# (ex1/rollups.py), False adds up the cities on every request
+STATS_FROM_ROLLUPS = True
+# answer the country/state/city detail GETs from a per-worker in-memory copy of the geography,
+# rebuilt when the GeoVersion counter moves (ex1/snapshot.py), or once it is MAX_AGE seconds old
+# for the writes that don't move it (admin, shell, raw SQL)
+GEO_SNAPSHOT = True
+GEO_SNAPSHOT_MAX_AGE = 60
+# city name search (ex1/search.py): an in-memory index per worker, MAX_LIMIT results per query at
+# most, prefixes matching up to SCAN_LIMIT names are ranked on the spot (bigger ones keep a top
+# list), FUZZY_THRESHOLD is the trigram similarity a fuzzy match needs; ENABLED False searches the db
+# the city writes are logged for the other workers' indexes, LOG_VERSIONS versions of them are kept
+CITY_SEARCH = {
+    'ENABLED': True,
+    'MAX_LIMIT': 50,
+    'SCAN_LIMIT': 2000,
+    'FUZZY_THRESHOLD': 0.3,
+    'LOG_VERSIONS': 1000,
+}
+# default of the UUID primary keys (ex1/ids.py): 'uuid7' time ordered, new rows go to the end of
+# the pk index, or 'uuid4' random
+PRIMARY_KEY_UUID = 'uuid7'
+# PRAGMAs run on every new sqlite connection (ex1/sqlite.py): WAL lets the readers go on while a
+# write commits, synchronous NORMAL is durable in WAL mode except for the last commits on a power
+# loss, busy_timeout (ms) waits for the write lock instead of failing, cache_size (negative: KiB)
+# and mmap_size (bytes) keep the hot pages in memory. `manage.py bench_sqlite` compares with the defaults
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': 5000,
+    'cache_size': -65536,
+    'mmap_size': 268435456,
+    'temp_store': 'memory',
+}
+# read replicas (ex1/replicas.py): the GETs of the geography and user views read from one of
+# these DATABASES aliases (none: everything on 'default'), a user who wrote reads from the primary
+# for STICKY_SECONDS after; the pins are kept in the django cache ALIAS, shared by the workers
+# (required with DATABASES)
+DB_REPLICAS = {
+    'DATABASES': [],
+    'STICKY_SECONDS': 5,
+    'ALIAS': None,
+}
+# async GETs for the geography views under ASGI (ex1/async_reads.py), turned on by app/asgi.py;
+# off (WSGI, runserver) the sync views serve them - under WSGI an async view costs an event loop
+# per request
+GEO_ASYNC_READS = os.environ.get('GEO_ASYNC_READS') == '1'
+# silk records every request in the db (/silk/) - in DEBUG only, and not in front of the async
+# views: its middleware is sync only, every async request would be sent to a thread for it
+SILK_ENABLED = DEBUG and not GEO_ASYNC_READS
+if not SILK_ENABLED:
+    INSTALLED_APPS.remove('silk')
+    MIDDLEWARE.remove('silk.middleware.SilkyMiddleware')
@@ -14,6 +14,7 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include
 
@@ -22,4 +23,5 @@ urlpatterns = [
     path('api/', include('ex1.urls')),
 ]
 
-urlpatterns += [path('silk/', include('silk.urls', namespace='silk'))]
\ No newline at end of file
+if settings.SILK_ENABLED:
+    urlpatterns += [path('silk/', include('silk.urls', namespace='silk'))]
\ No newline at end of file
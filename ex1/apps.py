@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class Ex1Config(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ex1'
+
+    def ready(self):
+        from . import signals  # noqa: F401 - connects the receivers
@@ -0,0 +1,154 @@
+# Async GETs for the geography views
+# Under ASGI a sync DRF view runs in a thread (sync_to_async), one per request in flight, so a
+# worker serves as many slow clients at once as it has threads. AsyncReadMixin makes the view's
+# callable async: GET/HEAD go through adispatch() - the steps of APIView.dispatch with the token
+# checked by aauthenticate() and the body built by alist()/aretrieve(), which the mixins of the
+# view implement next to list()/retrieve() (response cache, ETags, snapshot, fast reads, streaming)
+# with the async ORM (aget, aaggregate, aiterator). The other methods go to the sync view as before.
+# What has no async version (a serializer without a read plan, the browsable API) runs in a
+# thread, like the whole request did. Django's async ORM still hands each query to a thread of
+# its own, what no longer holds a thread is the request waiting on the client or the db.
+# Only under ASGI: app/asgi.py turns GEO_ASYNC_READS on. Under WSGI (and runserver) the plain sync
+# views serve the GETs - an async view there costs an event loop per request, and a streamed
+# list would be an async generator the WSGI server has to drain in a thread.
+# The caches shared by the workers (a django cache alias) block, async code reads them in a thread
+# (aget() in cache.py).
+#
+# https://docs.djangoproject.com/en/5.2/topics/async/
+# https://docs.djangoproject.com/en/5.2/topics/db/queries/#asynchronous-queries
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import Http404
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions, mixins
+from rest_framework.response import Response
+
+from .fastread import FAST_READS, read_plan_for
+
+ASYNC_READS = getattr(settings, 'GEO_ASYNC_READS', False)
+
+
+class _Fetch(Exception):
+    def __init__(self, queryset):
+        self.queryset = queryset
+
+
+class _Rows:
+    # stands in for the queryset while CursorPagination.paginate_queryset runs: passes order_by()
+    # and filter() on, and at the slice either asks for the rows (_Fetch) or hands them over
+    def __init__(self, queryset, rows=None):
+        self.queryset = queryset
+        self.rows = rows
+
+    def order_by(self, *fields):
+        return _Rows(self.queryset.order_by(*fields), self.rows)
+
+    def filter(self, *args, **kwargs):
+        return _Rows(self.queryset.filter(*args, **kwargs), self.rows)
+
+    def __getitem__(self, page):
+        if self.rows is None:
+            raise _Fetch(self.queryset[page])
+        return self.rows
+
+
+# For CursorPagination classes: DRF's paging, with the page read by aiterator()
+class AsyncCursorPaginationMixin:
+    async def apaginate_queryset(self, queryset, request, view=None):
+        try:
+            return self.paginate_queryset(_Rows(queryset), request, view)
+        except _Fetch as fetch:
+            rows = [row async for row in fetch.queryset.aiterator()]
+        return self.paginate_queryset(_Rows(queryset, rows), request, view)
+
+
+# Goes last among the mixins of the view (right before the generic DRF class): the end of the
+# alist()/aretrieve() chain
+class AsyncReadMixin:
+    @classmethod
+    def as_view(cls, **initkwargs):
+        sync_view = super().as_view(**initkwargs)
+        if not ASYNC_READS:
+            return sync_view
+        run_sync = sync_to_async(sync_view)
+
+        async def view(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return await run_sync(request, *args, **kwargs)
+            self = cls(**initkwargs)
+            self.setup(request, *args, **kwargs)
+            return await self.adispatch(request, *args, **kwargs)
+
+        view.cls = cls
+        view.initkwargs = initkwargs
+        return csrf_exempt(view)
+
+    async def adispatch(self, request, *args, **kwargs):
+        # APIView.dispatch for a GET
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+        try:
+            await self.aauthenticate(request)
+            # request.user is set, initial() doesn't touch the db anymore
+            await self.ainitial(request, *args, **kwargs)
+            if self.lookup_field in kwargs or self.lookup_url_kwarg in kwargs:
+                response = await self.aretrieve(request, *args, **kwargs)
+            else:
+                response = await self.alist(request, *args, **kwargs)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return await self._arender(self.response)
+
+    async def ainitial(self, request, *args, **kwargs):
+        # overridden by the mixins whose initial() would block (replicas.py)
+        self.initial(request, *args, **kwargs)
+
+    async def aauthenticate(self, request):
+        # Request._authenticate, with the authenticators' aauthenticate() when they have one
+        try:
+            for authenticator in request.authenticators:
+                if hasattr(authenticator, 'aauthenticate'):
+                    user_auth = await authenticator.aauthenticate(request)
+                else:
+                    user_auth = await sync_to_async(authenticator.authenticate)(request)
+                if user_auth is not None:
+                    request._authenticator = authenticator
+                    request.user, request.auth = user_auth
+                    return
+        except exceptions.APIException:
+            request._not_authenticated()
+            raise
+        request._not_authenticated()
+
+    async def _arender(self, response):
+        # rendered here: django renders a response that has a render() method in a thread (with
+        # the other thread sensitive work), one that has already been rendered too
+        if not isinstance(response, Response):
+            return response
+        if response.accepted_renderer.format == 'api':
+            # the browsable API reads the db for its forms
+            await sync_to_async(response.render)()
+        else:
+            response.render()
+        response.render = None
+        return response
+
+    async def alist(self, request, *args, **kwargs):
+        return await sync_to_async(mixins.ListModelMixin.list)(self, request, *args, **kwargs)
+
+    async def aretrieve(self, request, *args, **kwargs):
+        plan = read_plan_for(self.get_serializer_class()) if FAST_READS else None
+        if plan is None:
+            return await sync_to_async(mixins.RetrieveModelMixin.retrieve)(self, request, *args, **kwargs)
+        # get_object() with aget, the row from the read plan (fastread.py)
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        queryset = self.get_queryset().filter(**{self.lookup_field: kwargs[lookup_url_kwarg]})
+        row = await plan.values(queryset).afirst()
+        if row is None:
+            raise Http404('No %s matches the given query.' % queryset.model._meta.object_name)
+        return Response((await plan.arender([row]))[0])
@@ -0,0 +1,62 @@
+# Token authentication with a token -> user cache in front of it
+# DRF's TokenAuthentication runs a Token JOIN User query on every single request, before the view
+# does anything. The token rarely changes, so we keep the Token (with its user) for TOKEN_CACHE['TTL']
+# seconds and serve the hits without touching the db - a busy client sends many requests per TTL.
+
+# Revocation: deleting a Token (signout, or the cascade when its user is deleted) and saving a user
+# evict the entry right away, see signals.py. With the in-process cache that only reaches the
+# worker that handled the write, the others serve the revoked token until the TTL runs out - that
+# is why the in-process default is a few seconds (DEFAULT_TTL). With TOKEN_CACHE['ALIAS'] set to a
+# cache shared by the workers the eviction reaches all of them, and the TTL can be longer.
+
+# aauthenticate() is the same for the async views (async_reads.py): a hit costs nothing, a miss is
+# one aget() on the event loop's terms instead of a thread per request.
+
+# https://www.django-rest-framework.org/api-guide/authentication/#custom-authentication
+
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
+from rest_framework import authentication, exceptions
+from rest_framework.authtoken.models import Token
+
+from .cache import build_cache
+
+DEFAULT_TTL = 5
+
+_options = getattr(settings, 'TOKEN_CACHE', {})
+token_cache = build_cache({'TTL': DEFAULT_TTL, **_options}, prefix='ex1:token:')
+
+
+class CachedTokenAuthentication(authentication.TokenAuthentication):
+    def authenticate_credentials(self, key):
+        token = token_cache.get(key)
+        if token is None:
+            user, token = super().authenticate_credentials(key)   # raises for unknown/inactive
+            token_cache.set(key, token)
+        return (token.user, token)
+
+    async def aauthenticate(self, request):
+        key = _TokenKey().authenticate(request)
+        if key is None:
+            return None
+        token = await token_cache.aget(key)
+        if token is None:
+            # the checks of TokenAuthentication.authenticate_credentials, with the async ORM
+            try:
+                token = await Token.objects.select_related('user').aget(key=key)
+            except Token.DoesNotExist:
+                raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            if not token.user.is_active:
+                raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+            await token_cache.aset(key, token)
+        return (token.user, token)
+
+
+class _TokenKey(authentication.TokenAuthentication):
+    # DRF's header parsing (and its errors), returns the key instead of looking it up
+    def authenticate_credentials(self, key):
+        return key
+
+
+def evict_token(key):
+    token_cache.delete(key)
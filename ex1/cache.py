@@ -0,0 +1,95 @@
+# Small in-process caches
+# An OrderedDict kept in least-recently-used order: a hit moves the key to the end, when the
+# cache is full the first key goes. Every entry also carries an expiry time (ttl, in seconds).
+# Values are shared between the threads of the worker, treat them as read only.
+
+# For a cache shared by all the workers of a host use a django cache alias instead
+# (LocMemCache is per process too, Memcached/Redis/FileBasedCache are shared)
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+
+
+class LRUCache:
+    def __init__(self, max_size=1000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    # from async code: nothing to wait for, no thread needed
+    async def aget(self, key, default=None):
+        return self.get(key, default)
+
+    async def aset(self, key, value, ttl=None):
+        self.set(key, value, ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# same get/set/delete as LRUCache on top of a django cache alias
+class DjangoCache:
+    def __init__(self, alias, ttl=300, prefix=''):
+        self.cache = caches[alias]
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key, default=None):
+        return self.cache.get(self.prefix + key, default)
+
+    def set(self, key, value, ttl=None):
+        self.cache.set(self.prefix + key, value, self.ttl if ttl is None else ttl)
+
+    # from async code: a call to the cache server (or the files) blocks, it runs in a thread
+    async def aget(self, key, default=None):
+        return await sync_to_async(self.get)(key, default)
+
+    async def aset(self, key, value, ttl=None):
+        await sync_to_async(self.set)(key, value, ttl)
+
+    def delete(self, key):
+        self.cache.delete(self.prefix + key)
+
+    # no clear(): the alias is shared with other users (sessions, the replica pins...), and a
+    # django cache can't drop the keys of one prefix only
+
+
+def build_cache(options, prefix=''):
+    # options = {'TTL': seconds, 'MAX_SIZE': entries, 'ALIAS': django cache alias or None}
+    if options.get('ALIAS'):
+        return DjangoCache(options['ALIAS'], ttl=options.get('TTL', 300), prefix=prefix)
+    return LRUCache(max_size=options.get('MAX_SIZE', 1000), ttl=options.get('TTL', 300))
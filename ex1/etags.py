@@ -0,0 +1,116 @@
+# ETags for the geography endpoints
+# Mobile clients poll the lists every few minutes and nearly always get back the same payload.
+# With an ETag they send If-None-Match: <tag> and get an empty 304 when nothing changed.
+
+# The tag is not a hash of the body (that would mean building the body first), it is a hash of:
+# - for a list: the GeoVersion counter (snapshot.py), which every geography write moves - a one
+#   row pk read. An aggregate over the rows would scan the whole filtered table (not just the
+#   page) on every revalidation, for a tag that a write on any page changes anyway.
+# - for a detail: a fingerprint of its row taken with one aggregate query - updated_at of the
+#   row and of the parents shown in it (a state shows its country's name) - and for the nested
+#   views (etag_children), whose row holds a whole tree, the counter plus an .exists().
+# plus the url, query params and the response format, so each representation has its own tag.
+# Like the snapshot, the counter doesn't see writes made around the API (admin, shell, raw SQL):
+# the list tags only move at the next write through it.
+
+# https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/ETag
+# https://docs.djangoproject.com/en/4.2/topics/conditional-view-processing/
+
+import hashlib
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.utils import timezone
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.response import Response
+
+from .snapshot import aread_version, read_version
+
+ETAGS_ENABLED = getattr(settings, 'GEO_ETAGS', True)
+
+
+def _aggregates(related):
+    aggregates = {'rows': Count('pk'), 'last': Max('updated_at')}
+    for name in related:
+        aggregates[name + '__last'] = Max(name + '__updated_at')
+    return aggregates
+
+
+def fingerprint(queryset, related=()):
+    return queryset.order_by().aggregate(**_aggregates(related))
+
+
+async def afingerprint(queryset, related=()):
+    return await queryset.order_by().aaggregate(**_aggregates(related))
+
+
+def make_etag(request, values):
+    parts = [request.path, sorted(request.query_params.lists()), request.accepted_renderer.format, sorted(values.items())]
+    return '"%s"' % hashlib.md5(repr(parts).encode()).hexdigest()
+
+
+def etag_matches(request, etag):
+    # If-None-Match uses the weak comparison, W/"x" matches "x"
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    tags = [tag.removeprefix('W/') for tag in parse_etags(header)]
+    return etag in tags or '*' in tags
+
+
+def not_modified(etag):
+    return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+
+def touch(objs):
+    # bulk_update() skips auto_now, stamp the rows ourselves - returns the field to add to the update
+    now = timezone.now()
+    for obj in objs:
+        obj.updated_at = now
+    return ['updated_at']
+
+
+class ETagMixin:
+    # forward relations whose fields appear in each row, e.g. ('country',)
+    etag_related = ()
+    # reverse relations nested in each row, e.g. ('states', 'states__cities')
+    etag_children = ()
+
+    def get_etag(self, request, detail=False, version=None):
+        # None when ETags are off or the object doesn't exist (the view answers 404 then);
+        # version: the GeoVersion value when the caller has read it already
+        if not ETAGS_ENABLED:
+            return None
+        if version is None and (not detail or self.etag_children):
+            version = read_version()
+        if not detail:
+            values = {'version': version}
+        elif self.etag_children:
+            values = {'version': version, 'rows': self._etag_queryset().exists()}
+        else:
+            values = fingerprint(self._etag_queryset(), self.etag_related)
+        return self._etag_of(request, detail, values)
+
+    async def aget_etag(self, request, detail=False, version=None):
+        if not ETAGS_ENABLED:
+            return None
+        if version is None and (not detail or self.etag_children):
+            version = await aread_version()
+        if not detail:
+            values = {'version': version}
+        elif self.etag_children:
+            values = {'version': version, 'rows': await self._etag_queryset().aexists()}
+        else:
+            values = await afingerprint(self._etag_queryset(), self.etag_related)
+        return self._etag_of(request, detail, values)
+
+    def _etag_queryset(self):
+        # the row of a detail view
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        return self.get_queryset().filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+
+    def _etag_of(self, request, detail, values):
+        if detail and not values['rows']:
+            return None
+        return make_etag(request, values)
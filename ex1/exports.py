@@ -0,0 +1,92 @@
+# Full dump of countries, states and cities for downstream systems
+# One query: countries LEFT JOIN states LEFT JOIN cities, read with values_list().iterator() - a
+# server side cursor on postgres, fetchmany() chunks on sqlite - so rows go out as they are read
+# and memory stays at one chunk whatever the number of cities. No model instances, no sort (the
+# rows come grouped by country and state, in the order of the join).
+# A country without states or a state without cities is still one row, with the missing columns empty.
+# Formats:
+# - csv: a header line, then one line per row
+# - ndjson: one JSON object per row
+# - columnar: a first line {"columns": [...]}, then one line per chunk holding one array per
+#   column - names are not repeated for every row, loads straight into a dataframe
+# Used by GET /api/export/ and `manage.py export_geography`.
+
+import csv
+import io
+
+from django.conf import settings
+
+from .models import CountryModel
+from .renderers import dumps
+
+EXPORT_CHUNK_SIZE = getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+
+# (column name, lookup from CountryModel)
+EXPORT_COLUMNS = [
+    ('country_code', 'country_code'),
+    ('country_name', 'name'),
+    ('country_curr_symbol', 'curr_symbol'),
+    ('country_phone_code', 'phone_code'),
+    ('state_code', 'states__state_code'),
+    ('state_name', 'states__name'),
+    ('state_gst_code', 'states__gst_code'),
+    ('city_code', 'states__cities__city_code'),
+    ('city_name', 'states__cities__name'),
+    ('city_phone_code', 'states__cities__phone_code'),
+    ('city_population', 'states__cities__population'),
+    ('city_avg_age', 'states__cities__avg_age'),
+    ('city_num_of_adults_males', 'states__cities__num_of_adults_males'),
+    ('city_num_of_adults_females', 'states__cities__num_of_adults_females'),
+]
+COLUMN_NAMES = [name for name, _ in EXPORT_COLUMNS]
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+    'columnar': 'application/x-ndjson',
+}
+
+
+def export_chunks(chunk_size=EXPORT_CHUNK_SIZE):
+    # lists of row tuples, chunk_size rows each
+    rows = CountryModel.objects.order_by().values_list(*[lookup for _, lookup in EXPORT_COLUMNS])
+    chunk = []
+    for row in rows.iterator(chunk_size=chunk_size):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def csv_stream(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMN_NAMES)
+    for chunk in chunks:
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def ndjson_stream(chunks):
+    for chunk in chunks:
+        yield b''.join(dumps(dict(zip(COLUMN_NAMES, row))) + b'\n' for row in chunk)
+
+
+def columnar_stream(chunks):
+    yield dumps({'columns': COLUMN_NAMES}) + b'\n'
+    for chunk in chunks:
+        yield dumps([list(column) for column in zip(*chunk)]) + b'\n'
+
+
+STREAMS = {'csv': csv_stream, 'ndjson': ndjson_stream, 'columnar': columnar_stream}
+
+
+def export_stream(export_format, chunk_size=EXPORT_CHUNK_SIZE):
+    # bytes, one piece per chunk of rows
+    return STREAMS[export_format](export_chunks(chunk_size))
@@ -0,0 +1,183 @@
+# Fast read path for the GET lists
+# A ModelSerializer list builds a model instance per row (plus one per joined row), then for every
+# field walks get_attribute() and to_representation() through the DRF field machinery.
+# For plain read-only output most of that is wasted: here each serializer class is compiled once
+# into a ReadPlan - the .values() lookup and a converter for every output field - and the rows come
+# straight from .values() as dicts:
+# - dotted sources become joined lookups, source='country.country_code' -> 'country__country_code'
+# - SerializerMethodFields use their Meta.method_field_sources entry, the method is taken to
+#   return that value as is (like get_my_country__name -> 'country.name')
+# - nested many=True serializers over a reverse FK are one more .values() query per level,
+#   filtered on the parent ids like prefetch_related would, and grouped under their parent
+# The dicts come out with the same keys, order and values as serializer.data, so the JSON is the
+# same bytes. A serializer using anything else (custom fields, methods without a declared source)
+# gets no plan and goes through the serializer as before.
+
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework import serializers
+from rest_framework.response import Response
+
+FAST_READS = getattr(settings, 'GEO_FAST_READS', True)
+
+
+class Unsupported(Exception):
+    pass
+
+
+def _converter(field):
+    # the same value field.to_representation() gives, without going through the field when we can
+    if isinstance(field, serializers.SerializerMethodField):
+        return None
+    if isinstance(field, serializers.RelatedField):
+        if not field.use_pk_only_optimization() or field.pk_field is not None:
+            raise Unsupported(field)
+        return None    # the pk as it is, like PrimaryKeyRelatedField
+    if type(field) is serializers.CharField:
+        return str
+    if type(field) is serializers.IntegerField:
+        return int
+    if type(field) is serializers.FloatField:
+        return float
+    if type(field) is serializers.UUIDField and field.uuid_format == 'hex_verbose':
+        return str
+    return field.to_representation
+
+
+def _lookup(field):
+    if isinstance(field, serializers.SerializerMethodField):
+        source = getattr(field.parent.Meta, 'method_field_sources', {}).get(field.field_name)
+        if not source:
+            raise Unsupported(field)
+        return source.replace('.', '__')
+    if field.source == '*':
+        raise Unsupported(field)
+    return '__'.join(field.source_attrs)
+
+
+class ReadPlan:
+    def __init__(self, serializer):
+        model = serializer.Meta.model
+        self.model = model
+        self.columns = []     # (output key, values() lookup, converter or None)
+        self.children = []    # (output key, child ReadPlan, fk attname on the child, fk name)
+        self.outputs = []     # output keys in serializer order
+        for name, field in serializer.fields.items():
+            if field.write_only:
+                continue
+            self.outputs.append(name)
+            if isinstance(field, serializers.ListSerializer):
+                self.children.append((name,) + self._child(model, field))
+            elif isinstance(field, (serializers.BaseSerializer, serializers.ManyRelatedField)):
+                raise Unsupported(field)
+            else:
+                self.columns.append((name, _lookup(field), _converter(field)))
+        self.lookups = sorted({lookup for _, lookup, _ in self.columns} | {'pk'})
+
+    @staticmethod
+    def _child(model, field):
+        # reverse FK only (country.states, state.cities)
+        try:
+            relation = model._meta.get_field(field.source)
+        except FieldDoesNotExist:
+            raise Unsupported(field)
+        if not relation.one_to_many:
+            raise Unsupported(field)
+        return ReadPlan(field.child), relation.field.attname, relation.field.name
+
+    def values(self, queryset, *extra):
+        return queryset.values(*self.lookups, *extra)
+
+    def render(self, rows):
+        # rows from values() -> output dicts, the nested levels fetched with one query each
+        children = []
+        for name, plan, fk_attname, fk_name in self.children:
+            children.append((name, plan.children_of(fk_attname, fk_name, [row['pk'] for row in rows])))
+        return self._render(rows, children)
+
+    async def arender(self, rows):
+        # the same with the async ORM
+        children = []
+        for name, plan, fk_attname, fk_name in self.children:
+            children.append((name, await plan.achildren_of(fk_attname, fk_name, [row['pk'] for row in rows])))
+        return self._render(rows, children)
+
+    def _render(self, rows, children):
+        columns = self.columns
+        outputs = self.outputs
+        result = []
+        for row in rows:
+            item = {}
+            for name, lookup, convert in columns:
+                value = row[lookup]
+                item[name] = value if value is None or convert is None else convert(value)
+            for name, grouped in children:
+                item[name] = grouped.get(row['pk'], [])
+            # the serializer's field order, nested fields can sit in the middle
+            result.append(item if not children else {name: item[name] for name in outputs})
+        return result
+
+    def children_of(self, fk_attname, fk_name, parent_ids):
+        if not parent_ids:
+            return {}
+        rows = list(self._children_query(fk_attname, fk_name, parent_ids))
+        return _group(rows, self.render(rows), fk_attname)
+
+    async def achildren_of(self, fk_attname, fk_name, parent_ids):
+        if not parent_ids:
+            return {}
+        rows = [row async for row in self._children_query(fk_attname, fk_name, parent_ids).aiterator()]
+        return _group(rows, await self.arender(rows), fk_attname)
+
+    def _children_query(self, fk_attname, fk_name, parent_ids):
+        return self.model._default_manager.filter(**{fk_name + '__in': parent_ids}).values(fk_attname, *self.lookups)
+
+
+def _group(rows, items, fk_attname):
+    grouped = {}
+    for row, item in zip(rows, items):
+        grouped.setdefault(row[fk_attname], []).append(item)
+    return grouped
+
+
+@lru_cache(maxsize=None)
+def read_plan_for(serializer_class):
+    # ReadPlan for a serializer class, or None when it needs the real serializer
+    try:
+        return ReadPlan(serializer_class())
+    except Unsupported:
+        return None
+
+
+# Mixin for list views, sits before QueryPlanMixin - the joins come from .values() here, the
+# select/prefetch plan only matters when falling back to the serializer
+class FastReadMixin:
+    def list(self, request, *args, **kwargs):
+        plan = read_plan_for(self.get_serializer_class()) if FAST_READS else None
+        if plan is None:
+            return super().list(request, *args, **kwargs)
+        rows = self._plan_rows(plan)
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(plan.render(page))
+        return Response(plan.render(list(rows)))
+
+    async def alist(self, request, *args, **kwargs):
+        # the async views (async_reads.py): same rows through aiterator()
+        plan = read_plan_for(self.get_serializer_class()) if FAST_READS else None
+        if plan is None:
+            return await super().alist(request, *args, **kwargs)
+        rows = self._plan_rows(plan)
+        if self.paginator is not None:
+            page = await self.paginator.apaginate_queryset(rows, request, view=self)
+            if page is not None:
+                return self.get_paginated_response(await plan.arender(page))
+        return Response(await plan.arender([row async for row in rows.aiterator()]))
+
+    def _plan_rows(self, plan):
+        # the cursor paginator reads its ordering fields off the rows, so they must be in the dicts
+        ordering = getattr(self.paginator, 'ordering', None) or ()
+        ordering = [name.lstrip('-') for name in ((ordering,) if isinstance(ordering, str) else ordering)]
+        return plan.values(self.get_queryset(), *ordering)
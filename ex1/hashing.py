@@ -0,0 +1,183 @@
+# Signin password checks in a bounded pool
+# Checking a password means running the PBKDF2 hasher (hundreds of thousands of iterations) - tens of
+# milliseconds of pure CPU per signin. Run inline, a burst of logins keeps every worker busy hashing
+# and the cheap reads queue up behind them.
+# So signin hands the check to a small bounded pool:
+# - at most MAX_WORKERS hashes run at the same time (processes by default, or threads - hashlib
+#   releases the GIL while it hashes)
+# - at most MAX_PENDING more wait for a slot, past that the signin is refused straight away (503)
+#   instead of piling up
+# - a hash keeps its slot until it has finished, even when the signin waiting on it timed out
+#   (a running hash can't be cancelled)
+# - stats() reports the queue depth and timings, served at /api/auth/signin/stats/
+# What the pool bounds is the CPU spent hashing, not the request threads: a signin still waits for
+# its result (up to TIMEOUT), so up to MAX_WORKERS + MAX_PENDING request workers can be tied up
+# waiting - they just don't burn CPU, and the signins past that get their 503 at once.
+# PooledModelBackend is django's ModelBackend with its password check in the pool inside
+# pooled_checks() - the signin serializer - and inline everywhere else (admin, session, basic
+# auth), where nothing turns a full pool into a 503. Signin goes through authenticate() like any
+# login: AUTHENTICATION_BACKENDS and the login signals still apply.
+
+# https://docs.python.org/3/library/concurrent.futures.html
+# https://docs.djangoproject.com/en/4.2/topics/auth/passwords/
+
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.hashers import check_password, identify_hasher, make_password
+
+
+class PasswordPoolBusy(Exception):
+    pass
+
+
+def _init_worker():
+    # spawned (not forked) workers start without django configured
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+
+
+def _check(raw_password, encoded):
+    # runs in the pool - returns (matches, new encoded password if the hasher settings changed)
+    if not check_password(raw_password, encoded):
+        return False, None
+    try:
+        must_update = identify_hasher(encoded).must_update(encoded)
+    except ValueError:
+        must_update = False
+    return True, make_password(raw_password) if must_update else None
+
+
+class PasswordCheckPool:
+    def __init__(self, executor='process', max_workers=2, max_pending=32, timeout=10):
+        self.executor_type = executor
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._total_seconds = 0.0
+        self._dummy_encoded = None
+
+    def _get_executor(self):
+        # created on first use, not at import - no processes forked for management commands
+        with self._lock:
+            if self._executor is None:
+                if self.executor_type == 'thread':
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='password')
+                else:
+                    self._executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_worker)
+            return self._executor
+
+    def check(self, raw_password, encoded):
+        # (matches, new encoded password or None), raises PasswordPoolBusy when the queue is full
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise PasswordPoolBusy()
+
+        started = time.monotonic()
+        with self._lock:
+            self._in_flight += 1
+        try:
+            future = self._get_executor().submit(_check, raw_password, encoded)
+        except BaseException:
+            self._done(started)
+            raise
+        # the slot is given back when the hash is over, not when we stop waiting for it
+        future.add_done_callback(lambda future: self._done(started))
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()   # only stops it if it hasn't started yet
+            with self._lock:
+                self._timed_out += 1
+            raise PasswordPoolBusy()
+
+    def _done(self, started):
+        with self._lock:
+            self._in_flight -= 1
+            self._completed += 1
+            self._total_seconds += time.monotonic() - started
+        self._slots.release()
+
+    def check_missing_user(self, raw_password):
+        # hash anyway when the user doesn't exist, so the response time doesn't tell (like ModelBackend)
+        if self._dummy_encoded is None:
+            self._dummy_encoded = make_password('not-a-real-password')
+        self.check(raw_password, self._dummy_encoded)
+        return False, None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'executor': self.executor_type,
+                'max_workers': self.max_workers,
+                'max_pending': self.max_pending,
+                'in_flight': self._in_flight,
+                'queued': max(0, self._in_flight - self.max_workers),
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'timed_out': self._timed_out,
+                'avg_ms': round(1000 * self._total_seconds / self._completed, 2) if self._completed else None,
+            }
+
+
+_options = getattr(settings, 'SIGNIN_HASH_POOL', {})
+password_pool = PasswordCheckPool(
+    executor=_options.get('EXECUTOR', 'process'),
+    max_workers=_options.get('MAX_WORKERS', 2),
+    max_pending=_options.get('MAX_PENDING', 32),
+    timeout=_options.get('TIMEOUT', 10),
+)
+
+
+_pooled = ContextVar('ex1_pooled_password_checks', default=False)
+
+
+@contextmanager
+def pooled_checks():
+    # the authenticate() calls inside check passwords in password_pool, and may raise PasswordPoolBusy
+    token = _pooled.set(True)
+    try:
+        yield
+    finally:
+        _pooled.reset(token)
+
+
+class PooledModelBackend(ModelBackend):
+    # ModelBackend.authenticate, with check_password() run by password_pool inside pooled_checks()
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if not _pooled.get():
+            return super().authenticate(request, username, password, **kwargs)
+        UserModel = get_user_model()
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        try:
+            user = UserModel._default_manager.get_by_natural_key(username)
+        except UserModel.DoesNotExist:
+            password_pool.check_missing_user(password)
+            return None
+        matches, new_encoded = password_pool.check(password, user.password)
+        if not matches or not self.user_can_authenticate(user):
+            return None
+        if new_encoded:
+            # hasher settings changed since this password was stored, keep the re-hashed one
+            user.password = new_encoded
+            user.save(update_fields=['password'])
+        return user
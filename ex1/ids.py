@@ -0,0 +1,43 @@
+# Primary key values for the UUID pk models
+# uuid4 is random: consecutive inserts land all over the pk index, so every insert touches some
+# page of it and a bulk load of cities gets slower as the table outgrows the cache. uuid7 (RFC 9562,
+# not in the stdlib before python 3.14) starts with the time in milliseconds, so new keys are
+# always near the end of the index - the same UUIDField, 36 chars in the urls, still unguessable
+# (74 random bits). Keys made in the same millisecond by this process keep increasing too: the 12
+# bits after the version count up from a random start.
+# PRIMARY_KEY_UUID (settings) picks the kind, `manage.py bench_ids` compares both.
+
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+_lock = threading.Lock()
+_last_ms = 0
+_counter = 0
+
+
+def uuid7():
+    global _last_ms, _counter
+    with _lock:
+        ms = time.time_ns() // 1000000
+        if ms > _last_ms:
+            # the top bit stays clear, room for 2048 more keys in this millisecond
+            _last_ms, _counter = ms, int.from_bytes(os.urandom(2), 'big') & 0x7ff
+        else:
+            # same millisecond, or the clock went back: keep counting after the last key
+            _counter += 1
+            if _counter > 0xfff:
+                _last_ms, _counter = _last_ms + 1, 0
+        ms, counter = _last_ms, _counter
+    random_bits = int.from_bytes(os.urandom(8), 'big') & (1 << 62) - 1
+    return uuid.UUID(int=ms << 80 | 7 << 76 | counter << 64 | 2 << 62 | random_bits)
+
+
+def new_id():
+    # default of the pk fields, a function (not uuid7 itself) so the setting can switch it without a migration
+    if getattr(settings, 'PRIMARY_KEY_UUID', 'uuid7') == 'uuid4':
+        return uuid.uuid4()
+    return uuid7()
@@ -0,0 +1,97 @@
+# Bulk import of states and cities from a CSV or NDJSON upload
+# The body is read line by line as it arrives and cut into batches of IMPORT_BATCH_SIZE rows, each
+# batch goes through the upsert path (queries.py): one IN query for the codes, one for the parent
+# codes, bulk_create/bulk_update, in its own transaction. Memory holds one batch, whatever the file
+# size, and a failure later in the file doesn't undo the batches already written.
+# Each value is validated by its model field (max_length, positive numbers...) and a row that
+# fails, or clashes with a stored one, is reported with errors keyed by field - see _upsert.
+# Rows are keyed on state_code / city_code like the upserts, importing the same file twice updates
+# instead of failing. The report has the totals and only the rows that failed, with their line.
+
+# CSV: a header line with the field names, e.g.
+#     city_code,name,state_code,phone_code,population,avg_age,num_of_adults_males,num_of_adults_females
+# empty cells are left out (a new row then needs every required field, an existing row keeps its value)
+# NDJSON: one JSON object per line, same keys
+
+# https://docs.python.org/3/library/csv.html
+
+import codecs
+import csv
+import json
+from itertools import islice
+
+from django.conf import settings
+
+from .queries import upsert_rows
+
+IMPORT_BATCH_SIZE = getattr(settings, 'IMPORT_BATCH_SIZE', 1000)
+# stop listing failed rows past this many, the totals still count them all
+IMPORT_MAX_ERRORS = getattr(settings, 'IMPORT_MAX_ERRORS', 1000)
+
+CSV_TYPES = ('text/csv', 'application/csv')
+NDJSON_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl', 'application/x-jsonlines')
+
+
+def import_format(content_type='', filename=''):
+    # 'csv', 'ndjson' or None
+    content_type = content_type.split(';')[0].strip().lower()
+    if content_type in CSV_TYPES or filename.lower().endswith('.csv'):
+        return 'csv'
+    if content_type in NDJSON_TYPES or filename.lower().endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    return None
+
+
+def read_csv(lines):
+    # (line number, row or None, error) for each record
+    reader = csv.DictReader(codecs.iterdecode(lines, 'utf-8-sig'))
+    for row in reader:
+        yield reader.line_num, {name: value for name, value in row.items() if name and value not in ('', None)}, None
+
+
+def read_ndjson(lines):
+    for line_num, line in enumerate(codecs.iterdecode(lines, 'utf-8-sig'), start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_num, None, 'Invalid JSON.'
+            continue
+        if not isinstance(row, dict):
+            yield line_num, None, 'Expected a JSON object.'
+            continue
+        yield line_num, row, None
+
+
+READERS = {'csv': read_csv, 'ndjson': read_ndjson}
+
+
+def import_rows(model, records, batch_size=IMPORT_BATCH_SIZE, max_errors=IMPORT_MAX_ERRORS):
+    totals = {status: 0 for status in ('created', 'updated', 'unchanged', 'error')}
+    errors = []
+
+    def add_error(line_num, result):
+        totals['error'] += 1
+        if len(errors) < max_errors:
+            errors.append({'line': line_num, **result})
+
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+        lines, rows = [], []
+        for line_num, row, error in batch:
+            if error:
+                add_error(line_num, {'status': 'error', 'errors': {'non_field_errors': [error]}})
+            else:
+                lines.append(line_num)
+                rows.append(row)
+        for line_num, result in zip(lines, upsert_rows(model, rows) if rows else []):
+            if result['status'] == 'error':
+                add_error(line_num, result)
+            else:
+                totals[result['status']] += 1
+
+    return {'totals': totals, 'errors': errors, 'errors_truncated': totals['error'] > len(errors)}
@@ -0,0 +1,77 @@
+# python manage.py bench_ids [--rows 1000000] [--every 100000]
+# Times bulk_create of made up cities with uuid4 and with uuid7 primary keys (ex1/ids.py): rows/s
+# for each slice of --every rows, so the slowdown as the table grows shows, then the size and fill
+# of the table and of its pk index. Each kind runs in its own transaction, rolled back at the end,
+# the db is left as it was. Index sizes come from sqlite's dbstat, other dbs only get the timings.
+
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from ex1.ids import uuid7
+from ex1.models import CityModel, CountryModel, StateModel
+
+KINDS = {'uuid4': uuid.uuid4, 'uuid7': uuid7}
+
+
+class Command(BaseCommand):
+    help = 'Benchmark bulk city inserts with random (uuid4) and time ordered (uuid7) primary keys'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000)
+        parser.add_argument('--every', type=int, default=100000)
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'BULK_BATCH_SIZE', 500))
+        parser.add_argument('--kinds', nargs='+', choices=sorted(KINDS), default=sorted(KINDS))
+
+    def handle(self, *args, **options):
+        self.stdout.write('%d rows in batches of %d, %d cities in the db already' % (
+            options['rows'], options['batch_size'], CityModel.objects.count()))
+        for kind in options['kinds']:
+            with transaction.atomic():
+                self.run(kind, KINDS[kind], options)
+                transaction.set_rollback(True)
+
+    def run(self, kind, make_id, options):
+        country = CountryModel.objects.create(name='Bench', country_code='BENCH', curr_symbol='B', phone_code='BENCH')
+        state = StateModel.objects.create(name='Bench', state_code='BENCH', country=country)
+        path = CityModel.path_from(state)
+        rows, every, batch_size = options['rows'], options['every'], options['batch_size']
+
+        total = slice_time = 0.0
+        for start in range(0, rows, batch_size):
+            cities = [
+                CityModel(
+                    id=make_id(), name='Bench %d' % i, city_code='B%d' % i, phone_code='B%d' % i,
+                    population=1000, avg_age=30.0, num_of_adults_males=300, num_of_adults_females=300,
+                    state=state, **path,
+                ) for i in range(start, min(start + batch_size, rows))
+            ]
+            started = time.perf_counter()
+            CityModel.objects.bulk_create(cities, batch_size=batch_size)
+            elapsed = time.perf_counter() - started
+            total += elapsed
+            slice_time += elapsed
+            done = start + len(cities)
+            if done % every == 0 or done == rows:
+                self.stdout.write('%s  rows %8d  %9.0f rows/s' % (kind, done, (every if done % every == 0 else done % every) / slice_time))
+                slice_time = 0.0
+        self.stdout.write('%s  total %.2f s, %.0f rows/s' % (kind, total, rows / total))
+
+        if connection.vendor == 'sqlite':
+            for name, size, unused in self.sizes():
+                self.stdout.write('%s  %-40s %8.1f MB  %3.0f%% full' % (kind, name, size / 2 ** 20, 100 * (1 - unused / size)))
+
+    def sizes(self):
+        # the table and its pk index (origin 'pk', the unique index sqlite makes for a non integer pk)
+        table = CityModel._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA index_list(%s)' % connection.ops.quote_name(table))
+            names = [table] + [row[1] for row in cursor.fetchall() if row[3] == 'pk']
+            cursor.execute(
+                'SELECT name, SUM(pgsize), SUM(unused) FROM dbstat WHERE name IN (%s) GROUP BY name ORDER BY name'
+                % ', '.join(['%s'] * len(names)), names,
+            )
+            return cursor.fetchall()
@@ -0,0 +1,47 @@
+# python manage.py bench_json [--repeat 20] [--copies 50]
+# Times encoding the /api/nested/countries/ payload with DRF's stdlib JSONRenderer and with the
+# orjson backed FastJSONRenderer (ex1/renderers.py), and checks both give the same bytes.
+# --copies repeats the countries in the payload to get a bigger body out of a small db.
+
+import time
+
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from ex1 import renderers
+from ex1.models import CountryModel
+from ex1.prefetch import apply_query_plan
+from ex1.serializers import NestedCountrySerializer
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the JSON encoders on the nested country payload'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--copies', type=int, default=1)
+
+    def handle(self, *args, **options):
+        queryset = apply_query_plan(CountryModel.objects.order_by('name', 'id'), NestedCountrySerializer)
+        data = list(NestedCountrySerializer(queryset, many=True).data) * options['copies']
+
+        encoders = {'stdlib': JSONRenderer().render}
+        if renderers.orjson is not None:
+            encoders['orjson'] = renderers.orjson_dumps
+        else:
+            self.stdout.write('orjson is not installed, only the stdlib encoder is timed')
+
+        results = {}
+        for name, encode in encoders.items():
+            content = encode(data)
+            started = time.perf_counter()
+            for _ in range(options['repeat']):
+                encode(data)
+            seconds = (time.perf_counter() - started) / options['repeat']
+            results[name] = content
+            self.stdout.write('%-7s %8.2f ms  %7.1f MB/s  %d bytes' % (
+                name, seconds * 1000, len(content) / seconds / 1e6, len(content)))
+
+        if len(results) > 1:
+            same = len(set(results.values())) == 1
+            self.stdout.write('same bytes: %s' % same)
@@ -0,0 +1,55 @@
+# python manage.py bench_search [--cities 1000000] [--queries 2000] [--limit 10]
+# Times the city search index (ex1/search.py) on made up city names, without the db: the build,
+# then prefix queries (the first 1 to 6 letters of a random city) and fuzzy queries (a random
+# city with one letter changed), p50/p99/max per kind.
+
+import random
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from ex1.search import CityIndex
+
+# consonant + vowel (+ consonant) syllables, 2 or 3 per word
+SYLLABLES = [c + v + end for c in 'bcdfghjklmnprstvwyz' for v in 'aeiou' for end in ('', 'n', 'r', 'l', 's', 'm', 't', 'k')]
+
+
+def _made_up_name(rng):
+    name = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3))).capitalize()
+    return name if rng.random() > 0.2 else name + ' ' + rng.choice(SYLLABLES).capitalize()
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the city search index on a synthetic set of cities'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cities', type=int, default=1000000)
+        parser.add_argument('--queries', type=int, default=2000)
+        parser.add_argument('--limit', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        names = [_made_up_name(rng) for _ in range(options['cities'])]
+        rows = ((uuid.uuid4(), name, 'C%d' % i, int(rng.paretovariate(1.2) * 1000), 1) for i, name in enumerate(names))
+        started = time.perf_counter()
+        index = CityIndex.from_rows(rows)
+        self.stdout.write('build   %8.2f s   %d cities' % (time.perf_counter() - started, options['cities']))
+
+        prefixes = [rng.choice(names)[:rng.randint(1, 6)] for _ in range(options['queries'])]
+        typos = []
+        for _ in range(options['queries']):
+            name = rng.choice(names)
+            at = rng.randrange(len(name))
+            typos.append(name[:at] + rng.choice('aeiourstn') + name[at + 1:])
+
+        for kind, search, queries in (('prefix', index.prefix, prefixes), ('fuzzy', index.fuzzy, typos)):
+            timings = []
+            for query in queries:
+                started = time.perf_counter()
+                search(query, options['limit'])
+                timings.append(time.perf_counter() - started)
+            timings.sort()
+            self.stdout.write('%-7s p50 %6.2f ms   p99 %6.2f ms   max %6.2f ms' % (
+                kind, timings[len(timings) // 2] * 1000, timings[int(len(timings) * 0.99)] * 1000, timings[-1] * 1000))
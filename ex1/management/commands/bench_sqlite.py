@@ -0,0 +1,130 @@
+# python manage.py bench_sqlite [--readers 8] [--seconds 5]
+# Parallel readers against one writer on a copy of the db, twice:
+# - before: sqlite defaults (rollback journal), a new connection per read like CONN_MAX_AGE = 0
+# - after: SQLITE_PRAGMAS (ex1/sqlite.py, WAL) and one connection per thread kept open
+# The readers look up random cities the way the city detail view does, the writer keeps updating
+# one city per transaction. Reads/s, read p50/p99 and "database is locked" errors per side.
+# The copy is made with sqlite's backup API in a temp dir, the db itself isn't touched.
+
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import closing
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from ex1.models import CityModel
+from ex1.sqlite import pragma_statements
+
+
+def _detail_query():
+    # the SELECT of the city detail lookup, with placeholders for the path
+    queryset = CityModel.objects.filter(country_code='', state_code='', city_code='').values(
+        'id', 'name', 'city_code', 'population', 'state_code', 'country_code',
+    )
+    sql, _ = queryset.query.sql_with_params()
+    return sql.replace('%s', '?')
+
+
+class Command(BaseCommand):
+    help = 'Benchmark concurrent reads and a writer with the default and the tuned sqlite setup'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=8)
+        parser.add_argument('--seconds', type=float, default=5)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('bench_sqlite needs the sqlite backend')
+        keys = list(CityModel.objects.values_list('country_code', 'state_code', 'city_code', 'id'))
+        if not keys:
+            raise CommandError('no cities to read')
+        table = CityModel._meta.db_table
+        self.read_sql = _detail_query()
+        self.write_sql = 'UPDATE %s SET updated_at = ? WHERE id = ?' % connection.ops.quote_name(table)
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'bench.sqlite3')
+            with closing(sqlite3.connect(path)) as copy:
+                connection.ensure_connection()
+                connection.connection.backup(copy)
+                # the copy keeps the journal mode of the source, start from the default one
+                copy.execute('PRAGMA journal_mode = delete')
+            for label, pragmas, persistent in (('before', [], False), ('after', pragma_statements(), True)):
+                self.report(label, self.run(path, keys, pragmas, persistent, options))
+        finally:
+            shutil.rmtree(directory)
+
+    def run(self, path, keys, pragmas, persistent, options):
+        stop = time.monotonic() + options['seconds']
+        results = {'reads': [], 'read_errors': 0, 'writes': 0, 'write_errors': 0}
+        lock = threading.Lock()
+
+        def connect():
+            db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+            for statement in pragmas:
+                db.execute(statement)
+            return db
+
+        def reader(seed):
+            rng = random.Random(seed)
+            timings, errors = [], 0
+            db = connect() if persistent else None
+            while time.monotonic() < stop:
+                started = time.perf_counter()
+                try:
+                    current = db or connect()
+                    current.execute(self.read_sql, rng.choice(keys)[:3]).fetchall()
+                    if not persistent:
+                        current.close()
+                except sqlite3.OperationalError:
+                    errors += 1
+                    continue
+                timings.append(time.perf_counter() - started)
+            if db:
+                db.close()
+            with lock:
+                results['reads'].extend(timings)
+                results['read_errors'] += errors
+
+        def writer():
+            rng = random.Random(0)
+            db = connect()
+            while time.monotonic() < stop:
+                try:
+                    db.execute('BEGIN IMMEDIATE')
+                    db.execute(self.write_sql, [timezone.now().isoformat(), rng.choice(keys)[3].hex])
+                    db.execute('COMMIT')
+                    results['writes'] += 1
+                except sqlite3.OperationalError:
+                    if db.in_transaction:
+                        db.execute('ROLLBACK')
+                    results['write_errors'] += 1
+            db.close()
+
+        threads = [threading.Thread(target=writer)]
+        threads += [threading.Thread(target=reader, args=(seed,)) for seed in range(options['readers'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        results['seconds'] = options['seconds']
+        return results
+
+    def report(self, label, results):
+        timings = sorted(results['reads'])
+        seconds = results['seconds']
+        if timings:
+            self.stdout.write('%-6s reads %8.0f/s  p50 %7.3f ms  p99 %7.3f ms  locked %d' % (
+                label, len(timings) / seconds, timings[len(timings) // 2] * 1000,
+                timings[int(len(timings) * 0.99)] * 1000, results['read_errors']))
+        else:
+            self.stdout.write('%-6s reads        0/s  locked %d' % (label, results['read_errors']))
+        self.stdout.write('%-6s writes %7.0f/s  locked %d' % (label, results['writes'] / seconds, results['write_errors']))
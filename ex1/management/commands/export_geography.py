@@ -0,0 +1,31 @@
+# python manage.py export_geography [--output csv|ndjson|columnar] [--file path] [--chunk-size N]
+# Same dump as GET /api/export/ (ex1/exports.py), written to a file or to stdout
+
+import sys
+
+from django.core.management.base import BaseCommand
+
+from ex1.exports import EXPORT_CHUNK_SIZE, STREAMS, export_stream
+
+
+class Command(BaseCommand):
+    help = 'Export every country, state and city as CSV, NDJSON or columnar NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', choices=sorted(STREAMS), default='csv')
+        parser.add_argument('--file', help='write here instead of stdout')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        stream = export_stream(options['output'], options['chunk_size'])
+        if not options['file']:
+            for piece in stream:
+                sys.stdout.buffer.write(piece)
+            sys.stdout.buffer.flush()
+            return
+        written = 0
+        with open(options['file'], 'wb') as out:
+            for piece in stream:
+                out.write(piece)
+                written += len(piece)
+        self.stderr.write('%d bytes written to %s' % (written, options['file']))
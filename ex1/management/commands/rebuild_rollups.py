@@ -0,0 +1,32 @@
+# python manage.py rebuild_rollups [--check]
+# Adds up the cities again and compares with the StateRollup/CountryRollup rows (ex1/rollups.py),
+# rows that drifted (writes that went around the ORM, raw SQL, a restored backup...) are rewritten.
+# --check only reports them and exits with status 1 when there are any, e.g. for a cron job
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ex1.models import CountryRollup, StateRollup
+from ex1.rollups import check_rollups
+
+ROLLUPS = [
+    ('states', StateRollup, 'state_id', 'state_id'),
+    ('countries', CountryRollup, 'country_id', 'state__country_id'),
+]
+
+
+class Command(BaseCommand):
+    help = 'Check the state and country rollups against the cities and repair the ones that drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='only report, exit with status 1 on drift')
+
+    def handle(self, *args, **options):
+        total = 0
+        # states first, a state rebuilt meanwhile doesn't change its country's totals
+        for label, model, key, group_by in ROLLUPS:
+            drifted = check_rollups(model, key, group_by, repair=not options['check'])
+            total += len(drifted)
+            verb = 'drifted' if options['check'] else 'repaired'
+            self.stdout.write('%s: %d %s' % (label, len(drifted), verb))
+        if options['check'] and total:
+            raise CommandError('%d rollup rows drifted, run rebuild_rollups to repair them' % total)
@@ -0,0 +1,32 @@
+# python manage.py sync_replicas [alias ...]
+# Copies the default sqlite db over the local stand-in replicas (DB_REPLICAS['DATABASES'], or the
+# aliases given) with sqlite's backup API - a consistent copy even while the app is writing.
+# Run it again to "replicate" newer writes; a real replica is kept up to date by the db server.
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from ex1.replicas import REPLICA_DATABASES
+
+
+class Command(BaseCommand):
+    help = 'Copy the default sqlite database to the replica aliases'
+
+    def add_arguments(self, parser):
+        parser.add_argument('aliases', nargs='*')
+
+    def handle(self, *args, **options):
+        aliases = options['aliases'] or REPLICA_DATABASES
+        if not aliases:
+            raise CommandError('no replica aliases, list them in DB_REPLICAS or give them here')
+        primary = connections[DEFAULT_DB_ALIAS]
+        for alias in aliases:
+            if alias not in connections or alias == DEFAULT_DB_ALIAS:
+                raise CommandError('%s is not a replica alias' % alias)
+            replica = connections[alias]
+            if primary.vendor != 'sqlite' or replica.vendor != 'sqlite':
+                raise CommandError('sync_replicas only copies sqlite databases')
+            primary.ensure_connection()
+            replica.ensure_connection()
+            primary.connection.backup(replica.connection)
+            self.stdout.write('%s -> %s (%s)' % (DEFAULT_DB_ALIAS, alias, replica.settings_dict['NAME']))
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 10:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ex1', '0004_assign_users'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='citymodel',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='countrymodel',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='statemodel',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 10:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ex1', '0005_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='citymodel',
+            index=models.Index(fields=['state', 'name', 'id'], name='city_state_name_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='countrymodel',
+            index=models.Index(fields=['name', 'id'], name='country_name_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='statemodel',
+            index=models.Index(fields=['country', 'name', 'id'], name='state_country_name_id_idx'),
+        ),
+    ]
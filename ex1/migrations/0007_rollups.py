@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-17 10:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, F, FloatField, Sum
+
+
+# the rollups of the cities already there, one GROUP BY per table
+def backfill_rollups(apps, schema_editor):
+    CityModel = apps.get_model('ex1', 'CityModel')
+    StateRollup = apps.get_model('ex1', 'StateRollup')
+    CountryRollup = apps.get_model('ex1', 'CountryRollup')
+    # annotation names can't reuse the city field names, F('population') would point at the sum
+    fields = ['city_count', 'population', 'adult_males', 'adult_females', 'age_weighted_sum']
+    totals = dict(
+        total_city_count=Count('id'),
+        total_population=Sum('population'),
+        total_adult_males=Sum('num_of_adults_males'),
+        total_adult_females=Sum('num_of_adults_females'),
+        total_age_weighted_sum=Sum(F('avg_age') * F('population'), output_field=FloatField()),
+    )
+    for model, key, group_by in ((StateRollup, 'state_id', 'state_id'), (CountryRollup, 'country_id', 'state__country_id')):
+        rows = CityModel.objects.order_by().values(group_by).annotate(**totals).values_list(group_by, *totals)
+        model.objects.bulk_create(
+            [model(**{key: row[0]}, **dict(zip(fields, row[1:]))) for row in rows],
+            batch_size=1000,
+        )
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ex1', '0006_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CountryRollup',
+            fields=[
+                ('country', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='rollup', serialize=False, to='ex1.countrymodel')),
+                ('city_count', models.BigIntegerField(default=0)),
+                ('population', models.BigIntegerField(default=0)),
+                ('adult_males', models.BigIntegerField(default=0)),
+                ('adult_females', models.BigIntegerField(default=0)),
+                ('age_weighted_sum', models.FloatField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StateRollup',
+            fields=[
+                ('state', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='rollup', serialize=False, to='ex1.statemodel')),
+                ('city_count', models.BigIntegerField(default=0)),
+                ('population', models.BigIntegerField(default=0)),
+                ('adult_males', models.BigIntegerField(default=0)),
+                ('adult_females', models.BigIntegerField(default=0)),
+                ('age_weighted_sum', models.FloatField(default=0)),
+            ],
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
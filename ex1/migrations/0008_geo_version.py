@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 11:03
+
+from django.db import migrations, models
+
+
+def create_version_row(apps, schema_editor):
+    apps.get_model('ex1', 'GeoVersion').objects.get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ex1', '0007_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeoVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_version_row, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,87 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:20
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+# cities are filled in pk ranges of this size, each range one short UPDATE - the table isn't held
+# by one statement writing millions of rows (the migration isn't atomic, see below)
+BACKFILL_BATCH_SIZE = 5000
+
+
+def backfill_paths(apps, schema_editor):
+    CountryModel = apps.get_model('ex1', 'CountryModel')
+    StateModel = apps.get_model('ex1', 'StateModel')
+    CityModel = apps.get_model('ex1', 'CityModel')
+
+    for country_id, country_code in CountryModel.objects.values_list('pk', 'country_code'):
+        StateModel.objects.filter(country_id=country_id).update(country_code=country_code)
+
+    states = StateModel.objects.filter(pk=OuterRef('state_id'))
+    last = None
+    while True:
+        pks = CityModel.objects.order_by('pk')
+        if last is not None:
+            pks = pks.filter(pk__gt=last)
+        pks = list(pks.values_list('pk', flat=True)[:BACKFILL_BATCH_SIZE])
+        if not pks:
+            break
+        CityModel.objects.filter(pk__gte=pks[0], pk__lte=pks[-1]).update(
+            state_code=Subquery(states.values('state_code')[:1]),
+            country_code=Subquery(states.values('country_code')[:1]),
+        )
+        last = pks[-1]
+
+
+class Migration(migrations.Migration):
+    # the backfill commits batch by batch
+    atomic = False
+
+    dependencies = [
+        ('ex1', '0008_geo_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='statemodel',
+            name='country_code',
+            field=models.CharField(default='', editable=False, max_length=10),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='citymodel',
+            name='state_code',
+            field=models.CharField(default='', editable=False, max_length=10),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='citymodel',
+            name='country_code',
+            field=models.CharField(default='', editable=False, max_length=10),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_paths, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='citymodel',
+            name='city_state_name_id_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='statemodel',
+            name='state_country_name_id_idx',
+        ),
+        migrations.AddIndex(
+            model_name='statemodel',
+            index=models.Index(fields=['country_code', 'name', 'id'], name='state_path_name_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='statemodel',
+            index=models.Index(fields=['country_code', 'state_code'], name='state_path_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='citymodel',
+            index=models.Index(fields=['country_code', 'state_code', 'name', 'id'], name='city_path_name_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='citymodel',
+            index=models.Index(fields=['country_code', 'state_code', 'city_code'], name='city_path_idx'),
+        ),
+    ]
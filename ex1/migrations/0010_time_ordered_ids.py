@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-17 11:22
+
+import ex1.ids
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ex1', '0009_hierarchy_path'),
+    ]
+
+    # only the python side default changes, the columns stay as they are (on sqlite an AlterField
+    # would copy every table)
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='citymodel',
+                    name='id',
+                    field=models.UUIDField(default=ex1.ids.new_id, editable=False, primary_key=True, serialize=False),
+                ),
+                migrations.AlterField(
+                    model_name='countrymodel',
+                    name='id',
+                    field=models.UUIDField(default=ex1.ids.new_id, editable=False, primary_key=True, serialize=False),
+                ),
+                migrations.AlterField(
+                    model_name='customuser',
+                    name='id',
+                    field=models.UUIDField(default=ex1.ids.new_id, editable=False, primary_key=True, serialize=False),
+                ),
+                migrations.AlterField(
+                    model_name='statemodel',
+                    name='id',
+                    field=models.UUIDField(default=ex1.ids.new_id, editable=False, primary_key=True, serialize=False),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ex1', '0010_time_ordered_ids'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CityChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(db_index=True)),
+                ('city_id', models.UUIDField()),
+                ('deleted', models.BooleanField(default=False)),
+                ('name', models.CharField(max_length=100, null=True)),
+                ('city_code', models.CharField(max_length=10, null=True)),
+                ('population', models.BigIntegerField(null=True)),
+                ('state_id', models.UUIDField(null=True)),
+            ],
+        ),
+    ]
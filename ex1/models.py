@@ -13,7 +13,8 @@
 from django.db import models
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, BaseUserManager
 from django.conf import settings
-import uuid
+
+from .ids import new_id
 
 class CustomUserManager(BaseUserManager):
     def create_user(self, email, password=None, **extra_fields):
@@ -26,7 +27,7 @@ class CustomUserManager(BaseUserManager):
         return user
 
 class CustomUser(AbstractBaseUser, PermissionsMixin):
-    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    id = models.UUIDField(primary_key=True, default=new_id, editable=False)
     email = models.EmailField(unique=True)
 
     USERNAME_FIELD = 'email'
@@ -54,13 +55,53 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
 
 
 
-class CountryModel(models.Model):
-    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+# remembers the column values an instance was loaded with (by attname, e.g. state_id), the
+# rollups compare them with the values being saved to know what changed (see rollups.py)
+class LoadedValuesMixin:
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def loaded_values(self, columns):
+        # for an instance saved without having been loaded (built with a pk, or loaded with only()),
+        # the columns it doesn't know yet from its current row
+        loaded = getattr(self, '_loaded_values', {})
+        missing = [column for column in columns if column not in loaded]
+        if not self._state.adding and missing:
+            row = type(self)._default_manager.filter(pk=self.pk).values(*missing).first()
+            if row is not None:
+                self._loaded_values = loaded = {**loaded, **row}
+        return loaded
+
+    def _saved(self, *attnames):
+        # the row holds these values now
+        self._loaded_values = {**getattr(self, '_loaded_values', {}), **{name: getattr(self, name) for name in attnames}}
+
+
+# Hierarchy path: states keep their country's code, cities their state's and country's codes, so
+# the nested urls (/countries/<cc>/states/<sc>/cities/<code>/) filter one table on one index
+# instead of joining up to the country. save() copies the codes from the parent when it is set or
+# changed, and pushes a changed code (or a state moving country) down to the children with one
+# UPDATE. The bulk paths don't go through save(): they call copy_path() / cascade_paths() themselves.
+
+def _with_update_fields(kwargs, *names):
+    # save(update_fields=[...]) has to write the path columns it changed too
+    if kwargs.get('update_fields') is not None:
+        kwargs['update_fields'] = set(kwargs['update_fields']) | set(names)
+
+
+class CountryModel(LoadedValuesMixin, models.Model):
+    id = models.UUIDField(primary_key=True, default=new_id, editable=False)
     name = models.CharField(max_length=100)
     country_code = models.CharField(max_length=10, unique=True)
     curr_symbol = models.CharField(max_length=1)
     phone_code = models.CharField(max_length=10, unique=True)
     my_user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, related_name='countries', null=True, on_delete=models.SET_NULL)
+    # auto_now is set by save() and bulk_create(), bulk_update()/update() need it passed explicitly
+    # the geography ETags are built from it (see etags.py)
+    updated_at = models.DateTimeField(auto_now=True)
     
     """
     Observation:
@@ -76,24 +117,73 @@ class CountryModel(models.Model):
     null=False, on_delete=models.SET_NULL -> System check error (abruptly stop process)
     """
 
+    class Meta:
+        # keyset pagination order (GeoCursorPagination)
+        indexes = [models.Index(fields=['name', 'id'], name='country_name_id_idx')]
+
+    def save(self, *args, **kwargs):
+        old_code = self.loaded_values(('country_code',)).get('country_code')
+        super().save(*args, **kwargs)
+        if old_code is not None and old_code != self.country_code:
+            StateModel.objects.filter(country_id=self.pk).update(country_code=self.country_code)
+            CityModel.objects.filter(country_code=old_code).update(country_code=self.country_code)
+        self._saved('country_code')
+
     def __str__(self):
         return self.name
 
-class StateModel(models.Model):
-    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+class StateModel(LoadedValuesMixin, models.Model):
+    id = models.UUIDField(primary_key=True, default=new_id, editable=False)
     name = models.CharField(max_length=100)
     gst_code = models.CharField(max_length=20, blank=True, null=True, unique=True)
     state_code = models.CharField(max_length=10, unique=True)
     country = models.ForeignKey(CountryModel, on_delete=models.CASCADE, related_name='states')
+    # path, copied from the country (see above)
+    country_code = models.CharField(max_length=10, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
     
     class Meta: 
         unique_together = ['name', 'country']
+        indexes = [
+            # keyset pagination of /countries/<cc>/states/, and the state lookups
+            models.Index(fields=['country_code', 'name', 'id'], name='state_path_name_id_idx'),
+            models.Index(fields=['country_code', 'state_code'], name='state_path_idx'),
+        ]
+
+    @staticmethod
+    def path_from(country):
+        return {'country_code': country.country_code}
+
+    def copy_path(self, country=None):
+        for name, value in self.path_from(country or self.country).items():
+            setattr(self, name, value)
+
+    @staticmethod
+    def cascade_paths(states):
+        # the cities of these states take their (new) state and country codes, in one UPDATE that
+        # reads them from the (already saved) state rows
+        parent = StateModel.objects.filter(pk=models.OuterRef('state_id'))
+        CityModel.objects.filter(state_id__in=[state.pk for state in states]).update(
+            state_code=models.Subquery(parent.values('state_code')[:1]),
+            country_code=models.Subquery(parent.values('country_code')[:1]),
+        )
+
+    def save(self, *args, **kwargs):
+        loaded = self.loaded_values(('country_id', 'state_code', 'country_code'))
+        if loaded.get('country_id') != self.country_id or not self.country_code:
+            self.copy_path()
+            _with_update_fields(kwargs, 'country_code')
+        moved = bool(loaded) and (loaded.get('state_code'), loaded.get('country_code')) != (self.state_code, self.country_code)
+        super().save(*args, **kwargs)
+        if moved:
+            self.cascade_paths([self])
+        self._saved('state_code', 'country_code')
 
     def __str__(self):
         return self.name
 
-class CityModel(models.Model):
-    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+class CityModel(LoadedValuesMixin, models.Model):
+    id = models.UUIDField(primary_key=True, default=new_id, editable=False)
     name = models.CharField(max_length=100)
     city_code = models.CharField(max_length=10, unique=True)
     phone_code = models.CharField(max_length=10, unique=True)
@@ -102,9 +192,33 @@ class CityModel(models.Model):
     num_of_adults_males = models.PositiveBigIntegerField()
     num_of_adults_females = models.PositiveBigIntegerField()
     state = models.ForeignKey(StateModel, on_delete=models.CASCADE, related_name='cities')
+    # path, copied from the state (see above)
+    state_code = models.CharField(max_length=10, editable=False)
+    country_code = models.CharField(max_length=10, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
         unique_together = ['name', 'state']
+        indexes = [
+            # keyset pagination of /countries/<cc>/states/<sc>/cities/, and the city lookups
+            models.Index(fields=['country_code', 'state_code', 'name', 'id'], name='city_path_name_id_idx'),
+            models.Index(fields=['country_code', 'state_code', 'city_code'], name='city_path_idx'),
+        ]
+
+    @staticmethod
+    def path_from(state):
+        return {'state_code': state.state_code, 'country_code': state.country_code}
+
+    def copy_path(self, state=None):
+        for name, value in self.path_from(state or self.state).items():
+            setattr(self, name, value)
+
+    def save(self, *args, **kwargs):
+        if self.loaded_values(('state_id',)).get('state_id') != self.state_id or not self.state_code:
+            self.copy_path()
+            _with_update_fields(kwargs, 'state_code', 'country_code')
+        super().save(*args, **kwargs)
+        self._saved('state_id')
         
     def clean(self):
         from django.core.exceptions import ValidationError
@@ -113,3 +227,56 @@ class CityModel(models.Model):
         
     def __str__(self):
         return self.name
+
+
+# Running totals of the cities of each state / country, kept up to date on every city write
+# (rollups.py) so the stats endpoints read one row instead of adding up the cities.
+# No row yet means no cities. age_weighted_sum is sum(avg_age * population), the average age
+# is age_weighted_sum / population.
+class StateRollup(models.Model):
+    state = models.OneToOneField(StateModel, primary_key=True, on_delete=models.CASCADE, related_name='rollup')
+    city_count = models.BigIntegerField(default=0)
+    population = models.BigIntegerField(default=0)
+    adult_males = models.BigIntegerField(default=0)
+    adult_females = models.BigIntegerField(default=0)
+    age_weighted_sum = models.FloatField(default=0)
+
+    def __str__(self):
+        return f'rollup of {self.state_id}'
+
+class CountryRollup(models.Model):
+    country = models.OneToOneField(CountryModel, primary_key=True, on_delete=models.CASCADE, related_name='rollup')
+    city_count = models.BigIntegerField(default=0)
+    population = models.BigIntegerField(default=0)
+    adult_males = models.BigIntegerField(default=0)
+    adult_females = models.BigIntegerField(default=0)
+    age_weighted_sum = models.FloatField(default=0)
+
+    def __str__(self):
+        return f'rollup of {self.country_id}'
+
+
+# One row (pk=1) counting the geography writes, bumped with every write (response_cache.bump_countries
+# / bump_all, and the city change log below). Each worker's snapshot (snapshot.py) compares it
+# with the version it was built at.
+class GeoVersion(models.Model):
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f'geography version {self.value}'
+
+
+# The city writes, for the search index of the other workers (search.py): one row per city written,
+# at the GeoVersion its transaction bumped to. A worker whose index is at version n applies the
+# rows above n instead of rebuilding. deleted rows have no values. Old versions are pruned.
+class CityChange(models.Model):
+    version = models.BigIntegerField(db_index=True)
+    city_id = models.UUIDField()
+    deleted = models.BooleanField(default=False)
+    name = models.CharField(max_length=100, null=True)
+    city_code = models.CharField(max_length=10, null=True)
+    population = models.BigIntegerField(null=True)
+    state_id = models.UUIDField(null=True)
+
+    def __str__(self):
+        return f'city {self.city_id} at version {self.version}'
@@ -0,0 +1,96 @@
+# Query planning for serializers
+# A serializer that reads obj.country.name on every row fires one extra query per row (the N+1 problem)
+# Instead of hand writing select_related/prefetch_related in every view, we read the serializer's
+# declared fields once and work out which joins it needs:
+# - dotted `source=` paths (source='country.country_code') are followed through the model relations
+# - nested serializers (states = NestedStateSerializer(many=True)) are walked recursively
+# - SerializerMethodFields are opaque, so the serializer lists what they read in Meta.method_field_sources
+#       method_field_sources = {'my_country__name': 'country.name'}
+# Forward FK / OneToOne chains become select_related (one JOIN), anything that crosses a reverse FK
+# or M2M becomes prefetch_related (one extra query per level, not per row)
+
+# https://docs.djangoproject.com/en/4.2/ref/models/querysets/#select-related
+# https://docs.djangoproject.com/en/4.2/ref/models/querysets/#prefetch-related
+
+from functools import lru_cache
+
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework import serializers
+
+
+def _relation_path(model, attrs):
+    # follow attrs through the model relations, stop at the first non relation (a column, property...)
+    # returns the relation names walked, whether any step was to-many, and the model we ended on
+    path = []
+    to_many = False
+    for attr in attrs:
+        try:
+            field = model._meta.get_field(attr)
+        except FieldDoesNotExist:
+            break
+        if not field.is_relation:
+            break
+        path.append(attr)
+        to_many = to_many or field.one_to_many or field.many_to_many
+        model = field.related_model
+    return path, to_many, model
+
+
+def _source_attrs(field):
+    if isinstance(field, serializers.SerializerMethodField):
+        sources = getattr(field.parent.Meta, 'method_field_sources', {})
+        source = sources.get(field.field_name)
+        return [source.split('.')] if source else []
+    if field.source == '*':
+        return [[]]
+    attrs = list(field.source_attrs)
+    # PrimaryKeyRelatedField reads obj.country_id, no join needed for the last hop
+    if isinstance(field, serializers.RelatedField) and field.use_pk_only_optimization():
+        attrs = attrs[:-1]
+    return [attrs]
+
+
+def _collect(serializer, model, prefix, to_many, select, prefetch):
+    for field in serializer.fields.values():
+        if field.write_only:
+            continue
+
+        nested = field.child if isinstance(field, serializers.ListSerializer) else field
+        if isinstance(field, serializers.ManyRelatedField):
+            nested = field.child_relation
+
+        for attrs in _source_attrs(field):
+            path, many, related_model = _relation_path(model, attrs)
+            full_path = prefix + path
+            full_many = to_many or many or isinstance(field, (serializers.ListSerializer, serializers.ManyRelatedField))
+            if path:
+                lookup = '__'.join(full_path)
+                (prefetch if full_many else select).add(lookup)
+            if isinstance(nested, serializers.BaseSerializer) and len(path) == len(attrs):
+                _collect(nested, related_model, full_path, full_many, select, prefetch)
+
+
+@lru_cache(maxsize=None)
+def plan_for(serializer_class):
+    # (select_related lookups, prefetch_related lookups) for a serializer class, computed once
+    serializer = serializer_class()
+    select, prefetch = set(), set()
+    _collect(serializer, serializer.Meta.model, [], False, select, prefetch)
+    return tuple(sorted(select)), tuple(sorted(prefetch))
+
+
+def apply_query_plan(queryset, serializer_class):
+    select, prefetch = plan_for(serializer_class)
+    if select:
+        queryset = queryset.select_related(*select)
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch)
+    return queryset
+
+
+# Mixin for generic views - filter_queryset runs for both list() and get_object(),
+# so the joins are added to every read without touching the view's get_queryset
+class QueryPlanMixin:
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        return apply_query_plan(queryset, self.get_serializer_class())
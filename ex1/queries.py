@@ -1,4 +1,14 @@
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+
 from .models import CountryModel, StateModel, CityModel
+from .response_cache import bump_all, bump_countries
+from .etags import touch
+from .rollups import record_rows, rollup_batch
+
+# rows per INSERT/UPDATE statement for the bulk write paths
+BULK_BATCH_SIZE = getattr(settings, 'BULK_BATCH_SIZE', 500)
 
 # input -> http request
 # output -> json (serialized data)
@@ -12,6 +22,7 @@ def insert_country(request):
         curr_symbol=country['curr_symbol'],
         phone_code=country['phone_code']
     )
+    bump_countries(country['country_code'])
     return True
     
 def insert_state(request):
@@ -22,6 +33,7 @@ def insert_state(request):
         state_code=state['state_code'],
         country=CountryModel.objects.get(country_code=state['country_code'])
     )
+    bump_countries(state['country_code'])
     
     return True
     
@@ -31,6 +43,7 @@ def insert_city(request):
         name=city['name'],
         state=StateModel.objects.get(state_code=city['state_code'])
     )
+    bump_all()
     
     return True
     
@@ -47,6 +60,7 @@ def bulk_insert_countries(request):
     ]
     
     CountryModel.objects.bulk_create(country_objects)
+    bump_countries(*[country.country_code for country in country_objects])
 
     return True
 
@@ -54,28 +68,246 @@ def bulk_insert_countries(request):
 def bulk_update_countries(request):
     countries = request.data
     country_objects = []
+    # one IN query for all the codes instead of a get() per country
+    existing = CountryModel.objects.in_bulk([country['country_code'] for country in countries], field_name='country_code')
     
     for country in countries:
-        try:
-            country_obj = CountryModel.objects.get(country_code=country['country_code'])
-            country_obj.name = country.get('name', country_obj.name)
-            country_obj.curr_symbol = country.get('curr_symbol', country_obj.curr_symbol)
-            country_obj.phone_code = country.get('phone_code', country_obj.phone_code)
-            country_objects.append(country_obj)
-        except CountryModel.DoesNotExist:
+        country_obj = existing.get(country['country_code'])
+        if country_obj is None:
             continue
+        country_obj.name = country.get('name', country_obj.name)
+        country_obj.curr_symbol = country.get('curr_symbol', country_obj.curr_symbol)
+        country_obj.phone_code = country.get('phone_code', country_obj.phone_code)
+        country_objects.append(country_obj)
     
-    CountryModel.objects.bulk_update(country_objects, ['name', 'curr_symbol', 'phone_code'])
+    CountryModel.objects.bulk_update(country_objects, ['name', 'curr_symbol', 'phone_code'] + touch(country_objects), batch_size=BULK_BATCH_SIZE)
+    bump_countries(*[country.country_code for country in country_objects])
     
     return True
+
+
+def apply_changes(obj, data):
+    # set only the attributes whose value differs, return the names that changed
+    changed = []
+    for attr, value in data.items():
+        if getattr(obj, attr) != value:
+            setattr(obj, attr, value)
+            changed.append(attr)
+    return changed
+
+
+# Upsert countries, states and cities keyed on their natural codes
+# Every existing key of the request is resolved with one IN query (plus one for the parents),
+# new rows go through bulk_create and changed rows through bulk_update, in one transaction
+# (with their rollup deltas, see rollups.py).
+# We look the rows up instead of using INSERT ... ON CONFLICT so each input row can report
+# whether it was created, updated or left unchanged - rows that fail get an error instead
+# and the rest of the batch still goes through. That includes the other unique columns
+# (phone_code, gst_code, name within the parent): checked up front with one IN query each, and a
+# clash that only shows at write time sends the batch through row by row, one savepoint per row.
+
+UPSERT_FIELDS = {
+    CountryModel: ['name', 'curr_symbol', 'phone_code'],
+    StateModel: ['name', 'gst_code'],
+    CityModel: ['name', 'phone_code', 'population', 'avg_age', 'num_of_adults_males', 'num_of_adults_females'],
+}
+
+
+def _clean_value(model, name, value):
+    # with the model field: coerced (e.g. "120" -> 120 for population) and validated (max_length,
+    # positive numbers...) - a list or an object is never a value, it would be stored as its repr
+    if isinstance(value, (list, dict)):
+        raise ValidationError({name: ['Expected a single value, not a list or an object.']})
+    try:
+        return model._meta.get_field(name).clean(value, None)
+    except ValidationError as exc:
+        raise ValidationError({name: exc.messages})
+
+
+def _clean_values(model, row, fields):
+    return {name: _clean_value(model, name, row[name]) for name in fields if name in row}
+
+
+def _error(result, exc):
+    result.update(status='error', errors=exc.message_dict if hasattr(exc, 'error_dict') else {'non_field_errors': exc.messages})
+
+
+def unique_sets(model, key):
+    # the unique columns besides the key, as tuples of fields: ('phone_code',), ('name', 'state')
+    sets = [(field,) for field in model._meta.local_fields if field.unique and not field.primary_key and field.name != key]
+    for names in model._meta.unique_together:
+        sets.append(tuple(model._meta.get_field(name) for name in names))
+    return sets
+
+
+def _check_unique(model, key, candidates):
+    # the rows about to be written against the other unique columns, one IN query per column:
+    # a value held by another stored row, or already taken by an earlier row of the request,
+    # fails that row only. Returns the rows that pass.
+    for fields in unique_sets(model, key):
+        attnames = [field.attname for field in fields]
+        values = {}
+        for obj, result in candidates:
+            value = tuple(getattr(obj, attname) for attname in attnames)
+            if None not in value:
+                values.setdefault(value, []).append((obj, result))
+        if not values:
+            continue
+        owners = dict(
+            (tuple(row[:-1]), row[-1]) for row in model.objects.filter(
+                **{attnames[0] + '__in': {value[0] for value in values}}
+            ).values_list(*attnames, key)
+        )
+        failed = set()
+        for value, objs in values.items():
+            owner = owners.get(value)
+            for index, (obj, result) in enumerate(objs):
+                if owner is not None and owner != getattr(obj, key):
+                    exc = obj.unique_error_message(model, [field.name for field in fields])
+                elif index and getattr(obj, key) != getattr(objs[0][0], key):
+                    exc = ValidationError('Repeated in this request.')
+                else:
+                    continue
+                name = fields[0].name if len(fields) == 1 else 'non_field_errors'
+                result.update(status='error', errors={name: exc.messages})
+                failed.add(id(obj))
+        candidates = [(obj, result) for obj, result in candidates if id(obj) not in failed]
+    return candidates
+
+
+def _write(model, to_create, to_update, update_fields, moved):
+    model.objects.bulk_create(to_create, batch_size=BULK_BATCH_SIZE)
+    if to_update:
+        model.objects.bulk_update(to_update, sorted(update_fields) + touch(to_update), batch_size=BULK_BATCH_SIZE)
+    if moved:
+        StateModel.cascade_paths(moved)
+    record_rows(model, to_create + to_update)
+
+
+def _upsert(model, key, rows, parent=None):
+    # parent = (fk column, parent model, parent key) for states and cities, the fk is compared
+    # and written as country_id/state_id so existing rows never load their parent
+    fields = UPSERT_FIELDS[model]
+    if parent:
+        fk_name, parent_model, parent_key = parent
+    results, valid = [], []
+    for row in rows:
+        result = {key: row.get(key) if isinstance(row, dict) else None}
+        results.append(result)
+        try:
+            if not isinstance(row, dict):
+                raise ValidationError('Expected an object.')
+            if row.get(key) in (None, ''):
+                raise ValidationError({key: ['This field is required.']})
+            code = _clean_value(model, key, row[key])
+            parent_code = None
+            if parent and row.get(parent_key) not in (None, ''):
+                parent_code = _clean_value(parent_model, parent_key, row[parent_key])
+        except ValidationError as exc:
+            _error(result, exc)
+            continue
+        valid.append((row, result, code, parent_code))
+
+    existing = model.objects.in_bulk([code for _, _, code, _ in valid], field_name=key)
+    parents = {}
+    if parent:
+        parents = parent_model.objects.in_bulk(
+            [parent_code for _, _, _, parent_code in valid if parent_code is not None], field_name=parent_key
+        )
+
+    candidates, changes, seen = [], {}, set()
+    for row, result, code, parent_code in valid:
+        if code in seen:
+            result.update(status='error', errors={key: ['Repeated in this request.']})
+            continue
+        seen.add(code)
+
+        try:
+            values = _clean_values(model, row, fields)
+            if parent_code is not None:
+                if parent_code not in parents:
+                    raise ValidationError({parent_key: ['Does not exist.']})
+                values[fk_name] = parents[parent_code].pk
+                # and the hierarchy path that comes with the parent (see models.py)
+                values.update(model.path_from(parents[parent_code]))
+
+            obj = existing.get(code)
+            if obj is None:
+                missing = [name for name in fields if name not in values and not model._meta.get_field(name).null]
+                if parent and fk_name not in values:
+                    missing.append(parent_key)
+                if missing:
+                    raise ValidationError({name: ['This field is required.'] for name in missing})
+                obj = model(**{key: code}, **values)
+                obj.clean()
+                result['status'] = 'created'
+            else:
+                changes[obj.pk] = apply_changes(obj, values)
+                obj.clean()
+                result['status'] = 'updated' if changes[obj.pk] else 'unchanged'
+            candidates.append((obj, result))
+        except ValidationError as exc:
+            _error(result, exc)
+
+    writes = _check_unique(model, key, [(obj, result) for obj, result in candidates if result['status'] != 'unchanged'])
+
+    def split(writes):
+        to_create = [obj for obj, result in writes if result['status'] == 'created']
+        to_update = [obj for obj, result in writes if result['status'] == 'updated']
+        update_fields = {name for obj in to_update for name in changes[obj.pk]}
+        moved = [obj for obj in to_update if model is StateModel and 'country_code' in changes[obj.pk]]
+        return to_create, to_update, update_fields, moved
+
+    with rollup_batch():
+        try:
+            with transaction.atomic():
+                _write(model, *split(writes))
+        except IntegrityError:
+            # a clash the checks couldn't see: a row written meanwhile, or values swapped between
+            # rows of the request - row by row then, each in its savepoint
+            for obj, result in writes:
+                if result['status'] == 'created':
+                    # bulk_create gave it the pk of the rolled back insert
+                    obj.pk, obj._state.adding = None, True
+                try:
+                    with transaction.atomic():
+                        _write(model, *split([(obj, result)]))
+                except IntegrityError:
+                    result.update(status='error', errors={'non_field_errors': ['Conflicts with another row.']})
+        if any(result['status'] in ('created', 'updated') for _, result in writes):
+            bump_all()
+    return results
+
+
+# natural key of each model, and how its parent is given: (fk column, parent model, parent key)
+UPSERT_KEYS = {
+    CountryModel: ('country_code', None),
+    StateModel: ('state_code', ('country_id', CountryModel, 'country_code')),
+    CityModel: ('city_code', ('state_id', StateModel, 'state_code')),
+}
+
+
+def upsert_rows(model, rows):
+    key, parent = UPSERT_KEYS[model]
+    return _upsert(model, key, rows, parent=parent)
+
+
+def upsert_countries(request):
+    return upsert_rows(CountryModel, request.data)
+
+def upsert_states(request):
+    return upsert_rows(StateModel, request.data)
+
+def upsert_cities(request):
+    return upsert_rows(CityModel, request.data)
     
 def get_all_countries():
     return CountryModel.objects.all()
 
 
 def get_states_by_country(country_code):
-    return StateModel.objects.filter(country__country_code=country_code)
+    return StateModel.objects.filter(country_code=country_code)
 
 def get_cities_by_state(country_code, state_code):
-    return CityModel.objects.filter(state__state_code=state_code, state__country__country_code=country_code)
+    return CityModel.objects.filter(country_code=country_code, state_code=state_code)
 
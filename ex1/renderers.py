@@ -0,0 +1,111 @@
+# JSON renderer and parser with a faster encoder behind them
+# DRF's JSONRenderer/JSONParser go through the stdlib json module: every UUID, float and datetime
+# of every row passes through a Python level default() call, and the output is built as a str
+# and then encoded to bytes.
+# With orjson installed (pip install orjson) the encoding is done in native code straight into
+# bytes, UUID/datetime are handled natively. Anything orjson doesn't know (Decimal, lazy strings,
+# querysets...) goes to DRF's own encoder, so the output is the same as DRF's - compact, UTF-8,
+# datetimes ending in Z. Floats too: orjson writes the same shortest digits as python's repr() but
+# formats the small and large ones its own way (1e16, 0.00001 where DRF has 1e+16, 1e-05), those
+# few numbers are written again with repr() (_python_floats). The one difference left: NaN and
+# Infinity come out as null, where DRF refuses to render them.
+# Without orjson both classes behave exactly like DRF's.
+# API_JSON_BACKEND picks the encoder: 'auto' (orjson when installed), 'orjson' or 'stdlib'.
+
+# https://github.com/ijl/orjson
+# https://www.django-rest-framework.org/api-guide/renderers/#custom-renderers
+
+import io
+import re
+
+from django.conf import settings
+from rest_framework import parsers, renderers
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_BACKEND = getattr(settings, 'API_JSON_BACKEND', 'auto')
+if JSON_BACKEND == 'orjson' and orjson is None:
+    raise ImportError("API_JSON_BACKEND = 'orjson' but orjson is not installed")
+# orjson output is always compact and UTF-8, like DRF's defaults - keep the stdlib if those were changed
+USE_ORJSON = (orjson is not None and JSON_BACKEND in ('auto', 'orjson')
+              and api_settings.COMPACT_JSON and api_settings.UNICODE_JSON)
+
+_default = JSONEncoder().default
+# orjson reads an integer outside of i64/u64 as a float, a body with a number that long (19 digits
+# and more, checked against the range) goes to the stdlib
+_LONG_NUMBER = re.compile(rb'-?\d{19,}')
+_INT_RANGE = range(-2 ** 63, 2 ** 64)
+# the floats orjson doesn't format like repr(): exponent form, or a small one written out
+_ORJSON_FLOAT = rb'(?<![\d.])(?:-?\d+(?:\.\d+)?e-?\d+|-?0\.0000\d*)'
+_MAYBE_ORJSON_FLOAT = re.compile(_ORJSON_FLOAT)
+# strings are matched whole so a number inside one is left alone
+_STRING_OR_ORJSON_FLOAT = re.compile(rb'"(?:[^"\\]|\\.)*"|(' + _ORJSON_FLOAT + rb')')
+
+
+def _python_float(match):
+    if match.group(1) is None:
+        return match.group(0)
+    return repr(float(match.group(1))).encode()
+
+
+def _python_floats(content):
+    # rare: only when something in the body looks like one of those floats
+    if _MAYBE_ORJSON_FLOAT.search(content) is None:
+        return content
+    return _STRING_OR_ORJSON_FLOAT.sub(_python_float, content)
+
+
+def _fits_orjson(content):
+    return all(int(match.group()) in _INT_RANGE for match in _LONG_NUMBER.finditer(content))
+
+
+def orjson_dumps(data):
+    try:
+        content = orjson.dumps(data, default=_default, option=orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS)
+    except orjson.JSONEncodeError:
+        # e.g. an int over 64 bits, let the stdlib have it
+        return renderers.JSONRenderer().render(data)
+    # DRF escapes these two so the JSON is valid javascript too
+    if b'\xe2\x80\xa8' in content or b'\xe2\x80\xa9' in content:
+        content = content.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+    return _python_floats(content)
+
+
+def dumps(data):
+    # compact JSON as bytes, same output as DRF's JSONRenderer
+    if USE_ORJSON:
+        return orjson_dumps(data)
+    return renderers.JSONRenderer().render(data)
+
+
+class FastJSONRenderer(renderers.JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        # ?indent / Accept: application/json; indent=4 - rare, the stdlib does the pretty printing
+        if not USE_ORJSON or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        return dumps(data)
+
+
+class FastJSONParser(parsers.JSONParser):
+    renderer_class = FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        if not USE_ORJSON or encoding.lower().replace('-', '') != 'utf8':
+            return super().parse(stream, media_type, parser_context)
+        content = stream.read() if stream is not None else b''
+        if not _fits_orjson(content):
+            return super().parse(io.BytesIO(content), media_type, parser_context)
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # the stdlib parser gives the error message DRF clients are used to
+            return super().parse(io.BytesIO(content), media_type, parser_context)
@@ -0,0 +1,145 @@
+# Read replicas
+# The GETs of the geography and user views (ReplicaReadMixin) read from one of the aliases of
+# DB_REPLICAS['DATABASES'], picked once per request so all its queries see the same copy. Anything
+# else, and every write, uses the primary ('default').
+# Read your writes: a request that wrote reads from the primary from then on, and the user who made
+# it stays on the primary for STICKY_SECONDS (longer than the replicas lag behind) - kept in the
+# django cache ALIAS, which must be shared by the workers: the next request of the user may go to
+# any of them, a pin in process memory would only hold on one. Replicas without an ALIAS don't start.
+# Only the ex1 models are routed, the other apps (sessions, tokens, silk...) stay on the primary.
+# The process wide copies (snapshot.py, search.py) are built from the primary, and a response
+# built from a replica isn't put in the response cache (response_cache.py): they are also served
+# to the users pinned to the primary. Only the write counter they check is read from the replica.
+# Locally a second sqlite file stands in for the replica, `manage.py sync_replicas` copies the db to it.
+
+import random
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .cache import build_cache
+
+_options = getattr(settings, 'DB_REPLICAS', {})
+REPLICA_DATABASES = list(_options.get('DATABASES', []))
+STICKY_SECONDS = _options.get('STICKY_SECONDS', 5)
+ROUTED_APPS = ('ex1',)
+
+
+
+def pin_cache(options):
+    if options.get('DATABASES') and not options.get('ALIAS'):
+        raise ImproperlyConfigured(
+            "DB_REPLICAS needs an 'ALIAS': a django cache shared by the workers, to keep the users "
+            "who wrote on the primary in all of them."
+        )
+    return build_cache({**options, 'TTL': STICKY_SECONDS}, prefix='ex1:pin:')
+
+
+_pins = pin_cache(_options)
+
+
+class RequestRouting:
+    __slots__ = ('replica', 'wrote')
+
+    def __init__(self):
+        self.replica = None       # the alias the reads go to, None for the primary
+        self.wrote = False
+
+
+_routing = ContextVar('ex1_request_routing', default=None)
+
+
+def reading_from_replica():
+    routing = _routing.get()
+    return routing is not None and routing.replica is not None and not routing.wrote
+
+
+def pin(user):
+    _pins.set(str(user.pk), True)
+
+
+def is_pinned(user):
+    return _pins.get(str(user.pk)) is not None
+
+
+async def ais_pinned(user):
+    return await _pins.aget(str(user.pk)) is not None
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label in ROUTED_APPS and reading_from_replica():
+            return _routing.get().replica
+        return None
+
+    def db_for_write(self, model, **hints):
+        routing = _routing.get()
+        if routing is not None and model._meta.app_label in ROUTED_APPS:
+            routing.wrote = True
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get their schema from the primary
+        return False if db in REPLICA_DATABASES else None
+
+
+# after AuthenticationMiddleware: the routing state of the request, and the pin of a user who wrote
+class ReplicaRoutingMiddleware:
+    # sync and async: the async reads (async_reads.py) mustn't be sent to a thread by a sync middleware
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        routing = RequestRouting()
+        token = _routing.set(routing)
+        try:
+            return self.get_response(request)
+        finally:
+            _routing.reset(token)
+            self.pin_writer(request, routing)
+
+    async def __acall__(self, request):
+        routing = RequestRouting()
+        token = _routing.set(routing)
+        try:
+            return await self.get_response(request)
+        finally:
+            _routing.reset(token)
+            if routing.wrote and REPLICA_DATABASES:
+                await sync_to_async(self.pin_writer)(request, routing)
+
+    def pin_writer(self, request, routing):
+        # DRF puts the user it authenticated on the django request too
+        user = getattr(request, 'user', None)
+        if routing.wrote and REPLICA_DATABASES and user is not None and user.is_authenticated:
+            pin(user)
+
+
+# Mixin for the read views, the GETs of users not pinned to the primary go to a replica
+class ReplicaReadMixin:
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if self._may_use_replica(request) and not (request.user.is_authenticated and is_pinned(request.user)):
+            _routing.get().replica = random.choice(REPLICA_DATABASES)
+
+    # the async views (async_reads.py): the pin is read off the event loop
+    async def ainitial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if self._may_use_replica(request) and not (request.user.is_authenticated and await ais_pinned(request.user)):
+            _routing.get().replica = random.choice(REPLICA_DATABASES)
+
+    def _may_use_replica(self, request):
+        return _routing.get() is not None and REPLICA_DATABASES and request.method in ('GET', 'HEAD')
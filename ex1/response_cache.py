@@ -0,0 +1,161 @@
+# Response cache for the geography endpoints
+# Countries, states and cities hardly ever change but every GET rebuilds the same JSON from the db.
+# CachedResponseMixin keeps the serialized response.data of list/retrieve, keyed by the request url
+# (path + sorted query params) and a version number:
+# - endpoints under /countries/<country_code>/... use that country's version
+# - the lists that span every country use the 'all' version
+# A write never deletes entries, it bumps the versions it affects (the country, and 'all') - the old
+# keys are simply never asked for again and age out of the LRU. bump_all() (the bulk paths) bumps
+# a generation that is part of every key.
+# Versions are bumped on commit, so a reader can't cache what the write is about to replace.
+# Entries carry the ETag of their body, see etags.py.
+
+# With GEO_RESPONSE_CACHE['ALIAS'] the entries and the versions live in a django cache shared
+# by the workers. Otherwise they are in process memory, where the versions only move with this
+# worker's writes - so the keys also carry the GeoVersion counter (snapshot.py), which every
+# geography write moves in the db: a write made by another worker is seen on the next request,
+# for one pk read per hit.
+
+import threading
+from urllib.parse import urlencode
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from rest_framework import status
+from rest_framework.response import Response
+
+from .cache import DjangoCache, build_cache
+from .etags import ETagMixin, etag_matches, not_modified
+from .replicas import reading_from_replica
+from .snapshot import aread_version, bump_version, read_version
+
+_options = getattr(settings, 'GEO_RESPONSE_CACHE', {})
+CACHE_ENABLED = _options.get('ENABLED', True)
+response_cache = build_cache(_options, prefix='ex1:geo:')
+
+_versions = {}
+_versions_lock = threading.Lock()
+
+
+def get_version(name):
+    if isinstance(response_cache, DjangoCache):
+        return response_cache.cache.get('ex1:geo:v:' + name, 0)
+    return _versions.get(name, 0)
+
+
+def _bump(name):
+    if isinstance(response_cache, DjangoCache):
+        key = 'ex1:geo:v:' + name
+        try:
+            response_cache.cache.incr(key)
+        except ValueError:
+            response_cache.cache.set(key, 1, None)
+        return
+    with _versions_lock:
+        _versions[name] = _versions.get(name, 0) + 1
+
+
+def bump_countries(*country_codes):
+    # a write under these countries - their endpoints and the all-country lists go stale
+    # (and every worker's snapshot, see snapshot.py)
+    bump_version()
+    def bump():
+        for code in set(country_codes) - {None}:
+            _bump('country:' + code)
+        _bump('all')
+    transaction.on_commit(bump)
+
+
+def bump_all():
+    # a write we can't pin to countries (bulk paths) - everything goes stale
+    bump_version()
+    transaction.on_commit(lambda: _bump('generation'))
+
+
+def cache_key(request, country_code=None, geo_version=None):
+    scope = 'country:' + country_code if country_code else 'all'
+    query = urlencode(sorted(request.query_params.lists()), doseq=True)
+    version = f"{get_version('generation')}:{scope}:{get_version(scope)}"
+    if geo_version is not None:
+        version = f"{geo_version}:{version}"
+    # the format is part of the key too, the cached ETag belongs to one representation
+    return f"{version}:{request.accepted_renderer.format}:{request.build_absolute_uri(request.path)}?{query}"
+
+
+def _country_codes(data):
+    # country codes found in a write response, e.g. a new country or a renamed country_code
+    items = data if isinstance(data, list) else [data]
+    return [item.get('country_code') for item in items if isinstance(item, dict) and 'country_code' in item]
+
+
+class CachedResponseMixin(ETagMixin):
+    # a cached entry is (etag, data): the tag was taken when the body was built, so the pair stays
+    # consistent even when this worker's copy lags behind the db - a hit costs no query at all
+    def list(self, request, *args, **kwargs):
+        return self._cached_response(super().list, request, False, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._cached_response(super().retrieve, request, True, *args, **kwargs)
+
+    # the same for the async views (async_reads.py), alist/aretrieve down the chain
+    async def alist(self, request, *args, **kwargs):
+        return await self._acached_response(super().alist, request, False, *args, **kwargs)
+
+    async def aretrieve(self, request, *args, **kwargs):
+        return await self._acached_response(super().aretrieve, request, True, *args, **kwargs)
+
+    def _cached_response(self, handler, request, detail, *args, **kwargs):
+        geo_version = read_version() if CACHE_ENABLED and not isinstance(response_cache, DjangoCache) else None
+        key, etag, data = self._cache_entry(request, kwargs, geo_version)
+        if data is None:
+            etag = self.get_etag(request, detail, geo_version)
+        if etag and etag_matches(request, etag):
+            return not_modified(etag)
+        response = Response(data) if data is not None else handler(request, *args, **kwargs)
+        return self._store(key, etag, data, response)
+
+    async def _acached_response(self, handler, request, detail, *args, **kwargs):
+        # a shared cache blocks on every call (the versions, the entry): those run in a thread
+        shared = isinstance(response_cache, DjangoCache)
+        geo_version = None
+        if shared:
+            key, etag, data = await sync_to_async(self._cache_entry)(request, kwargs)
+        else:
+            geo_version = await aread_version() if CACHE_ENABLED else None
+            key, etag, data = self._cache_entry(request, kwargs, geo_version)
+        if data is None:
+            etag = await self.aget_etag(request, detail, geo_version)
+        if etag and etag_matches(request, etag):
+            return not_modified(etag)
+        response = Response(data) if data is not None else await handler(request, *args, **kwargs)
+        if shared:
+            return await sync_to_async(self._store)(key, etag, data, response)
+        return self._store(key, etag, data, response)
+
+    def _cache_entry(self, request, kwargs, geo_version=None):
+        # (key, etag, data) - etag and data None on a miss
+        key = cache_key(request, kwargs.get('country_code'), geo_version) if CACHE_ENABLED else None
+        entry = response_cache.get(key) if key else None
+        return (key,) + (entry if entry is not None else (None, None))
+
+    def _store(self, key, etag, data, response):
+        # 304s are answered from the tag before this, the body is never built for them
+        # a replica may lag behind the versions, what it gave isn't cached (see replicas.py)
+        if data is None and key and response.status_code == status.HTTP_200_OK and not reading_from_replica():
+            # plain copy, ReturnList/ReturnDict would keep the serializer and its instances alive
+            data = list(response.data) if isinstance(response.data, list) else dict(response.data)
+            response_cache.set(key, (etag, data))
+        if etag and response.status_code == status.HTTP_200_OK:
+            response['ETag'] = etag
+        return response
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        # any successful write through this view - the country in the url, plus the country codes
+        # in the response body (a created country, a changed country_code)
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400:
+            codes = [self.kwargs.get('country_code')]
+            if isinstance(response.data, (list, dict)):
+                codes += _country_codes(response.data)
+            bump_countries(*codes)
+        return super().finalize_response(request, response, *args, **kwargs)
@@ -0,0 +1,240 @@
+# Incremental state/country rollups (StateRollup, CountryRollup in models.py)
+# Every city write turns into a delta of its state's totals: its old values come off the state it
+# was loaded with, its new values go on the state it is saved with. The deltas of a batch are
+# added up per state and applied with one UPDATE ... SET population = population + n per state,
+# then the same per country, in the transaction of the write - concurrent writers add up instead
+# of overwriting each other.
+# - single saves/deletes (views, admin, shell) are caught by the signals in signals.py
+# - the bulk paths (bulk_create/bulk_update in serializers.py and queries.py) call record_rows()
+# - queryset deletes send post_delete per row, so they land in the signals too
+# Wrapping a write in `with rollup_batch():` collects its deltas and applies them once at the end,
+# otherwise each record is applied on its own. A state moving to another country takes its totals along.
+# `manage.py rebuild_rollups` recomputes everything from the cities and repairs any drift.
+# The batches also collect the city changes for the search index (search.py): logged in the
+# transaction for the other workers, handed over to this worker's index on commit.
+
+import math
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import partial
+
+from django.db import transaction
+from django.db.models import Count, F, FloatField, Sum
+
+from . import search
+from .models import CityModel, CountryModel, CountryRollup, StateModel, StateRollup
+
+ROLLUP_FIELDS = ('city_count', 'population', 'adult_males', 'adult_females', 'age_weighted_sum')
+CITY_COLUMNS = ('state_id', 'population', 'avg_age', 'num_of_adults_males', 'num_of_adults_females')
+SEARCH_COLUMNS = ('name', 'city_code', 'population', 'state_id')
+
+_local = threading.local()
+
+
+def city_totals(values):
+    # what one city adds to its state, in ROLLUP_FIELDS order
+    population = values['population']
+    return (1, population, values['num_of_adults_males'], values['num_of_adults_females'], values['avg_age'] * population)
+
+
+def _add(totals, values, sign=1):
+    for index, value in enumerate(values):
+        totals[index] += sign * value
+
+
+class RollupBatch:
+    def __init__(self):
+        self.states = defaultdict(lambda: [0] * len(ROLLUP_FIELDS))
+        self.moves = {}              # state id -> (country it had, country it has now)
+        self.state_countries = {}    # country of the deleted states, they can't be looked up anymore
+        self.cities = []             # (pk, search columns or None when deleted) for the search index
+
+    def merge(self, other):
+        for state_id, delta in other.states.items():
+            _add(self.states[state_id], delta)
+        for state_id, (old, new) in other.moves.items():
+            self.moves[state_id] = (self.moves.get(state_id, (old,))[0], new)
+        self.state_countries.update(other.state_countries)
+        self.cities.extend(other.cities)
+
+    def flush(self):
+        if self.cities:
+            search.log_changes(self.cities)
+            transaction.on_commit(partial(search.apply_changes, self.cities))
+        countries = defaultdict(lambda: [0] * len(ROLLUP_FIELDS))
+
+        # moved states take the totals they had so far, their pending deltas follow below
+        if self.moves:
+            moved = StateRollup.objects.filter(state_id__in=self.moves).values_list('state_id', *ROLLUP_FIELDS)
+            for state_id, *totals in moved:
+                old, new = self.moves[state_id]
+                _add(countries[old], totals, -1)
+                _add(countries[new], totals)
+
+        states = {state_id: delta for state_id, delta in self.states.items() if any(delta)}
+        if states:
+            _apply(StateRollup, 'state_id', StateModel, states)
+            state_countries = dict(self.state_countries)
+            state_countries.update(StateModel.objects.filter(
+                pk__in=set(states) - set(state_countries)
+            ).values_list('pk', 'country_id'))
+            for state_id, delta in states.items():
+                if state_countries.get(state_id):
+                    _add(countries[state_countries[state_id]], delta)
+
+        countries = {country_id: delta for country_id, delta in countries.items() if any(delta)}
+        if countries:
+            _apply(CountryRollup, 'country_id', CountryModel, countries)
+
+
+def _apply(model, key, parent_model, deltas):
+    # one atomic increment per row, rows that don't exist yet are created first
+    # (unless their state/country was just deleted)
+    def increment(pk, delta):
+        changes = {name: F(name) + value for name, value in zip(ROLLUP_FIELDS, delta) if value}
+        return model.objects.filter(**{key: pk}).update(**changes)
+
+    missing = [pk for pk, delta in deltas.items() if not increment(pk, delta)]
+    if missing:
+        existing = list(parent_model.objects.filter(pk__in=missing).values_list('pk', flat=True))
+        model.objects.bulk_create([model(**{key: pk}) for pk in existing], ignore_conflicts=True)
+        for pk in existing:
+            increment(pk, deltas[pk])
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+@contextmanager
+def rollup_batch():
+    # a transaction whose rollup deltas are applied once, just before it commits - nested batches
+    # hand their deltas to the outer one, a batch that raises drops them with its savepoint
+    stack = _stack()
+    batch = RollupBatch()
+    stack.append(batch)
+    try:
+        with transaction.atomic():
+            yield batch
+            if len(stack) == 1:
+                batch.flush()
+    finally:
+        stack.pop()
+    if stack:
+        stack[-1].merge(batch)
+
+
+def _record(record, *args):
+    stack = _stack()
+    if stack:
+        record(stack[-1], *args)
+        return
+    with rollup_batch() as batch:
+        record(batch, *args)
+
+
+def _record_city(batch, city, deleted):
+    old = getattr(city, '_loaded_values', None) or {}
+    new = None if deleted else {name: getattr(city, name) for name in CITY_COLUMNS}
+    batch.cities.append((city.pk, None if deleted else {name: getattr(city, name) for name in SEARCH_COLUMNS}))
+    if all(name in old for name in CITY_COLUMNS):
+        old = {name: old[name] for name in CITY_COLUMNS}
+        if old == new:
+            return
+        _add(batch.states[old['state_id']], city_totals(old), -1)
+    if new:
+        _add(batch.states[new['state_id']], city_totals(new))
+        city._loaded_values = {**getattr(city, '_loaded_values', {}), **new}
+
+
+def _record_state(batch, state, deleted):
+    old_country_id = (getattr(state, '_loaded_values', None) or {}).get('country_id', state.country_id)
+    if deleted:
+        batch.state_countries[state.pk] = old_country_id
+        return
+    if old_country_id != state.country_id:
+        batch.moves[state.pk] = (batch.moves.get(state.pk, (old_country_id,))[0], state.country_id)
+    state._loaded_values = {**getattr(state, '_loaded_values', {}), 'country_id': state.country_id}
+
+
+def record_city(city, deleted=False):
+    _record(_record_city, city, deleted)
+
+
+def record_state(state, deleted=False):
+    _record(_record_state, state, deleted)
+
+
+def record_rows(model, objs):
+    # after a bulk_create / bulk_update - new rows have no loaded values, so they only add
+    record = {CityModel: _record_city, StateModel: _record_state}.get(model)
+    if record is None:
+        return
+    def record_all(batch):
+        for obj in objs:
+            record(batch, obj, False)
+    _record(record_all)
+
+
+def load_values(instance, columns):
+    # the row as it is in the db, for an instance saved without having been loaded (no from_db)
+    instance.loaded_values(columns)
+
+
+# Checking / rebuilding (manage.py rebuild_rollups)
+
+def actual_totals(group_by):
+    # {state or country id: totals} added up from the cities, group_by 'state_id' or 'state__country_id'
+    rows = CityModel.objects.order_by().values(group_by).annotate(
+        rollup_city_count=Count('id'),
+        rollup_population=Sum('population'),
+        rollup_adult_males=Sum('num_of_adults_males'),
+        rollup_adult_females=Sum('num_of_adults_females'),
+        rollup_age_weighted_sum=Sum(F('avg_age') * F('population'), output_field=FloatField()),
+    ).values_list(group_by, *['rollup_' + name for name in ROLLUP_FIELDS])
+    return {row[0]: tuple(row[1:]) for row in rows}
+
+
+def _same(stored, actual):
+    # age_weighted_sum is a float that went through many additions, the rest has to match exactly
+    return all(math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-6) for a, b in zip(stored, actual))
+
+
+def check_rollups(model, key, group_by, repair=False):
+    # the ids whose rollup row is wrong or missing, rewritten with the actual totals when repair
+    # is set - the rows are locked first, so writes committing meanwhile add on top of the rebuilt totals
+    with transaction.atomic():
+        stored = model.objects.order_by()
+        if repair:
+            stored = stored.select_for_update()
+        stored = {row[0]: tuple(row[1:]) for row in stored.values_list(key, *ROLLUP_FIELDS)}
+        actual = actual_totals(group_by)
+        zero = (0,) * len(ROLLUP_FIELDS)
+        drifted = {
+            pk: actual.get(pk, zero) for pk in set(stored) | set(actual)
+            if not _same(stored.get(pk, zero), actual.get(pk, zero))
+        }
+        if repair and drifted:
+            rows = [model(**{key: pk}, **dict(zip(ROLLUP_FIELDS, totals))) for pk, totals in drifted.items()]
+            model.objects.bulk_update([row for row in rows if getattr(row, key) in stored], ROLLUP_FIELDS, batch_size=500)
+            model.objects.bulk_create([row for row in rows if getattr(row, key) not in stored], batch_size=500)
+    return drifted
+
+
+# Mixin for the geography write views - the write and its rollup deltas in one transaction, and
+# a cascade delete (a state with its cities) applies its deltas once instead of once per city
+class RollupBatchMixin:
+    def perform_create(self, serializer):
+        with rollup_batch():
+            super().perform_create(serializer)
+
+    def perform_update(self, serializer):
+        with rollup_batch():
+            super().perform_update(serializer)
+
+    def perform_destroy(self, instance):
+        with rollup_batch():
+            super().perform_destroy(instance)
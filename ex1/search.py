@@ -0,0 +1,359 @@
+# City name search: prefix (type-ahead) and fuzzy (typos), ranked by population
+# Each worker keeps a CityIndex in memory, built once from CityModel and then kept up to date
+# incrementally: the city writes already funnel through the rollup batches (rollups.py), which hand
+# their changes over here when the transaction commits.
+# - records are slots in parallel arrays (name, code, state, population), a dead slot has pk None
+# - prefix: names normalized (casefold, no accents, single spaces) in one sorted array, a prefix is
+#   a bisect range. Small ranges are ranked on the spot, big ones (a one letter prefix over millions
+#   of cities) keep their best TOP_K cities per prefix, computed with the index and maintained on writes
+# - fuzzy: trigram posting lists (slot arrays). The posting lists of the query's trigrams are
+#   counted together (Counter, a C loop) which gives the trigrams each name shares with the query,
+#   with the trigram count of every slot that is the jaccard similarity, kept from FUZZY_THRESHOLD
+#   up. Words are padded with one space on each side: the '  x' first letter trigrams of pg_trgm
+#   would be the longest lists by far, and a first letter is what the prefix search is for
+# Writes of the other workers: every city write also goes to the CityChange log (models.py), in its
+# transaction and at the GeoVersion (snapshot.py) it bumps. When the version moved past the index's,
+# the index applies the log rows above its version - the changes of every worker, its own ones again
+# (applying a change twice gives the same index). An index too far behind for the log
+# (LOG_VERSIONS) is rebuilt in a background thread while the old one keeps answering, so is one
+# with too many dead slots (renamed/deleted cities).
+# `manage.py bench_search` times the queries on a synthetic index.
+
+import heapq
+from collections import Counter
+import math
+import threading
+import unicodedata
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connection
+
+from .models import CityChange, CityModel, StateModel
+from .snapshot import bump_version, read_version
+
+_options = getattr(settings, 'CITY_SEARCH', {})
+SEARCH_ENABLED = _options.get('ENABLED', True)
+# most results a query can ask for, and the length of the per-prefix lists
+TOP_K = _options.get('MAX_LIMIT', 50)
+# prefix ranges up to this many names are ranked on the spot
+SCAN_LIMIT = _options.get('SCAN_LIMIT', 2000)
+FUZZY_THRESHOLD = _options.get('FUZZY_THRESHOLD', 0.3)
+# versions of city changes kept in the log, an index further behind is rebuilt
+LOG_VERSIONS = _options.get('LOG_VERSIONS', 1000)
+# rebuild when this share of the slots is dead
+MAX_DEAD_RATIO = 0.25
+
+_LAST = '\U0010ffff'
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', text.casefold())
+    return ' '.join(''.join(ch for ch in text if not unicodedata.combining(ch)).split())
+
+
+def trigrams(key):
+    grams = set()
+    for word in key.split():
+        word = ' ' + word + ' '
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+class CityIndex:
+    def __init__(self):
+        self.pks = []                     # slot -> city pk, None when the slot is dead
+        self.names = []
+        self.keys = []                    # normalized names
+        self.codes = []
+        self.state_ids = []
+        self.populations = array('q')
+        self.gram_counts = array('H')     # number of trigrams of each name
+        self.slot_of = {}                 # pk -> live slot
+        self.sorted_keys = []             # every live key, sorted
+        self.sorted_slots = array('i')    # the slot of each sorted_keys entry
+        self.postings = {}                # trigram -> array of slots, ascending
+        self.top = {}                     # prefix -> its TOP_K most populated slots, best first
+        self.states = {}                  # state id -> (state_code, country_code)
+        self.dead = 0
+        self.version = self.states_version = 0
+        self.lock = threading.RLock()
+
+    @classmethod
+    def from_rows(cls, rows):
+        # rows of (pk, name, city_code, population, state_id)
+        index = cls()
+        for row in rows:
+            index._append(*row)
+        order = sorted(range(len(index.keys)), key=index.keys.__getitem__)
+        index.sorted_keys = [index.keys[slot] for slot in order]
+        index.sorted_slots = array('i', order)
+        index._warm_top()
+        return index
+
+    @classmethod
+    def build(cls):
+        # version first: rows written after it are in the log above it and get picked up - both
+        # from the primary
+        version = read_version(DEFAULT_DB_ALIAS)
+        rows = CityModel.objects.using(DEFAULT_DB_ALIAS).order_by().values_list('pk', 'name', 'city_code', 'population', 'state_id')
+        index = cls.from_rows(rows.iterator(chunk_size=5000))
+        index.version = version
+        index.load_states(version)
+        return index
+
+    def _warm_top(self):
+        # the top lists of every prefix too big to rank on the spot, instead of on its first query
+        keys = self.sorted_keys
+        length, found = 1, True
+        while found:
+            found, lo = False, 0
+            while lo < len(keys):
+                prefix = keys[lo][:length]
+                hi = bisect_left(keys, prefix + _LAST, lo)
+                if hi - lo > SCAN_LIMIT and len(prefix) == length:
+                    self.top[prefix] = self._best(self.sorted_slots[lo:hi], TOP_K)
+                    found = True
+                lo = hi
+            length += 1
+
+    def catch_up(self, version):
+        # the logged changes between the index's version and version, oldest first
+        with self.lock:
+            if self.version >= version:
+                return
+            rows = CityChange.objects.using(DEFAULT_DB_ALIAS).filter(
+                version__gt=self.version, version__lte=version,
+            ).order_by('version', 'pk').values_list('city_id', 'deleted', 'name', 'city_code', 'population', 'state_id')
+            self.apply(
+                (pk, None if deleted else {'name': name, 'city_code': code, 'population': population, 'state_id': state_id})
+                for pk, deleted, name, code, population, state_id in rows
+            )
+            self.version = version
+            # a state may have changed its code too
+            self.load_states(version)
+
+    def load_states(self, version):
+        self.states = {
+            state_id: (state_code, country_code) for state_id, state_code, country_code
+            in StateModel.objects.using(DEFAULT_DB_ALIAS).values_list('pk', 'state_code', 'country_code')
+        }
+        self.states_version = version
+
+    # writes
+
+    def _append(self, pk, name, code, population, state_id):
+        slot = len(self.pks)
+        key = normalize(name)
+        self.pks.append(pk)
+        self.names.append(name)
+        self.keys.append(key)
+        self.codes.append(code)
+        self.state_ids.append(state_id)
+        self.populations.append(population)
+        self.slot_of[pk] = slot
+        grams = trigrams(key)
+        self.gram_counts.append(len(grams))
+        for gram in grams:
+            self.postings.setdefault(gram, array('i')).append(slot)
+        return slot
+
+    def _prefixes(self, key):
+        return (key[:length] for length in range(1, len(key) + 1))
+
+    def _top_drop(self, slot):
+        # a list that loses a member (or sees it fall) can't tell who comes next, it is rebuilt on demand
+        for prefix in self._prefixes(self.keys[slot]):
+            best = self.top.get(prefix)
+            if best is not None and slot in best:
+                del self.top[prefix]
+
+    def _top_add(self, slot):
+        population = self.populations[slot]
+        for prefix in self._prefixes(self.keys[slot]):
+            best = self.top.get(prefix)
+            if best is None:
+                continue
+            if slot in best:
+                # grew in place
+                best.sort(key=self.populations.__getitem__, reverse=True)
+            elif population > self.populations[best[-1]]:
+                best.append(slot)
+                best.sort(key=self.populations.__getitem__, reverse=True)
+                del best[TOP_K:]
+
+    def _kill(self, slot):
+        self._top_drop(slot)
+        key = self.keys[slot]
+        position = bisect_left(self.sorted_keys, key)
+        while self.sorted_slots[position] != slot:
+            position += 1
+        del self.sorted_keys[position]
+        del self.sorted_slots[position]
+        del self.slot_of[self.pks[slot]]
+        self.pks[slot] = None
+        self.dead += 1
+
+    def apply(self, changes):
+        # changes: (pk, values) in write order, values None for a deleted city, else a dict of
+        # name, city_code, population, state_id
+        with self.lock:
+            for pk, values in changes:
+                slot = self.slot_of.get(pk)
+                if values is None:
+                    if slot is not None:
+                        self._kill(slot)
+                    continue
+                if slot is not None and self.names[slot] == values['name']:
+                    # same name: same slot, postings and sorted position
+                    if values['population'] < self.populations[slot]:
+                        self._top_drop(slot)
+                    self.codes[slot] = values['city_code']
+                    self.state_ids[slot] = values['state_id']
+                    self.populations[slot] = values['population']
+                    self._top_add(slot)
+                    continue
+                if slot is not None:
+                    self._kill(slot)
+                slot = self._append(pk, values['name'], values['city_code'], values['population'], values['state_id'])
+                key = self.keys[slot]
+                position = bisect_left(self.sorted_keys, key)
+                self.sorted_keys.insert(position, key)
+                self.sorted_slots.insert(position, slot)
+                self._top_add(slot)
+
+    # reads
+
+    def _best(self, slots, limit):
+        return heapq.nlargest(limit, slots, key=self.populations.__getitem__)
+
+    def prefix(self, query, limit):
+        key = normalize(query)
+        if not key:
+            return []
+        with self.lock:
+            lo = bisect_left(self.sorted_keys, key)
+            hi = bisect_left(self.sorted_keys, key + _LAST, lo)
+            if hi - lo <= SCAN_LIMIT:
+                return self._best(self.sorted_slots[lo:hi], limit)
+            best = self.top.get(key)
+            if best is None:
+                best = self.top[key] = self._best(self.sorted_slots[lo:hi], TOP_K)
+            return best[:limit]
+
+    def fuzzy(self, query, limit):
+        grams = trigrams(normalize(query))
+        if not grams:
+            return []
+        size = len(grams)
+        needed = max(1, math.ceil(FUZZY_THRESHOLD * size))
+        with self.lock:
+            shared = Counter()
+            for gram in grams:
+                shared.update(self.postings.get(gram, ()))
+            gram_counts, pks = self.gram_counts, self.pks
+            matches = [
+                slot for slot, count in shared.items()
+                if count >= needed and count / (size + gram_counts[slot] - count) >= FUZZY_THRESHOLD
+                and pks[slot] is not None
+            ]
+            return self._best(matches, limit)
+
+    def records(self, slots):
+        with self.lock:
+            result = []
+            for slot in slots:
+                state_code, country_code = self.states.get(self.state_ids[slot], (None, None))
+                result.append({
+                    'id': str(self.pks[slot]),
+                    'name': self.names[slot],
+                    'city_code': self.codes[slot],
+                    'state_code': state_code,
+                    'country_code': country_code,
+                    'population': self.populations[slot],
+                })
+            return result
+
+
+# the worker's index
+
+_index = None
+_lock = threading.Lock()          # swapping _index, _pending
+_first_build = threading.Lock()
+_pending = None                   # changes committed while a rebuild runs, replayed on the new index
+
+
+def _rebuild():
+    global _index, _pending
+    try:
+        index = CityIndex.build()
+        with _lock:
+            index.apply(_pending)
+            _index = index
+    finally:
+        with _lock:
+            _pending = None
+        connection.close()
+
+
+def start_rebuild():
+    global _pending
+    with _lock:
+        if _pending is not None:
+            return
+        _pending = []
+    threading.Thread(target=_rebuild, name='city-search-rebuild', daemon=True).start()
+
+
+def get_index():
+    global _index
+    if _index is None:
+        with _first_build:
+            if _index is None:
+                _index = CityIndex.build()
+        return _index
+    index = _index
+    version = read_version()
+    if version - index.version > LOG_VERSIONS or index.dead > MAX_DEAD_RATIO * len(index.pks):
+        # the log was pruned past it, or too much garbage - answer from this one until the new one is in
+        start_rebuild()
+    elif version != index.version:
+        index.catch_up(version)
+    return index
+
+
+def log_changes(changes):
+    # in the transaction of a write batch (rollups.py), for the indexes of the other workers
+    if not SEARCH_ENABLED:
+        return
+    bump_version()
+    version = read_version()
+    CityChange.objects.bulk_create([
+        CityChange(version=version, city_id=pk, deleted=True) if values is None
+        else CityChange(version=version, city_id=pk, **values)
+        for pk, values in changes
+    ], batch_size=1000)
+    CityChange.objects.filter(version__lte=version - LOG_VERSIONS).delete()
+
+
+def apply_changes(changes):
+    # on commit of a write batch, see rollups.py - this worker's index doesn't wait for the log
+    with _lock:
+        if _index is not None:
+            _index.apply(changes)
+        if _pending is not None:
+            _pending.extend(changes)
+
+
+def search_cities(query, limit, fuzzy=False):
+    if not SEARCH_ENABLED:
+        # no index: the db, istartswith / icontains (no typo tolerance), a scan of the cities
+        lookup = 'name__icontains' if fuzzy else 'name__istartswith'
+        rows = CityModel.objects.filter(**{lookup: query.strip()}).order_by('-population').values(
+            'id', 'name', 'city_code', 'state_code', 'country_code', 'population',
+        )[:limit]
+        return [{**row, 'id': str(row['id'])} for row in rows]
+    index = get_index()
+    slots = index.fuzzy(query, limit) if fuzzy else index.prefix(query, limit)
+    return index.records(slots)
@@ -9,29 +9,244 @@
 # https://www.django-rest-framework.org/api-guide/serializers/#modelserializer
 
 
-from rest_framework import serializers
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import IntegrityError, connection, models, transaction
+from django.utils.translation import gettext_lazy as _
+from rest_framework import serializers, status
+from rest_framework.authtoken.serializers import AuthTokenSerializer
+from rest_framework.exceptions import APIException
+from rest_framework.settings import api_settings
+from rest_framework.validators import UniqueValidator
 from .models import *
+from .queries import BULK_BATCH_SIZE, apply_changes, unique_sets
+from .etags import touch
+from .hashing import PasswordPoolBusy, pooled_checks
+from .response_cache import bump_countries
+from .rollups import record_rows, rollup_batch
 
-class CountrySerializer(serializers.ModelSerializer):
+# 'reconcile' diffs the incoming tree against the db, 'replace' deletes and re-inserts it
+NESTED_UPDATE_MODE = getattr(settings, 'NESTED_UPDATE_MODE', 'reconcile')
+# skip the unique pre-check queries and let the db constraints catch clashes, see _save_optimistically
+# can also be switched per view with context['optimistic_unique']
+OPTIMISTIC_UNIQUE_CHECKS = getattr(settings, 'OPTIMISTIC_UNIQUE_CHECKS', False)
+
+
+# Uniqueness checks
+# Each serializer declares its unique constraints once, in Meta.unique_checks:
+#     unique_checks = [
+#         (fields, message when the db already has the value, message when the request repeats it),
+#     ]
+# A single item runs one .exists() per check, like the validate_<field> methods used to.
+# Sent as a list (many=True), BatchUniqueListSerializer runs each check once for the whole batch
+# with an IN query, and also flags values repeated inside the batch - errors stay per item.
+# A None message skips that half of the check.
+# Meta.unique_scope is for the nested serializers: rows under the country a NestedCountrySerializer
+# is updating are matched by their code, not conflicts.
+# In optimistic mode none of the db checks run up front (values repeated inside a batch are still
+# caught, that costs no query), the INSERT/UPDATE goes straight to the db - see _save_optimistically.
+class UniqueChecksMixin:
+    def get_fields(self):
+        # DRF adds a UniqueValidator per unique field and a UniqueTogetherValidator per unique_together,
+        # each one more query per item - unique_checks replaces them
+        fields = super().get_fields()
+        for field in fields.values():
+            field.validators = [v for v in field.validators if not isinstance(v, UniqueValidator)]
+        return fields
+
+    def get_unique_together_validators(self):
+        return []
+
+    def save(self, **kwargs):
+        return _save_optimistically(self, super().save, **kwargs)
+
+    def unique_queryset(self):
+        queryset = self.Meta.model.objects.all()
+        if isinstance(self.instance, self.Meta.model):
+            queryset = queryset.exclude(pk=self.instance.pk)
+        scope = getattr(self.Meta, 'unique_scope', None)
+        country = _nested_country(self)
+        if scope and country:
+            queryset = queryset.exclude(**{scope: country})
+        return queryset
+
+    def to_internal_value(self, data):
+        data = super().to_internal_value(data)
+        if getattr(self, '_batch_unique', False) or _optimistic(self):
+            return data   # the list serializer checks the whole batch / the db will
+
+        errors = {}
+        for fields, message, _ in self.Meta.unique_checks:
+            key = _unique_key(data, fields)
+            if message and key and self.unique_queryset().filter(**dict(zip(fields, key))).exists():
+                errors.setdefault(_unique_error_key(fields), []).append(message)
+        if errors:
+            raise serializers.ValidationError(errors)
+        return data
+
+
+# PrimaryKeyRelatedField runs a .get() per item, this one first looks in what
+# BatchUniqueListSerializer loaded for the whole batch with a single in_bulk()
+class BatchPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    preloaded = None
+
+    def to_internal_value(self, data):
+        if self.preloaded is not None:
+            try:
+                obj = self.preloaded.get(self.get_queryset().model._meta.pk.to_python(data))
+            except (TypeError, ValueError, DjangoValidationError):
+                obj = None
+            if obj is not None:
+                return obj
+        return super().to_internal_value(data)   # proper error for bad/unknown pks
+
+
+class BatchUniqueListSerializer(serializers.ListSerializer):
+    def preload_related(self, data):
+        for field in self.child.fields.values():
+            if not isinstance(field, BatchPrimaryKeyRelatedField) or field.read_only:
+                continue
+            pk_field = field.get_queryset().model._meta.pk
+            pks = set()
+            for item in data:
+                try:
+                    pks.add(pk_field.to_python(item.get(field.field_name)))
+                except (AttributeError, TypeError, ValueError, DjangoValidationError):
+                    continue
+            field.preloaded = field.get_queryset().in_bulk(pks - {None})
+
+    def run_child_validation(self, data):
+        # remember every item's outcome in order, to_internal_value pairs them with the batch checks
+        try:
+            validated = super().run_child_validation(data)
+        except serializers.ValidationError as exc:
+            self._outcomes.append((None, exc.detail))
+            raise
+        self._outcomes.append((validated, None))
+        return validated
+
+    def to_internal_value(self, data):
+        self._outcomes = []
+        self.child._batch_unique = True
+        try:
+            if isinstance(data, list):
+                self.preload_related(data)
+            super().to_internal_value(data)
+        except serializers.ValidationError:
+            if not self._outcomes:
+                raise   # not a list, empty list...
+        finally:
+            self.child._batch_unique = False
+            for field in self.child.fields.values():
+                if isinstance(field, BatchPrimaryKeyRelatedField):
+                    field.preloaded = None
+
+        items = [validated for validated, _ in self._outcomes]
+        errors = [dict(error) if error else {} for _, error in self._outcomes]
+        self.check_unique(items, errors)
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return items
+
+    def check_unique(self, items, errors):
+        queryset = self.child.unique_queryset()
+        for fields, message, repeated in self.child.Meta.unique_checks:
+            error_key = _unique_error_key(fields)
+            keys = [(index, _unique_key(item, fields)) for index, item in enumerate(items) if item is not None]
+            keys = [(index, key) for index, key in keys if key]
+
+            taken = set()
+            if message and keys and not _optimistic(self):
+                # one IN query per field, the combinations are matched here
+                lookups = {f'{field}__in': {key[i] for _, key in keys} for i, field in enumerate(fields)}
+                taken = set(queryset.filter(**lookups).values_list(*fields))
+
+            seen = set()
+            for index, key in keys:
+                if key in taken:
+                    errors[index].setdefault(error_key, []).append(message)
+                elif repeated and key in seen:
+                    errors[index].setdefault(error_key, []).append(repeated)
+                seen.add(key)
+
+    def save(self, **kwargs):
+        return _save_optimistically(self, super().save, **kwargs)
+
+    def create(self, validated_data):
+        # a batch POST to the list endpoints becomes one bulk_create, only used for flat serializers
+        model = self.child.Meta.model
+        objs = [model(**attrs) for attrs in validated_data]
+        for obj in objs:
+            # bulk_create doesn't call save(), which fills the hierarchy path (see models.py)
+            if hasattr(obj, 'copy_path'):
+                obj.copy_path()
+        objs = model.objects.bulk_create(objs, batch_size=BULK_BATCH_SIZE)
+        record_rows(model, objs)
+        return objs
+
+
+def _optimistic(serializer):
+    return serializer.context.get('optimistic_unique', OPTIMISTIC_UNIQUE_CHECKS)
+
+
+def _save_optimistically(serializer, save, **kwargs):
+    # In optimistic mode the unique constraints of the models are what catches a clash, so on the
+    # happy path a single row create is just its INSERT. On IntegrityError we validate the request
+    # again with the checks switched on - that tells which fields/items clashed and raises the
+    # same ValidationError the pre-checks would have, only the failing request pays for the queries.
+    # A clash the checks don't see (e.g. a row written in between) is still a 400, not a 500.
+    if not _optimistic(serializer):
+        return save(**kwargs)
+    # Outside a transaction (the views: no ATOMIC_REQUESTS) the write is its one INSERT/UPDATE.
+    # Inside one (a batch, a caller's atomic block, the tests) a savepoint goes around it - two more
+    # statements, but needed: save() marks the enclosing atomic block for rollback when it fails
+    # (mark_for_rollback_on_error), and every query after that, the re-check below included, would
+    # raise TransactionManagementError. The savepoint takes the failed write back alone.
+    try:
+        if connection.in_atomic_block:
+            with transaction.atomic():
+                return save(**kwargs)
+        return save(**kwargs)
+    except IntegrityError:
+        context = serializer.context
+        optimistic = context.get('optimistic_unique', OPTIMISTIC_UNIQUE_CHECKS)
+        context['optimistic_unique'] = False
+        try:
+            serializer.run_validation(serializer.initial_data)
+        finally:
+            context['optimistic_unique'] = optimistic
+        raise serializers.ValidationError({api_settings.NON_FIELD_ERRORS_KEY: ['Conflicts with another row.']})
+
+
+def _unique_key(data, fields):
+    # values of `fields` as a tuple (related objects by pk), None if any of them is missing
+    key = tuple(data.get(field) for field in fields)
+    key = tuple(value.pk if isinstance(value, models.Model) else value for value in key)
+    return None if any(value in (None, '') for value in key) else key
+
+
+def _unique_error_key(fields):
+    return fields[0] if len(fields) == 1 else api_settings.NON_FIELD_ERRORS_KEY
+
+
+class CountrySerializer(UniqueChecksMixin, serializers.ModelSerializer):
     class Meta:
         model = CountryModel
         fields = ['id', 'name', 'country_code', 'curr_symbol', 'phone_code', 'my_user']
         read_only_fields = ['id', 'my_user']
-        
-    def validate_phone_code(self, value):
-        queryset = CountryModel.objects.filter(phone_code=value)
-        if self.instance:
-            queryset = queryset.exclude(pk=self.instance.pk)
-        if queryset.exists():
-            raise serializers.ValidationError("Phone code already exists.")
-        return value
+        list_serializer_class = BatchUniqueListSerializer
+        unique_checks = [
+            (['country_code'], "Country code already exists.", "Country code is repeated in this request."),
+            (['phone_code'], "Phone code already exists.", "Phone code is repeated in this request."),
+        ]
 
 
-class StateSerializer(serializers.ModelSerializer):
-    country_code = serializers.CharField(source='country.country_code', read_only=True)
+class StateSerializer(UniqueChecksMixin, serializers.ModelSerializer):
+    # the state's own copy of its country's code, no join
+    country_code = serializers.CharField(read_only=True)
     my_country__name = serializers.SerializerMethodField(read_only=True)
     my_country__my_user__name = serializers.SerializerMethodField(read_only=True)
-    country = serializers.PrimaryKeyRelatedField(queryset=CountryModel.objects.all(), write_only=True, required=True)
+    country = BatchPrimaryKeyRelatedField(queryset=CountryModel.objects.all(), write_only=True, required=True)
     
     class Meta:
         model = StateModel
@@ -46,6 +261,17 @@ class StateSerializer(serializers.ModelSerializer):
             'my_country__my_user__name',
         ]
         read_only_fields = ['id', 'country_code', 'my_country__name', 'my_country__my_user__name']
+        # what the get_<field> methods below read, used to plan joins (see prefetch.py)
+        method_field_sources = {
+            'my_country__name': 'country.name',
+            'my_country__my_user__name': 'country.my_user.email',
+        }
+        list_serializer_class = BatchUniqueListSerializer
+        unique_checks = [
+            (['state_code'], "State code already exists.", "State code is repeated in this request."),
+            (['gst_code'], "GST code already exists.", "GST code is repeated in this request."),
+            (['name', 'country'], "State with this name already exists in the country.", "State name is repeated in this request."),
+        ]
 
     def get_my_country__name(self, obj):
         return obj.country.name if obj.country else None
@@ -53,33 +279,17 @@ class StateSerializer(serializers.ModelSerializer):
     def get_my_country__my_user__name(self, obj):
         return obj.country.my_user.email if obj.country and obj.country.my_user else None
 
-    def validate_gst_code(self, value):
-        if value:
-            queryset = StateModel.objects.filter(gst_code=value)
-            if self.instance:
-                queryset = queryset.exclude(pk=self.instance.pk)
-            if queryset.exists():
-                raise serializers.ValidationError("GST code already exists.")
-        return value
-
     def validate(self, data):
         name = data.get('name')
-        country = data.get('country')
         if name and len(name) < 3:
             raise serializers.ValidationError({"name": "State name must be at least 3 characters long"})
-        if name and country:
-            queryset = StateModel.objects.filter(name=name, country=country)
-            if self.instance:
-                queryset = queryset.exclude(pk=self.instance.pk)
-            if queryset.exists():
-                raise serializers.ValidationError("State with this name already exists in the country.")
         return data
     
     
-class CitySerializer(serializers.ModelSerializer):
-    state_code = serializers.CharField(source='state.state_code', read_only=True)
+class CitySerializer(UniqueChecksMixin, serializers.ModelSerializer):
+    state_code = serializers.CharField(read_only=True)
     my_state__name = serializers.SerializerMethodField(read_only=True)
-    state = serializers.PrimaryKeyRelatedField(queryset=StateModel.objects.all(), write_only=True, required=True)
+    state = BatchPrimaryKeyRelatedField(queryset=StateModel.objects.all(), write_only=True, required=True)
 
     class Meta:
         model = CityModel
@@ -97,29 +307,21 @@ class CitySerializer(serializers.ModelSerializer):
             'my_state__name',
         ]
         read_only_fields = ['id', 'state_code', 'my_state__name']
+        method_field_sources = {
+            'my_state__name': 'state.name',
+        }
+        list_serializer_class = BatchUniqueListSerializer
+        unique_checks = [
+            (['phone_code'], "Phone code already exists.", "Phone code is repeated in this request."),
+            (['city_code'], "City code already exists.", "City code is repeated in this request."),
+            (['name', 'state'], "City with this name already exists in the state.", "City name is repeated in this state."),
+        ]
 
     def get_my_state__name(self, obj):
         return obj.state.name if obj.state else None
 
-    def validate_phone_code(self, value):
-        queryset = CityModel.objects.filter(phone_code=value)
-        if self.instance:
-            queryset = queryset.exclude(pk=self.instance.pk)
-        if queryset.exists():
-            raise serializers.ValidationError("Phone code already exists.")
-        return value
-
-    def validate_city_code(self, value):
-        queryset = CityModel.objects.filter(city_code=value)
-        if self.instance:
-            queryset = queryset.exclude(pk=self.instance.pk)
-        if queryset.exists():
-            raise serializers.ValidationError("City code already exists.")
-        return value
-
     def validate(self, data):
         name = data.get('name')
-        state = data.get('state')
         population = data.get('population')
         num_of_adults_males = data.get('num_of_adults_males')
         num_of_adults_females = data.get('num_of_adults_females')
@@ -127,13 +329,6 @@ class CitySerializer(serializers.ModelSerializer):
         if name and len(name) < 3:
             raise serializers.ValidationError({"name": "City name must be at least 3 characters long"})
         
-        if name and state:
-            queryset = CityModel.objects.filter(name=name, state=state)
-            if self.instance:
-                queryset = queryset.exclude(pk=self.instance.pk)
-            if queryset.exists():
-                raise serializers.ValidationError("City with this name already exists in the state.")
-        
         if population is not None and num_of_adults_males is not None and num_of_adults_females is not None:
             if population <= (num_of_adults_males + num_of_adults_females):
                 raise serializers.ValidationError("Population must be greater than the sum of adult males and females.")
@@ -154,7 +349,24 @@ class UserSerializer(serializers.ModelSerializer):
         return user
 
 
-class NestedCitySerializer(serializers.ModelSerializer):
+class SignInBusy(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Too many sign-ins in progress, try again shortly.'
+    default_code = 'signin_busy'
+
+
+# DRF's AuthTokenSerializer: authenticate() with the configured backends - PooledModelBackend
+# (hashing.py) checks the password in the bounded pool, 503 when the pool is full
+class SignInSerializer(AuthTokenSerializer):
+    def validate(self, attrs):
+        try:
+            with pooled_checks():
+                return super().validate(attrs)
+        except PasswordPoolBusy:
+            raise SignInBusy()
+
+
+class NestedCitySerializer(UniqueChecksMixin, serializers.ModelSerializer):
     class Meta:
         model = CityModel
         fields = [
@@ -162,22 +374,16 @@ class NestedCitySerializer(serializers.ModelSerializer):
             'avg_age', 'num_of_adults_males', 'num_of_adults_females'
         ]
         read_only_fields = ['id']
-
-    def validate_phone_code(self, value):
-        queryset = CityModel.objects.filter(phone_code=value)
-        if self.instance:
-            queryset = queryset.exclude(pk=self.instance.pk)
-        if queryset.exists():
-            raise serializers.ValidationError("Phone code already exists.")
-        return value
-
-    def validate_city_code(self, value):
-        queryset = CityModel.objects.filter(city_code=value)
-        if self.instance:
-            queryset = queryset.exclude(pk=self.instance.pk)
-        if queryset.exists():
-            raise serializers.ValidationError("City code already exists.")
-        return value
+        list_serializer_class = BatchUniqueListSerializer
+        # on a nested update, cities of the country being updated are matched by city_code or
+        # deleted before anything is inserted, so they only clash with cities of other countries
+        unique_scope = 'state__country'
+        # city_code and phone_code are unique across states too, see NestedCountrySerializer.validate_states
+        unique_checks = [
+            (['city_code'], "City code already exists.", "City code is repeated in this request."),
+            (['phone_code'], "Phone code already exists.", "Phone code is repeated in this request."),
+            (['name'], None, "City name is repeated in this state."),
+        ]
 
     def validate(self, data):
         population = data.get('population')
@@ -191,69 +397,289 @@ class NestedCitySerializer(serializers.ModelSerializer):
         return data
 
 
-class NestedStateSerializer(serializers.ModelSerializer):
+class NestedStateSerializer(UniqueChecksMixin, serializers.ModelSerializer):
     cities = NestedCitySerializer(many=True, required=False)
     
     class Meta:
         model = StateModel
         fields = ['id', 'name', 'gst_code', 'state_code', 'cities']
         read_only_fields = ['id']
-
-    def validate_gst_code(self, value):
-        if value:
-            queryset = StateModel.objects.filter(gst_code=value)
-            if self.instance:
-                queryset = queryset.exclude(pk=self.instance.pk)
-            if queryset.exists():
-                raise serializers.ValidationError("GST code already exists.")
-        return value
+        list_serializer_class = BatchUniqueListSerializer
+        unique_scope = 'country'
+        unique_checks = [
+            (['state_code'], "State code already exists.", "State code is repeated in this request."),
+            (['gst_code'], "GST code already exists.", "GST code is repeated in this request."),
+            (['name'], None, "State name is repeated in this request."),
+        ]
 
 
-class NestedCountrySerializer(serializers.ModelSerializer):
+class NestedCountrySerializer(UniqueChecksMixin, serializers.ModelSerializer):
     states = NestedStateSerializer(many=True, required=False)
     
     class Meta:
         model = CountryModel
         fields = ['id', 'name', 'country_code', 'curr_symbol', 'phone_code', 'states']
         read_only_fields = ['id']
-        
-    def validate_phone_code(self, value):
-        queryset = CountryModel.objects.filter(phone_code=value)
-        if self.instance:
-            queryset = queryset.exclude(pk=self.instance.pk)
-        if queryset.exists():
-            raise serializers.ValidationError("Phone code already exists.")
-        return value
+        unique_checks = CountrySerializer.Meta.unique_checks
+
+    def validate_states(self, states):
+        # each state's cities are checked as one batch, but city_code and phone_code are unique
+        # across all the states of the request too - catch that here, per item, before bulk_create
+        # turns it into an IntegrityError halfway through the tree
+        errors = [{} for _ in states]
+        updating = self.instance is not None
+        city_codes, phone_codes = set(), set()
+        for state, state_errors in zip(states, errors):
+            if updating:
+                # an update matches the rows on their codes, a PATCH doesn't require them by itself
+                _check_required(state, state_errors, ['state_code'])
+            cities = state.get('cities', [])
+            city_errors = [{} for _ in cities]
+            for city, errors_of_city in zip(cities, city_errors):
+                if updating:
+                    _check_required(city, errors_of_city, ['city_code'])
+            _check_repeated(cities, city_errors, 'city_code', "City code is repeated in this request.", city_codes)
+            _check_repeated(cities, city_errors, 'phone_code', "Phone code is repeated in this request.", phone_codes)
+            if any(city_errors):
+                state_errors['cities'] = city_errors
+
+        if updating and not any(errors):
+            self._check_against_stored(states, errors)
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return states
+
+    def _check_against_stored(self, states, errors):
+        # The unique checks of the nested rows skip this country (unique_scope), its rows are
+        # matched by code - but not all of them are in the request: the cities of a state sent
+        # without `cities` are kept as they are, the rows sent must not clash with those - nor with
+        # the codes a PATCH keeps on the rows it sends without them.
+        # And a PATCH leaves out required fields, the rows it creates still need them.
+        country = self.instance
+        stored_states = dict(country.states.values_list('state_code', 'gst_code'))
+        stored_cities = {}
+        for city_code, phone_code, state_code in CityModel.objects.filter(state__country=country).values_list(
+            'city_code', 'phone_code', 'state_code'
+        ):
+            stored_cities[city_code] = (phone_code, state_code)
+
+        kept_states = {state['state_code'] for state in states if 'cities' not in state} & stored_states.keys()
+        if NESTED_UPDATE_MODE == 'replace':
+            # the whole tree is deleted and inserted again
+            stored_states, stored_cities, kept_states = {}, {}, set()
+        kept_codes = {code for code, (_, state_code) in stored_cities.items() if state_code in kept_states}
+        # value -> the row keeping it
+        kept_phones = {stored_cities[code][0]: code for code in kept_codes}
+        kept_gst = {}
+        for state in states:
+            if 'gst_code' not in state and stored_states.get(state['state_code']) is not None:
+                kept_gst[stored_states[state['state_code']]] = state['state_code']
+            for city in state.get('cities', []):
+                if 'phone_code' not in city and city['city_code'] in stored_cities:
+                    kept_phones[stored_cities[city['city_code']][0]] = city['city_code']
+
+        state_fields = _create_fields(self.fields['states'].child)
+        city_fields = _create_fields(self.fields['states'].child.fields['cities'].child)
+        for state, state_errors in zip(states, errors):
+            new_state = state['state_code'] not in stored_states
+            if kept_gst.get(state.get('gst_code'), state['state_code']) != state['state_code']:
+                state_errors.setdefault('gst_code', []).append("GST code already exists.")
+            if self.partial and new_state:
+                _check_required(state, state_errors, state_fields)
+            cities = state.get('cities', [])
+            city_errors = [{} for _ in cities]
+            for city, errors_of_city in zip(cities, city_errors):
+                if city['city_code'] in kept_codes:
+                    errors_of_city.setdefault('city_code', []).append("City code already exists.")
+                elif kept_phones.get(city.get('phone_code'), city['city_code']) != city['city_code']:
+                    errors_of_city.setdefault('phone_code', []).append("Phone code already exists.")
+                # a city moving into a new state is inserted again too (_reconcile_states)
+                if self.partial and (new_state or city['city_code'] not in stored_cities):
+                    _check_required(city, errors_of_city, city_fields)
+            if any(city_errors):
+                state_errors['cities'] = city_errors
 
     def create(self, validated_data):
         states_data = validated_data.pop('states', [])
-        country = CountryModel.objects.create(**validated_data)
-        
-        for state_data in states_data:
-            cities_data = state_data.pop('cities', [])
-            state = StateModel.objects.create(country=country, **state_data)
-            
-            for city_data in cities_data:
-                CityModel.objects.create(state=state, **city_data)
-                
+        with rollup_batch():
+            country = CountryModel.objects.create(**validated_data)
+            _bulk_create_states(country, states_data)
+            bump_countries(country.country_code)
         return country
 
     def update(self, instance, validated_data):
         states_data = validated_data.pop('states', [])
+        old_country_code = instance.country_code
 
-        for attr, value in validated_data.items():
-            setattr(instance, attr, value)
-        instance.save()
-        
-        if states_data:
-            # here its cities will be deleted too because of cascade delete in model
-            instance.states.all().delete()
-            
-            for state_data in states_data:
-                cities_data = state_data.pop('cities', [])
-                state = StateModel.objects.create(country=instance, **state_data)
-                
-                for city_data in cities_data:
-                    CityModel.objects.create(state=state, **city_data)
-        
-        return instance
\ No newline at end of file
+        try:
+            # a savepoint: a clash the checks didn't see (a row written in between) leaves the
+            # request's transaction usable for the 400
+            with transaction.atomic(), rollup_batch():
+                for attr, value in validated_data.items():
+                    setattr(instance, attr, value)
+                instance.save()
+
+                if states_data:
+                    if NESTED_UPDATE_MODE == 'replace':
+                        # here its cities will be deleted too because of cascade delete in model
+                        instance.states.all().delete()
+                        _bulk_create_states(instance, states_data)
+                    else:
+                        _reconcile_states(instance, states_data)
+                bump_countries(old_country_code, instance.country_code)
+        except IntegrityError:
+            raise serializers.ValidationError({'states': ['Conflicts with another row.']})
+
+        return instance
+
+
+def _nested_country(serializer):
+    # the country a NestedCountrySerializer is updating, None when creating
+    instance = serializer.root.instance
+    return instance if isinstance(instance, CountryModel) else None
+
+
+def _check_required(item, errors, fields):
+    for field in fields:
+        if field not in item:
+            errors.setdefault(field, []).append(_('This field is required.'))
+
+
+def _create_fields(serializer):
+    # the fields a create needs, partial validation skips them
+    return [name for name, field in serializer.fields.items() if field.required and not field.read_only]
+
+
+def _check_repeated(items, errors, field, message, seen=None):
+    # flag items whose `field` value was already used by an earlier item of the same request
+    seen = set() if seen is None else seen
+    for item, item_errors in zip(items, errors):
+        value = item.get(field)
+        if value in (None, ''):
+            continue
+        if value in seen:
+            item_errors.setdefault(field, []).append(message)
+        seen.add(value)
+
+
+def _bulk_create_states(country, states_data):
+    # one bulk_create per level instead of one INSERT per row
+    # the UUID pk is filled in by the field default when the model is built, so the cities
+    # can point at their state before anything is written - no re-read of the states needed
+    states, cities = [], []
+    for state_data in states_data:
+        cities_data = state_data.pop('cities', [])
+        state = StateModel(country=country, **state_data, **StateModel.path_from(country))
+        states.append(state)
+        cities.extend(CityModel(state=state, **city_data, **CityModel.path_from(state)) for city_data in cities_data)
+
+    StateModel.objects.bulk_create(states, batch_size=BULK_BATCH_SIZE)
+    CityModel.objects.bulk_create(cities, batch_size=BULK_BATCH_SIZE)
+    record_rows(CityModel, cities)
+    return states, cities
+
+
+def _unique_values(obj, sets):
+    return [tuple(getattr(obj, field.attname) for field in fields) for fields in sets]
+
+
+def _park_moving_values(model, sets, rows):
+    # bulk_update writes the rows one after the other (even within one UPDATE), so a unique value
+    # handed from one row of the batch to another - two states swapping gst codes, two cities
+    # swapping phone codes or names - clashes with the row still holding it. Those rows give the
+    # value up first, one UPDATE per column: NULL, or their own pk when the column can't be null.
+    # rows = [(row, _unique_values() as loaded)]
+    for index, fields in enumerate(sets):
+        wanted = {values[index] for values in (_unique_values(obj, sets) for obj, _ in rows)}
+        moving = [
+            obj for obj, loaded in rows
+            if None not in loaded[index] and loaded[index] in wanted and loaded[index] != _unique_values(obj, sets)[index]
+        ]
+        if not moving:
+            continue
+        field = next(field for field in fields if not field.is_relation)
+        if field.null:
+            placeholder = None
+        else:
+            placeholder = models.Case(*[models.When(pk=obj.pk, then=models.Value(obj.pk.hex[-field.max_length:])) for obj in moving])
+        model.objects.filter(pk__in=[obj.pk for obj in moving]).update(**{field.attname: placeholder})
+
+
+def _reconcile_states(country, states_data):
+    # Match the incoming tree against the stored one on state_code / city_code and only write
+    # the difference: bulk_update for changed rows, bulk_create for new ones, a batched delete
+    # for the ones that are gone. Untouched rows keep their UUIDs and cost nothing.
+    # A state sent without a `cities` key keeps its cities as they are.
+    existing_states = {state.state_code: state for state in country.states.all()}
+    for state in existing_states.values():
+        # prefetched states can predate a country_code change, the rows have it already (CountryModel.save)
+        state.copy_path(country)
+    existing_cities = {city.city_code: city for city in CityModel.objects.filter(state__country=country)}
+    state_sets, city_sets = unique_sets(StateModel, 'state_code'), unique_sets(CityModel, 'city_code')
+
+    new_states, changed_states, state_fields, new_state_ids = [], [], set(), set()
+    new_cities, changed_cities, city_fields = [], [], set()
+    # (row, its unique values as loaded) of the changed rows, see _park_moving_values
+    loaded_states, loaded_cities = [], []
+    kept_state_ids, kept_city_ids, stale_city_ids = set(), set(), set()
+
+    for state_data in states_data:
+        cities_data = state_data.pop('cities', None)
+        state = existing_states.get(state_data['state_code'])
+        if state is None:
+            state = StateModel(country=country, **state_data, **StateModel.path_from(country))
+            new_states.append(state)
+            new_state_ids.add(state.pk)
+        else:
+            kept_state_ids.add(state.pk)
+            loaded = _unique_values(state, state_sets)
+            changed = apply_changes(state, state_data)
+            if changed:
+                changed_states.append(state)
+                state_fields.update(changed)
+                loaded_states.append((state, loaded))
+
+        if cities_data is None:
+            kept_city_ids.update(city.pk for city in existing_cities.values() if city.state_id == state.pk)
+            continue
+
+        for city_data in cities_data:
+            city = existing_cities.get(city_data['city_code'])
+            if city is not None and state.pk in new_state_ids:
+                # moving into a state that doesn't exist yet, simpler to re-insert the city
+                stale_city_ids.add(city.pk)
+                city = None
+            if city is None:
+                new_cities.append(CityModel(state=state, **city_data, **CityModel.path_from(state)))
+                continue
+            kept_city_ids.add(city.pk)
+            loaded = _unique_values(city, city_sets)
+            changed = apply_changes(city, city_data)
+            if city.state_id != state.pk:
+                city.state = state
+                changed.append('state')
+                changed.extend(apply_changes(city, CityModel.path_from(state)))
+            if changed:
+                changed_cities.append(city)
+                city_fields.update(changed)
+                loaded_cities.append((city, loaded))
+
+    stale_city_ids.update(city.pk for city in existing_cities.values() if city.pk not in kept_city_ids)
+    stale_state_ids = [state.pk for state in existing_states.values() if state.pk not in kept_state_ids]
+
+    # deletes first so the codes and names they free can be reused by the updates and inserts,
+    # cities are moved out of removed states before those states cascade
+    if stale_city_ids:
+        CityModel.objects.filter(pk__in=stale_city_ids).delete()
+    if changed_cities:
+        _park_moving_values(CityModel, city_sets, loaded_cities)
+        CityModel.objects.bulk_update(changed_cities, sorted(city_fields) + touch(changed_cities), batch_size=BULK_BATCH_SIZE)
+    if stale_state_ids:
+        StateModel.objects.filter(pk__in=stale_state_ids).delete()
+    if changed_states:
+        _park_moving_values(StateModel, state_sets, loaded_states)
+        StateModel.objects.bulk_update(changed_states, sorted(state_fields) + touch(changed_states), batch_size=BULK_BATCH_SIZE)
+    StateModel.objects.bulk_create(new_states, batch_size=BULK_BATCH_SIZE)
+    CityModel.objects.bulk_create(new_cities, batch_size=BULK_BATCH_SIZE)
+    # the deletes went through the post_delete signals, the bulk writes don't send any
+    record_rows(CityModel, changed_cities + new_cities)
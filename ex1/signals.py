@@ -0,0 +1,83 @@
+# Signal handlers, connected in apps.py
+# https://docs.djangoproject.com/en/4.2/topics/signals/
+
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from .authentication import evict_token
+from .models import CityModel, CountryModel, CustomUser, StateModel
+from .response_cache import bump_all
+from .rollups import CITY_COLUMNS, load_values, record_city, record_state
+from .sqlite import configure_connection
+
+
+# pragmas of the new db connections (sqlite.py)
+@receiver(connection_created)
+def tune_connection(sender, connection, **kwargs):
+    configure_connection(connection)
+
+
+# signout deletes the token, deleting a user cascades to its token - both land here
+@receiver(post_delete, sender=Token)
+def evict_deleted_token(sender, instance, **kwargs):
+    evict_token(instance.key)
+
+
+# the cached token carries a copy of the user, drop it when the user changes (deactivated, new email...)
+@receiver(post_save, sender=CustomUser)
+def evict_user_tokens(sender, instance, created, **kwargs):
+    if created:
+        return
+    for key in Token.objects.filter(user=instance).values_list('key', flat=True):
+        evict_token(key)
+
+
+# state responses show the country owner's email (my_country__my_user__name)
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def invalidate_geography_responses(sender, instance, **kwargs):
+    if not kwargs.get('created'):
+        bump_all()
+
+
+# same reason for the ETags (etags.py): they only look at updated_at, so move it on the owner's
+# countries when the email changes or the user goes (pre_delete - SET_NULL clears my_user after)
+@receiver(post_save, sender=CustomUser)
+@receiver(pre_delete, sender=CustomUser)
+def touch_owned_countries(sender, instance, **kwargs):
+    update_fields = kwargs.get('update_fields')
+    if kwargs.get('created') or (update_fields is not None and 'email' not in update_fields):
+        return
+    CountryModel.objects.filter(my_user=instance).update(updated_at=timezone.now())
+
+
+# rollups (rollups.py): every city save/delete moves its totals, a state changing country moves its
+# totals to the new country. An instance saved without being loaded first (built with a pk, or
+# from an old pickle) reads its current row so the old values can come off.
+@receiver(pre_save, sender=CityModel)
+def load_city_values(sender, instance, raw=False, **kwargs):
+    if not raw:
+        load_values(instance, CITY_COLUMNS)
+
+
+@receiver(pre_save, sender=StateModel)
+def load_state_values(sender, instance, raw=False, **kwargs):
+    if not raw:
+        load_values(instance, ('country_id',))
+
+
+@receiver(post_save, sender=CityModel)
+@receiver(post_delete, sender=CityModel)
+def update_city_rollups(sender, instance, raw=False, **kwargs):
+    if not raw:
+        record_city(instance, deleted=kwargs['signal'] is post_delete)
+
+
+@receiver(post_save, sender=StateModel)
+@receiver(post_delete, sender=StateModel)
+def update_state_rollups(sender, instance, raw=False, **kwargs):
+    if not raw:
+        record_state(instance, deleted=kwargs['signal'] is post_delete)
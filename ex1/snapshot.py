@@ -0,0 +1,182 @@
+# In-memory snapshot of the geography for the detail lookups
+# Countries, states and cities are small next to RAM and read all the time, so each worker keeps a
+# copy: per serializer a Table - the output values of every row as one tuple (the field names are
+# stored once), indexed by the natural key of the url, e.g. ('US', 'CA') for a state. The values
+# are the ones the fast read plan (fastread.py) gives, a lookup is a dict hit and a zip().
+# Freshness: GeoVersion is one row counting the writes, also watched by the city search index. It is
+# bumped by response_cache.bump_countries and bump_all: inside the write's transaction on the bulk,
+# upsert and nested paths, right after the write has committed for the single row views (their
+# finalize_response) - a lookup in between still gets the previous snapshot. A city write also
+# bumps it in its transaction, for the search change log (search.py). Every lookup reads it -
+# a one row pk query - and when it moved, a new empty snapshot is swapped in and its tables are
+# built again on first use. A snapshot is never changed once its tables are in, readers of the old
+# one finish with it undisturbed.
+# Writes that don't bump (a country or state saved from the admin or a shell, raw SQL,
+# queryset.update()) are picked up when the snapshot is GEO_SNAPSHOT_MAX_AGE seconds old: it is
+# replaced then even if the version didn't move.
+# One thread builds at a time, the others meanwhile go to the db as if there was no snapshot.
+# The version is read where the request reads (replicas.py): a GET routed to a replica doesn't
+# query the primary. A replica lagging behind gives an older version, which never replaces a
+# newer snapshot - the requests that must see their own writes read it from the primary and move
+# it on. The tables are always built from the primary, so they are at least as new as their version.
+
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import F
+from django.http import Http404
+from rest_framework.response import Response
+
+from .fastread import read_plan_for
+from .models import GeoVersion
+
+SNAPSHOT_ENABLED = getattr(settings, 'GEO_SNAPSHOT', True)
+SNAPSHOT_MAX_AGE = getattr(settings, 'GEO_SNAPSHOT_MAX_AGE', 60)
+# what reads the version: this snapshot, the city search index (search.py) and the nested ETags
+# (etags.py) - with all of them off a write doesn't pay for bumping it
+VERSION_READ = (
+    SNAPSHOT_ENABLED or getattr(settings, 'CITY_SEARCH', {}).get('ENABLED', True)
+    or getattr(settings, 'GEO_ETAGS', True)
+)
+SNAPSHOT_CHUNK_SIZE = 2000
+
+
+def _version_query(using=None):
+    # using=None: the db the router picks for the request
+    return GeoVersion.objects.using(using).filter(pk=1).values_list('value', flat=True)
+
+
+def read_version(using=None):
+    return next(iter(_version_query(using)), 0)
+
+
+async def aread_version(using=None):
+    return await _version_query(using).afirst() or 0
+
+
+def bump_version():
+    # a write: the snapshots, the search indexes and the nested ETags go stale. The UPDATE holds the
+    # row until the write commits, so the writers bump it one after the other, in commit order
+    if not VERSION_READ:
+        return
+    if not GeoVersion.objects.filter(pk=1).update(value=F('value') + 1):
+        GeoVersion.objects.get_or_create(pk=1, defaults={'value': 1})
+
+
+class Table:
+    __slots__ = ('outputs', 'rows')
+
+    def __init__(self, outputs, rows):
+        self.outputs = outputs    # output field names
+        self.rows = rows          # key tuple -> tuple of output values
+
+    def get(self, key):
+        row = self.rows.get(key)
+        return None if row is None else dict(zip(self.outputs, row))
+
+
+class Snapshot:
+    __slots__ = ('version', 'tables', 'expires_at')
+
+    def __init__(self, version):
+        self.version = version
+        self.tables = {}          # serializer class -> Table, replaced (never changed) when one is added
+        self.expires_at = time.monotonic() + SNAPSHOT_MAX_AGE
+
+
+_snapshot = Snapshot(-1)
+_build_lock = threading.Lock()
+
+
+def build_table(plan, key_lookups):
+    columns = plan.columns
+    extra = sorted(set(key_lookups) - set(plan.lookups))
+    rows = {}
+    for row in plan.values(plan.model._default_manager.using(DEFAULT_DB_ALIAS).order_by(), *extra).iterator(chunk_size=SNAPSHOT_CHUNK_SIZE):
+        rows[tuple(row[lookup] for lookup in key_lookups)] = tuple(
+            row[lookup] if row[lookup] is None or convert is None else convert(row[lookup])
+            for _, lookup, convert in columns
+        )
+    return Table(tuple(plan.outputs), rows)
+
+
+def current_snapshot(version=None):
+    global _snapshot
+    if version is None:
+        version = read_version()
+    snapshot = _snapshot
+    if snapshot.version < version or snapshot.expires_at <= time.monotonic():
+        snapshot = _snapshot = Snapshot(version)
+    return snapshot
+
+
+def snapshot_table(serializer_class, key_lookups):
+    # the Table of serializer_class at the current version, None when it can't be used right now
+    # (a serializer without a flat read plan, or another thread is building)
+    plan = _flat_plan(serializer_class)
+    if plan is None:
+        return None
+    snapshot = current_snapshot()
+    return snapshot.tables.get(serializer_class) or _build(snapshot, serializer_class, plan, key_lookups)
+
+
+async def asnapshot_table(serializer_class, key_lookups):
+    plan = _flat_plan(serializer_class)
+    if plan is None:
+        return None
+    snapshot = current_snapshot(await aread_version())
+    table = snapshot.tables.get(serializer_class)
+    if table is None:
+        # once per version, the build reads every row - in a thread
+        table = await sync_to_async(_build)(snapshot, serializer_class, plan, key_lookups)
+    return table
+
+
+def _flat_plan(serializer_class):
+    plan = read_plan_for(serializer_class)
+    return None if plan is None or plan.children else plan
+
+
+def _build(snapshot, serializer_class, plan, key_lookups):
+    if not _build_lock.acquire(blocking=False):
+        return None
+    try:
+        table = snapshot.tables.get(serializer_class)
+        if table is None:
+            table = build_table(plan, key_lookups)
+            snapshot.tables = {**snapshot.tables, serializer_class: table}
+    finally:
+        _build_lock.release()
+    return table
+
+
+# Mixin for the detail views, answers retrieve() from the snapshot when GEO_SNAPSHOT is on
+# snapshot_key maps the url kwargs to the lookups of the row, in the order of the url
+class SnapshotMixin:
+    snapshot_key = None
+
+    def retrieve(self, request, *args, **kwargs):
+        table = None
+        if SNAPSHOT_ENABLED and self.snapshot_key:
+            table = snapshot_table(self.get_serializer_class(), tuple(self.snapshot_key.values()))
+        if table is None:
+            return super().retrieve(request, *args, **kwargs)
+        return self._snapshot_response(table, kwargs)
+
+    async def aretrieve(self, request, *args, **kwargs):
+        table = None
+        if SNAPSHOT_ENABLED and self.snapshot_key:
+            table = await asnapshot_table(self.get_serializer_class(), tuple(self.snapshot_key.values()))
+        if table is None:
+            return await super().aretrieve(request, *args, **kwargs)
+        return self._snapshot_response(table, kwargs)
+
+    def _snapshot_response(self, table, kwargs):
+        item = table.get(tuple(kwargs[name] for name in self.snapshot_key))
+        if item is None:
+            # same message as get_object_or_404
+            raise Http404('No %s matches the given query.' % self.get_serializer_class().Meta.model._meta.object_name)
+        return Response(item)
@@ -0,0 +1,21 @@
+# SQLite connection setup
+# Django opens sqlite with the library defaults: rollback journal (a writer blocks every reader
+# while it commits), a full fsync per commit, a 2 MB page cache. SQLITE_PRAGMAS (settings) is run
+# on every new connection - the connection_created receiver in signals.py - and with CONN_MAX_AGE
+# a connection is set up once per worker thread, not once per request.
+# journal_mode=wal is stored in the db file, the other pragmas only last as long as the connection.
+
+from django.conf import settings
+
+
+def pragma_statements(pragmas=None):
+    pragmas = getattr(settings, 'SQLITE_PRAGMAS', {}) if pragmas is None else pragmas
+    return ['PRAGMA %s = %s' % (name, value) for name, value in pragmas.items()]
+
+
+def configure_connection(connection):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for statement in pragma_statements():
+            cursor.execute(statement)
@@ -0,0 +1,90 @@
+# Population stats per country and per state, added up by the db
+# The metrics are aggregates over the cities, so a group of rows comes back from one GROUP BY query
+# instead of every city being downloaded and summed on the client:
+# - city_count, population, adult_males, adult_females, adults: counts and sums
+# - avg_age: weighted by population, sum(avg_age * population) / sum(population)
+# - adult_ratio: adults / population, male_ratio: adult_males / adults
+# (the ratios and avg_age are null when the denominator is 0)
+# Lists can be filtered with ?min_<metric>=/?max_<metric>= (a HAVING clause) and sorted with
+# ?ordering=<metric>,-<metric>
+# With STATS_FROM_ROLLUPS the same metrics are read from the rollup rows (rollups.py) instead:
+# one row per state/country, no scan of the cities - city_metrics() stays for checking them.
+
+# https://docs.djangoproject.com/en/4.2/topics/db/aggregation/
+
+from django.conf import settings
+from django.db.models import Count, F, FloatField, Sum
+from django.db.models.functions import Cast, Coalesce, NullIf
+from rest_framework.exceptions import ValidationError
+
+# read the stats from the rollup tables, False adds up the cities on every request
+STATS_FROM_ROLLUPS = getattr(settings, 'STATS_FROM_ROLLUPS', True)
+
+METRICS = ['city_count', 'population', 'adult_males', 'adult_females', 'adults', 'avg_age', 'adult_ratio', 'male_ratio']
+
+
+def _ratio(numerator, denominator):
+    # float division (sqlite divides integers as integers), null instead of a division by zero
+    return Cast(numerator, FloatField()) / NullIf(Cast(denominator, FloatField()), 0.0)
+
+
+def city_metrics(prefix=''):
+    # annotations over the cities reached through prefix, e.g. 'cities__' from a state
+    population = Coalesce(Sum(prefix + 'population'), 0)
+    males = Coalesce(Sum(prefix + 'num_of_adults_males'), 0)
+    females = Coalesce(Sum(prefix + 'num_of_adults_females'), 0)
+    return {
+        'city_count': Count(prefix + 'id'),
+        'population': population,
+        'adult_males': males,
+        'adult_females': females,
+        'adults': males + females,
+        'avg_age': _ratio(Sum(F(prefix + 'avg_age') * F(prefix + 'population'), output_field=FloatField()), Sum(prefix + 'population')),
+        'adult_ratio': _ratio(males + females, population),
+        'male_ratio': _ratio(males, males + females),
+    }
+
+
+def rollup_metrics(prefix='rollup__'):
+    # the same annotations read from a StateRollup/CountryRollup row, 0 when there is no row yet
+    population = Coalesce(F(prefix + 'population'), 0)
+    males = Coalesce(F(prefix + 'adult_males'), 0)
+    females = Coalesce(F(prefix + 'adult_females'), 0)
+    return {
+        'city_count': Coalesce(F(prefix + 'city_count'), 0),
+        'population': population,
+        'adult_males': males,
+        'adult_females': females,
+        'adults': males + females,
+        'avg_age': _ratio(F(prefix + 'age_weighted_sum'), population),
+        'adult_ratio': _ratio(males + females, population),
+        'male_ratio': _ratio(males, males + females),
+    }
+
+
+def metrics(cities_prefix):
+    # rollup_metrics() or city_metrics(cities_prefix), depending on STATS_FROM_ROLLUPS
+    return rollup_metrics() if STATS_FROM_ROLLUPS else city_metrics(cities_prefix)
+
+
+def filter_and_order(queryset, query_params, extra_ordering=(), default_ordering=()):
+    # ?min_population=1000&max_avg_age=40&ordering=-population
+    filters = {}
+    for metric in METRICS:
+        for bound, lookup in (('min_', 'gte'), ('max_', 'lte')):
+            value = query_params.get(bound + metric)
+            if value in (None, ''):
+                continue
+            try:
+                filters[f'{metric}__{lookup}'] = float(value)
+            except ValueError:
+                raise ValidationError({bound + metric: ['A number is required.']})
+    if filters:
+        queryset = queryset.filter(**filters)
+
+    ordering = [name.strip() for name in query_params.get('ordering', '').split(',') if name.strip()]
+    allowed = set(METRICS) | set(extra_ordering)
+    invalid = [name for name in ordering if name.lstrip('-') not in allowed]
+    if invalid:
+        raise ValidationError({'ordering': ['Unknown field(s): %s. Use one of: %s.' % (', '.join(invalid), ', '.join(sorted(allowed)))]})
+    return queryset.order_by(*(ordering or default_ordering))
@@ -0,0 +1,106 @@
+# Streaming JSON for big lists
+# list() builds the whole response.data in memory and renders it in one go: memory peaks at a few
+# times the size of the data and nothing goes out before the last row is serialized.
+# Here the rows are read with iterator(chunk_size=...) - Django runs the prefetch_related lookups
+# once per chunk - each chunk is serialized and rendered, handed to the server, and dropped.
+# Memory stays at about one chunk and the first bytes leave after the first chunk.
+# The async views (async_reads.py) stream from aiterator() with an async generator: under ASGI a
+# slow client holds a coroutine, not a thread.
+# A sync generator under ASGI (the sync views, the export) would be drained into a list by django
+# before the first byte goes out - streaming_response() hands it over as an async iterator that
+# pulls one chunk at a time in a thread instead.
+
+# https://docs.djangoproject.com/en/4.2/ref/request-response/#streaminghttpresponse-objects
+# https://docs.djangoproject.com/en/4.2/ref/models/querysets/#iterator
+
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+
+from .renderers import dumps
+
+STREAM_CHUNK_SIZE = getattr(settings, 'GEO_STREAM_CHUNK_SIZE', 100)
+
+
+def iter_chunks(queryset, chunk_size):
+    rows = queryset.iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def stream_json_list(serializer_class, queryset, context, chunk_size=STREAM_CHUNK_SIZE):
+    # same bytes as the renderer would give for the whole list, one chunk at a time
+    yield b'['
+    first = True
+    for chunk in iter_chunks(queryset, chunk_size):
+        for item in serializer_class(chunk, many=True, context=context).data:
+            yield (b'' if first else b',') + dumps(item)
+            first = False
+    yield b']'
+
+
+async def astream_json_list(serializer_class, queryset, context, chunk_size=STREAM_CHUNK_SIZE):
+    yield b'['
+    first = True
+    chunk = []
+    rows = queryset.aiterator(chunk_size=chunk_size)
+    while True:
+        row = await anext(rows, None)
+        if row is not None:
+            chunk.append(row)
+            if len(chunk) < chunk_size:
+                continue
+        for item in serializer_class(chunk, many=True, context=context).data:
+            yield (b'' if first else b',') + dumps(item)
+            first = False
+        chunk = []
+        if row is None:
+            break
+    yield b']'
+
+
+async def pull_in_thread(pieces):
+    # a sync iterator (db cursor included) as an async one, next() in a thread for each piece
+    pieces = iter(pieces)
+    end = object()
+    pull = sync_to_async(next)
+    while (piece := await pull(pieces, end)) is not end:
+        yield piece
+
+
+def streaming_response(request, content, content_type='application/json'):
+    if isinstance(getattr(request, '_request', request), ASGIRequest) and not hasattr(content, '__aiter__'):
+        content = pull_in_thread(content)
+    response = StreamingHttpResponse(content, content_type=content_type)
+    # tell nginx not to buffer it, or the client waits for the end anyway
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+class StreamingListMixin:
+    # GET ...?stream=1 - the whole list (no pagination) as a streamed JSON array
+    stream_chunk_size = STREAM_CHUNK_SIZE
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get('stream') not in ('1', 'true'):
+            return super().list(request, *args, **kwargs)
+        return streaming_response(request, stream_json_list(
+            self.get_serializer_class(), self._stream_queryset(), self.get_serializer_context(), self.stream_chunk_size,
+        ))
+
+    async def alist(self, request, *args, **kwargs):
+        if request.query_params.get('stream') not in ('1', 'true'):
+            return await super().alist(request, *args, **kwargs)
+        return streaming_response(request, astream_json_list(
+            self.get_serializer_class(), self._stream_queryset(), self.get_serializer_context(), self.stream_chunk_size,
+        ))
+
+    def _stream_queryset(self):
+        # a stable order, so each chunk picks up where the previous one ended
+        return self.filter_queryset(self.get_queryset()).order_by('name', 'id')
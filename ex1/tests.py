@@ -1,3 +1,1216 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.conf import settings
+from django.contrib.auth import authenticate
+from django.contrib.auth.signals import user_login_failed
+from django.core.cache import caches as django_caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import connection, connections
+from django.test import AsyncRequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import timezone
+from rest_framework import serializers
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from . import authentication, exports, fastread, hashing, ids, renderers, replicas, response_cache, rollups, search, snapshot, sqlite, views
+from .cache import DjangoCache, LRUCache
+from .management.commands import rebuild_rollups
+from .models import CityChange, CityModel, CountryModel, CustomUser, StateModel, StateRollup
+from .prefetch import plan_for
+from .serializers import CitySerializer, CountrySerializer, NestedCountrySerializer, StateSerializer
+
+
+def reset_process_state():
+    # the per-worker caches outlive the test transactions, start every test from empty ones
+    response_cache.response_cache.clear()
+    response_cache._versions.clear()
+    authentication.token_cache.clear()
+    replicas._pins.clear()
+    snapshot._snapshot = snapshot.Snapshot(-1)
+    search._index = None
+    search._pending = None
+
+
+# The seed data of the migrations: US (CA, TX, NY) and IN (MH, KA), two cities per state,
+# users a@ah.com ... e@ah.com with the password test123
+# silk records every request in the db, it would show up in the query counts
+@override_settings(MIDDLEWARE=[name for name in settings.MIDDLEWARE if not name.startswith('silk.')])
+class GeoTestCase(TestCase):
+    def setUp(self):
+        reset_process_state()
+        self.user = CustomUser.objects.get(email='a@ah.com')
+        self.client = self.client_for(self.user)
+
+    def client_for(self, user):
+        client = APIClient()
+        token, _ = Token.objects.get_or_create(user=user)
+        client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        return client
+
+    def request(self, method, url, data=None, client=None, **extra):
+        # the cache versions are bumped on commit, run those callbacks like a real commit would
+        with self.captureOnCommitCallbacks(execute=True):
+            return getattr(client or self.client, method)(url, data, format='json', **extra)
+
+    def get(self, url, **extra):
+        return self.request('get', url, **extra)
+
+    def results(self, response):
+        data = response.json()
+        return data['results'] if isinstance(data, dict) and 'results' in data else data
+
+    def streamed(self, response):
+        # the async views stream from an async generator
+        if response.is_async:
+            async def collect():
+                return b''.join([chunk async for chunk in response.streaming_content])
+            return async_to_sync(collect)()
+        return b''.join(response.streaming_content)
+
+    def count_queries(self, method, url, data=None, **extra):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.request(method, url, data, **extra)
+        return response, len(queries.captured_queries)
+
+    def city_data(self, code, **extra):
+        return {
+            'name': 'City ' + code, 'city_code': code, 'phone_code': '+0-' + code, 'population': 1000,
+            'avg_age': 30.0, 'num_of_adults_males': 100, 'num_of_adults_females': 100, **extra,
+        }
+
+
+class QueryPlanTests(GeoTestCase):
+    def test_plans_from_serializer_fields(self):
+        self.assertEqual(plan_for(StateSerializer), (('country', 'country__my_user'), ()))
+        self.assertEqual(plan_for(CitySerializer), (('state',), ()))
+        self.assertEqual(plan_for(NestedCountrySerializer), ((), ('states', 'states__cities')))
+
+    def test_unknown_method_source_plans_nothing(self):
+        class Opaque(serializers.ModelSerializer):
+            label = serializers.SerializerMethodField()
+            missing = serializers.SerializerMethodField()
+
+            class Meta:
+                model = StateModel
+                fields = ['name', 'label', 'missing']
+                method_field_sources = {'label': 'name'}
+
+            def get_label(self, obj):
+                return obj.name
+
+            def get_missing(self, obj):
+                return None
+
+        self.assertEqual(plan_for(Opaque), ((), ()))
+
+    def test_list_queries_do_not_grow_with_rows(self):
+        # fast reads off, so the serializers (and the planned joins) build the rows
+        with mock.patch('ex1.fastread.FAST_READS', False):
+            _, before = self.count_queries('get', '/api/countries/US/states/CA/cities/?page_size=1000')
+            state = StateModel.objects.get(state_code='CA')
+            for i in range(5):
+                CityModel.objects.create(state=state, **self.city_data('Q%d' % i))
+            reset_process_state()
+            response, after = self.count_queries('get', '/api/countries/US/states/CA/cities/?page_size=1000')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.results(response)), 7)
+        self.assertEqual(before, after)
+        self.assertEqual(self.results(response)[0]['my_state__name'], 'California')
+
+
+def nested_payload(code, states=2, cities=3, **extra):
+    return {
+        'name': 'Land ' + code, 'country_code': code, 'curr_symbol': 'x', 'phone_code': '+' + code, **extra,
+        'states': [
+            {
+                'name': '%s state %d' % (code, i), 'state_code': '%sS%d' % (code, i), 'gst_code': None,
+                'cities': [
+                    {
+                        'name': '%s city %d %d' % (code, i, j), 'city_code': '%sC%d%d' % (code, i, j),
+                        'phone_code': '%sP%d%d' % (code, i, j), 'population': 1000 + j, 'avg_age': 30.5,
+                        'num_of_adults_males': 10, 'num_of_adults_females': 10,
+                    }
+                    for j in range(cities)
+                ],
+            }
+            for i in range(states)
+        ],
+    }
+
+
+class NestedCreateTests(GeoTestCase):
+    def test_query_count_does_not_grow_with_cities(self):
+        # the per-state batches (city validation, rollup rows) are per state, not per city
+        self.request('post', '/api/nested/countries/', nested_payload('ZW', 1, 1))   # first write creates GeoVersion
+        _, small = self.count_queries('post', '/api/nested/countries/', nested_payload('ZA', 5, 1))
+        response, big = self.count_queries('post', '/api/nested/countries/', nested_payload('ZB', 5, 10))
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(small, big)
+        country = CountryModel.objects.get(country_code='ZB')
+        self.assertEqual(country.my_user, self.user)
+        self.assertEqual(StateModel.objects.filter(country=country).count(), 5)
+        self.assertEqual(CityModel.objects.filter(state__country=country).count(), 50)
+        self.assertEqual(len(response.json()['states'][4]['cities']), 10)
+
+    def test_city_code_repeated_across_states_writes_nothing(self):
+        payload = nested_payload('ZC', 2, 1)
+        payload['states'][1]['cities'][0]['city_code'] = payload['states'][0]['cities'][0]['city_code']
+        response = self.request('post', '/api/nested/countries/', payload)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['states'][1]['cities'][0]['city_code'], ['City code is repeated in this request.'])
+        self.assertFalse(CountryModel.objects.filter(country_code='ZC').exists())
+
+    def test_city_code_taken_by_another_country(self):
+        payload = nested_payload('ZD', 1, 1)
+        payload['states'][0]['cities'][0]['city_code'] = 'LA'
+        response = self.request('post', '/api/nested/countries/', payload)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['states'][0]['cities'][0]['city_code'], ['City code already exists.'])
+
+
+class NestedUpdateTests(GeoTestCase):
+    url = '/api/nested/countries/IN/'
+
+    def tree(self):
+        return {
+            state.state_code: {city.city_code: city.pk for city in state.cities.all()}
+            for state in StateModel.objects.filter(country_code='IN').prefetch_related('cities')
+        }
+
+    def test_put_keeps_matched_rows_and_writes_the_difference(self):
+        before = self.tree()
+        data = self.get(self.url).json()
+        data['states'] = [state for state in data['states'] if state['state_code'] == 'MH']
+        for city in data['states'][0]['cities']:
+            # the seed rows are exactly at population == adults, which validation refuses
+            city['population'] += 1
+        data['states'][0]['cities'].append(self.city_data('THN', name='Thane'))
+        response = self.request('put', self.url, data)
+        self.assertEqual(response.status_code, 200, response.content)
+        after = self.tree()
+        self.assertEqual(set(after), {'MH'})
+        self.assertEqual(after['MH']['MUM'], before['MH']['MUM'])    # same row, updated in place
+        self.assertEqual(set(after['MH']), {'MUM', 'PUN', 'THN'})
+        self.assertEqual(CityModel.objects.get(city_code='MUM').population, 12400001)
+
+    def test_state_without_cities_keeps_them(self):
+        before = self.tree()
+        response = self.request('patch', self.url, {'states': [{'state_code': 'MH'}, {'state_code': 'KA', 'name': 'Karnataka2'}]})
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.tree(), before)
+        self.assertEqual(StateModel.objects.get(state_code='KA').name, 'Karnataka2')
+
+    def test_patch_without_state_code_is_a_400(self):
+        response = self.request('patch', self.url, {'states': [{'name': 'Kar2'}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'states': [{'state_code': ['This field is required.']}]})
+
+    def test_patch_without_city_code_is_a_400(self):
+        response = self.request('patch', self.url, {'states': [{'state_code': 'KA', 'cities': [{'name': 'Mysuru'}]}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['states'][0]['cities'][0], {'city_code': ['This field is required.']})
+
+    def test_patch_creating_a_city_needs_its_fields(self):
+        response = self.request('patch', self.url, {'states': [{'state_code': 'KA', 'cities': [{'city_code': 'HUB'}]}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('population', response.json()['states'][0]['cities'][0])
+        self.assertFalse(CityModel.objects.filter(city_code='HUB').exists())
+
+    def test_new_city_clashing_with_a_kept_city_is_a_400(self):
+        # MH is sent without cities, so Mumbai stays - its phone code is taken
+        before = self.tree()
+        response = self.request('patch', self.url, {'states': [
+            {'state_code': 'MH'},
+            {'state_code': 'KA', 'cities': [self.city_data('HUB', phone_code='+91-22')]},
+        ]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['states'][1]['cities'][0], {'phone_code': ['Phone code already exists.']})
+        self.assertEqual(self.tree(), before)
+
+    def test_city_code_of_a_kept_city_is_a_400(self):
+        response = self.request('patch', self.url, {'states': [
+            {'state_code': 'MH'},
+            {'state_code': 'KA', 'cities': [self.city_data('MUM')]},
+        ]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['states'][1]['cities'][0], {'city_code': ['City code already exists.']})
+
+    def test_patch_swapping_gst_codes(self):
+        gst = dict(StateModel.objects.filter(country_code='IN').values_list('state_code', 'gst_code'))
+        before = self.tree()
+        response = self.request('patch', self.url, {'states': [
+            {'state_code': 'MH', 'gst_code': gst['KA']}, {'state_code': 'KA', 'gst_code': gst['MH']},
+        ]})
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(dict(StateModel.objects.filter(country_code='IN').values_list('state_code', 'gst_code')),
+                         {'MH': gst['KA'], 'KA': gst['MH']})
+        self.assertEqual(self.tree(), before)
+
+    def test_put_swapping_phone_codes_and_names(self):
+        before = self.tree()
+        data = self.get(self.url).json()
+        for state in data['states']:
+            for city in state['cities']:
+                city['population'] += 1
+        cities = data['states'][[state['state_code'] for state in data['states']].index('MH')]['cities']
+        first, second = cities
+        first['phone_code'], second['phone_code'] = second['phone_code'], first['phone_code']
+        first['name'], second['name'] = second['name'], first['name']
+        response = self.request('put', self.url, data)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.tree(), before)     # same rows, updated in place
+        stored = {city.city_code: (city.name, city.phone_code) for city in CityModel.objects.filter(state_code='MH')}
+        self.assertEqual(stored, {first['city_code']: (first['name'], first['phone_code']),
+                                  second['city_code']: (second['name'], second['phone_code'])})
+
+    def test_taking_a_code_from_a_row_that_keeps_it_is_a_400(self):
+        # PUN and KA are sent without the codes asked for, they keep them
+        gst = dict(StateModel.objects.filter(country_code='IN').values_list('state_code', 'gst_code'))
+        before = self.tree()
+        response = self.request('patch', self.url, {'states': [
+            {'state_code': 'MH', 'gst_code': gst['KA'], 'cities': [{'city_code': 'MUM', 'phone_code': '+91-20'}, {'city_code': 'PUN'}]},
+            {'state_code': 'KA'},
+        ]})
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()['states']
+        self.assertEqual(errors[0]['gst_code'], ['GST code already exists.'])
+        self.assertEqual(errors[0]['cities'][0], {'phone_code': ['Phone code already exists.']})
+        self.assertEqual(self.tree(), before)
+
+    def test_clash_missed_by_the_checks_is_a_400(self):
+        with mock.patch.object(NestedCountrySerializer, '_check_against_stored'):
+            response = self.request('patch', self.url, {'states': [
+                {'state_code': 'MH', 'cities': [{'city_code': 'MUM', 'phone_code': '+91-20'}, {'city_code': 'PUN'}]},
+            ]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'states': ['Conflicts with another row.']})
+        self.assertEqual(CityModel.objects.get(city_code='MUM').phone_code, '+91-22')
+
+
+class UpsertTests(GeoTestCase):
+    url = '/api/upsert/cities/'
+
+    def statuses(self, response):
+        return [result['status'] for result in response.json()['results']]
+
+    def test_creates_updates_and_leaves_unchanged(self):
+        mumbai = CityModel.objects.get(city_code='MUM')
+        # the seed rows are exactly at population == adults, which clean() refuses
+        CityModel.objects.filter(city_code='PUN').update(population=10 ** 7)
+        response = self.request('post', self.url, [
+            {**self.city_data('NEW1'), 'state_code': 'KA'},
+            {'city_code': 'MUM', 'population': mumbai.population + 1},
+            {'city_code': 'PUN', 'name': CityModel.objects.get(city_code='PUN').name},
+        ])
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.statuses(response), ['created', 'updated', 'unchanged'])
+        self.assertEqual(CityModel.objects.get(city_code='NEW1').state.state_code, 'KA')
+        self.assertEqual(CityModel.objects.get(city_code='MUM').population, mumbai.population + 1)
+
+    def test_clashing_row_fails_alone(self):
+        response = self.request('post', self.url, [
+            {**self.city_data('NEW1', phone_code='+91-22'), 'state_code': 'KA'},    # Mumbai's phone code
+            {**self.city_data('NEW2'), 'state_code': 'KA'},
+            {**self.city_data('NEW3', phone_code='+0-NEW2'), 'state_code': 'KA'},   # NEW2's, in the same request
+        ])
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.statuses(response), ['error', 'created', 'error'])
+        results = response.json()['results']
+        self.assertEqual(list(results[0]['errors']), ['phone_code'])
+        self.assertEqual(results[2]['errors'], {'phone_code': ['Repeated in this request.']})
+        self.assertEqual(list(CityModel.objects.filter(city_code__startswith='NEW').values_list('city_code', flat=True)), ['NEW2'])
+
+    def test_clash_found_at_write_time_fails_alone(self):
+        # e.g. a row written by another request between the checks and the insert
+        with mock.patch('ex1.queries._check_unique', lambda model, key, candidates: candidates):
+            response = self.request('post', self.url, [
+                {**self.city_data('NEW1', phone_code='+91-22'), 'state_code': 'KA'},
+                {**self.city_data('NEW2'), 'state_code': 'KA'},
+            ])
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.statuses(response), ['error', 'created'])
+        self.assertNotIn('UNIQUE', str(response.json()['results'][0]['errors']))
+        self.assertTrue(CityModel.objects.filter(city_code='NEW2').exists())
+
+    def test_name_taken_in_the_state_fails_the_row(self):
+        name = CityModel.objects.get(city_code='MUM').name
+        response = self.request('post', self.url, [{**self.city_data('NEW1', name=name), 'state_code': 'MH'}])
+        self.assertEqual(self.statuses(response), ['error'])
+        self.assertIn('non_field_errors', response.json()['results'][0]['errors'])
+
+    def test_values_are_validated_with_the_model_fields(self):
+        response = self.request('post', self.url, [
+            {'city_code': ['MUM']},
+            {'city_code': 'MUM', 'name': {'a': 1}},
+            {'city_code': 'PUN', 'phone_code': 'x' * 50},
+            'MUM',
+        ])
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.statuses(response), ['error'] * 4)
+        results = response.json()['results']
+        self.assertEqual(list(results[0]['errors']), ['city_code'])
+        self.assertEqual(list(results[1]['errors']), ['name'])
+        self.assertEqual(list(results[2]['errors']), ['phone_code'])
+        self.assertEqual(list(results[3]['errors']), ['non_field_errors'])
+
+    def test_unknown_parent_and_missing_fields(self):
+        response = self.request('post', self.url, [
+            {**self.city_data('NEW1'), 'state_code': 'ZZ'},
+            {'city_code': 'NEW2', 'state_code': 'KA'},
+        ])
+        results = response.json()['results']
+        self.assertEqual(results[0]['errors'], {'state_code': ['Does not exist.']})
+        self.assertIn('population', results[1]['errors'])
+
+
+def country_data(code, **extra):
+    return {'name': 'Land ' + code, 'country_code': code, 'curr_symbol': 'x', 'phone_code': '+' + code, **extra}
+
+
+class BatchUniqueTests(GeoTestCase):
+    def test_one_query_per_check_whatever_the_batch_size(self):
+        for size in (1, 20):
+            serializer = CountrySerializer(data=[country_data('B%d' % i) for i in range(size)], many=True)
+            with self.assertNumQueries(len(CountrySerializer.Meta.unique_checks)):
+                self.assertTrue(serializer.is_valid(), serializer.errors)
+
+    def test_errors_stay_per_item(self):
+        response = self.request('post', '/api/countries/', [
+            country_data('B1'),
+            country_data('US'),                     # stored
+            country_data('B2', phone_code='+B1'),   # repeats the first item
+            country_data('B3'),
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), [
+            {},
+            {'country_code': ['Country code already exists.']},
+            {'phone_code': ['Phone code is repeated in this request.']},
+            {},
+        ])
+        self.assertFalse(CountryModel.objects.filter(country_code__startswith='B').exists())
+
+    def test_valid_batch_is_created(self):
+        response = self.request('post', '/api/countries/', [country_data('B1'), country_data('B2')])
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(CountryModel.objects.filter(country_code__in=['B1', 'B2']).count(), 2)
+
+    def test_single_item_runs_its_checks(self):
+        response = self.request('post', '/api/countries/', country_data('B1', phone_code='+1'))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'phone_code': ['Phone code already exists.']})
+
+
+class OptimisticUniqueTests(GeoTestCase):
+    def serializer(self, **extra):
+        return CountrySerializer(data=country_data('B1', **extra), context={'optimistic_unique': True})
+
+    def test_happy_path_runs_no_check_query(self):
+        serializer = self.serializer()
+        with self.assertNumQueries(0):
+            self.assertTrue(serializer.is_valid())
+        # like a view: no transaction around the write, it's the INSERT alone
+        with mock.patch.object(connections['default'], 'in_atomic_block', False), self.assertNumQueries(1):
+            serializer.save()
+        self.assertTrue(CountryModel.objects.filter(country_code='B1').exists())
+
+    def test_inside_a_transaction_the_write_gets_a_savepoint(self):
+        serializer = self.serializer()
+        self.assertTrue(serializer.is_valid())
+        with CaptureQueriesContext(connection) as queries:
+            serializer.save()
+        statements = [query['sql'].split()[0] for query in queries.captured_queries]
+        self.assertEqual(statements, ['SAVEPOINT', 'INSERT', 'RELEASE'])
+
+    def test_clash_is_reported_like_the_pre_checks(self):
+        with mock.patch('ex1.serializers.OPTIMISTIC_UNIQUE_CHECKS', True):
+            response = self.request('post', '/api/countries/', country_data('B1', phone_code='+1'))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'phone_code': ['Phone code already exists.']})
+
+    def test_clash_the_checks_miss_is_a_400(self):
+        serializer = self.serializer(phone_code='+1')
+        self.assertTrue(serializer.is_valid())
+        with mock.patch.object(CountrySerializer.Meta, 'unique_checks', []):
+            with self.assertRaises(serializers.ValidationError) as raised:
+                serializer.save()
+        self.assertEqual(raised.exception.detail, {'non_field_errors': ['Conflicts with another row.']})
+        self.assertTrue(serializer.context['optimistic_unique'])
+
+
+class TokenCacheTests(GeoTestCase):
+    def test_hit_skips_the_token_query(self):
+        key = Token.objects.get(user=self.user).key
+        auth = authentication.CachedTokenAuthentication()
+        with self.assertNumQueries(1):
+            auth.authenticate_credentials(key)
+        with self.assertNumQueries(0):
+            user, token = auth.authenticate_credentials(key)
+        self.assertEqual(user, self.user)
+
+    def test_in_process_default_ttl_is_short(self):
+        self.assertLessEqual(authentication.token_cache.ttl, authentication.DEFAULT_TTL)
+
+    def test_signout_revokes_the_cached_token(self):
+        self.assertEqual(self.get('/api/countries/').status_code, 200)
+        self.assertEqual(self.request('post', '/api/auth/signout/').status_code, 200)
+        self.assertEqual(self.get('/api/countries/').status_code, 401)
+
+    def test_deleted_user_is_refused(self):
+        self.assertEqual(self.get('/api/countries/').status_code, 200)
+        self.user.delete()
+        self.assertEqual(self.get('/api/countries/').status_code, 401)
+
+    def test_unknown_token_is_refused(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token nope')
+        self.assertEqual(self.request('get', '/api/countries/', client=client).status_code, 401)
+
+
+class SignInTests(GeoTestCase):
+    url = '/api/auth/signin/'
+
+    def setUp(self):
+        super().setUp()
+        pool = hashing.PasswordCheckPool(executor='thread', max_workers=1, max_pending=0, timeout=5)
+        patcher = mock.patch('ex1.hashing.password_pool', pool)
+        self.pool = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_signin_returns_the_token(self):
+        response = self.request('post', self.url, {'username': 'a@ah.com', 'password': 'test123'}, client=APIClient())
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['token'], Token.objects.get(user=self.user).key)
+        self.assertEqual(self.pool.stats()['completed'], 1)
+
+    def test_wrong_password_goes_through_the_backends(self):
+        failed = mock.Mock()
+        user_login_failed.connect(failed)
+        self.addCleanup(user_login_failed.disconnect, failed)
+        for username in ('a@ah.com', 'nobody@ah.com'):
+            response = self.request('post', self.url, {'username': username, 'password': 'wrong'}, client=APIClient())
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(failed.call_count, 2)
+        self.assertEqual(self.pool.stats()['completed'], 2)   # hashed for the missing user too
+
+    def test_full_pool_is_a_503(self):
+        with mock.patch.object(self.pool, 'check', side_effect=hashing.PasswordPoolBusy):
+            response = self.request('post', self.url, {'username': 'a@ah.com', 'password': 'test123'}, client=APIClient())
+        self.assertEqual(response.status_code, 503)
+
+    def test_timed_out_hash_keeps_its_slot_until_it_ends(self):
+        release = threading.Event()
+        self.pool.timeout = 0.05
+        with mock.patch('ex1.hashing._check', lambda raw, encoded: release.wait(5) and (True, None)):
+            with self.assertRaises(hashing.PasswordPoolBusy):
+                self.pool.check('x', 'y')
+            # still hashing: the only slot is taken
+            with self.assertRaises(hashing.PasswordPoolBusy):
+                self.pool.check('x', 'y')
+            stats = self.pool.stats()
+            self.assertEqual((stats['in_flight'], stats['completed'], stats['timed_out'], stats['rejected']), (1, 0, 1, 1))
+            release.set()
+            self.pool._executor.shutdown(wait=True)
+        stats = self.pool.stats()
+        self.assertEqual((stats['in_flight'], stats['completed']), (0, 1))
+        self.pool._executor, self.pool.timeout = None, 5
+        self.assertEqual(self.pool.check('x', 'y')[0], False)
+
+    def test_other_logins_check_inline(self):
+        # a full pool only concerns signin: admin / session / basic auth logins don't go through it
+        with mock.patch.object(self.pool, 'check', side_effect=hashing.PasswordPoolBusy):
+            self.assertEqual(authenticate(None, username='a@ah.com', password='test123'), self.user)
+            self.assertTrue(APIClient().login(username='a@ah.com', password='test123'))
+            self.assertIsNone(authenticate(None, username='a@ah.com', password='wrong'))
+        self.assertEqual(self.pool.stats()['completed'], 0)
+
+
+class ResponseCacheTests(GeoTestCase):
+    url = '/api/countries/US/states/'
+
+    def test_hit_reads_only_the_version(self):
+        first = self.get(self.url)
+        with CaptureQueriesContext(connection) as queries:
+            second = self.get(self.url)
+        self.assertEqual(len(queries.captured_queries), 1)
+        self.assertIn('ex1_geoversion', queries.captured_queries[0]['sql'])
+        self.assertEqual(first.json(), second.json())
+        self.assertEqual(first['ETag'], second['ETag'])
+
+    def test_write_in_the_country_invalidates(self):
+        self.get(self.url)
+        response = self.request('patch', self.url + 'CA/', {'name': 'Golden State'})
+        self.assertEqual(response.status_code, 200, response.content)
+        names = [state['name'] for state in self.results(self.get(self.url))]
+        self.assertIn('Golden State', names)
+
+    def shared_cache(self):
+        self.addCleanup(django_caches['default'].clear)
+        return mock.patch('ex1.response_cache.response_cache', DjangoCache('default', prefix='ex1:test-geo:'))
+
+    def test_write_in_another_country_keeps_the_shared_entry(self):
+        # in process memory the GeoVersion counter drops every entry on a write, shared the versions are per country
+        with self.shared_cache():
+            self.get(self.url)
+            self.request('patch', '/api/countries/IN/states/KA/', {'name': 'Karnataka2'})
+            with self.assertNumQueries(0):
+                self.get(self.url)
+
+    def test_write_on_another_worker_invalidates(self):
+        self.get(self.url)
+        # what another worker's write leaves behind: the db and the counter, not this worker's versions
+        StateModel.objects.filter(state_code='CA').update(name='Golden State')
+        snapshot.bump_version()
+        names = [state['name'] for state in self.results(self.get(self.url))]
+        self.assertIn('Golden State', names)
+
+    def test_shared_cache_hit_costs_no_query(self):
+        with self.shared_cache():
+            self.get(self.url)
+            with self.assertNumQueries(0):
+                self.get(self.url)
+
+    def test_disabled_cache_reads_the_db(self):
+        with mock.patch('ex1.response_cache.CACHE_ENABLED', False):
+            self.get(self.url)
+            with CaptureQueriesContext(connection) as queries:
+                self.get(self.url)
+        self.assertTrue(queries.captured_queries)
+
+
+class ETagTests(GeoTestCase):
+    def assert_revalidates(self, url, write):
+        etag = self.get(url)['ETag']
+        reset_process_state()   # answered from the tag, not from a cached entry
+        self.assertEqual(self.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        write()
+        response = self.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_flat_list(self):
+        self.assert_revalidates('/api/countries/US/states/', lambda: self.request(
+            'patch', '/api/countries/US/states/CA/', {'name': 'Golden State'}
+        ))
+
+    def test_nested_list_follows_the_version_counter(self):
+        self.assert_revalidates('/api/nested/countries/', lambda: self.request(
+            'post', '/api/countries/US/states/CA/cities/', {**self.city_data('SAC', name='Sacramento'), 'state': str(StateModel.objects.get(state_code='CA').pk)}
+        ))
+
+    def test_flat_detail(self):
+        self.assert_revalidates('/api/countries/US/states/CA/', lambda: self.request(
+            'patch', '/api/countries/US/', {'name': 'United States of America'}     # shown in the state
+        ))
+
+    def test_list_tags_read_no_rows(self):
+        for url in ('/api/nested/countries/', '/api/countries/US/states/?page_size=1'):
+            etag = self.get(url)['ETag']
+            reset_process_state()
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            sql = [query['sql'] for query in queries.captured_queries]
+            self.assertEqual(len(sql), 2, sql)   # the token, the version
+            self.assertIn('ex1_geoversion', sql[1])
+
+    def test_missing_detail_is_a_404(self):
+        response = self.get('/api/nested/countries/ZZ/', HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(response.status_code, 404)
+
+
+class CursorPaginationTests(GeoTestCase):
+    def walk(self, url):
+        codes, pages = [], 0
+        while url:
+            data = self.get(url).json()
+            codes += [row['country_code'] for row in data['results']]
+            url, pages = data['next'], pages + 1
+        return codes, pages
+
+    def test_walks_every_row_once_across_repeated_names(self):
+        # country names aren't unique, the cursor has to step over a run of equal names
+        for i in range(5):
+            CountryModel.objects.create(**country_data('D%d' % i, name='Dup'))
+        codes, pages = self.walk('/api/countries/?page_size=2')
+        self.assertEqual(sorted(codes), sorted(CountryModel.objects.values_list('country_code', flat=True)))
+        self.assertEqual(len(codes), len(set(codes)))
+        self.assertEqual(pages, 4)
+
+    def test_page_size_is_capped(self):
+        with mock.patch.object(views.GeoCursorPagination, 'max_page_size', 1):
+            data = self.get('/api/countries/?page_size=50').json()
+        self.assertEqual(len(data['results']), 1)
+        self.assertIsNotNone(data['next'])
+
+    def test_bad_cursor_is_a_404(self):
+        self.assertEqual(self.get('/api/countries/?cursor=nope').status_code, 404)
+
+
+class StreamingTests(GeoTestCase):
+    def test_stream_is_the_whole_list(self):
+        for code in ('S1', 'S2', 'S3'):
+            self.request('post', '/api/nested/countries/', nested_payload(code, 2, 2))
+        response = self.get('/api/nested/countries/?stream=1&page_size=1')
+        self.assertTrue(response.streaming)
+        body = json.loads(self.streamed(response))
+        self.assertEqual(len(body), CountryModel.objects.count())
+        self.assertEqual([country['name'] for country in body], sorted(country['name'] for country in body))
+        paged = self.results(self.get('/api/nested/countries/?page_size=100'))
+        self.assertEqual(sorted(body, key=lambda c: c['id']), sorted(paged, key=lambda c: c['id']))
+
+    def test_small_chunks_give_the_same_bytes(self):
+        url = '/api/nested/countries/?stream=1'
+        whole = self.streamed(self.get(url))
+        with mock.patch.object(views.NestedCountryListCreateView, 'stream_chunk_size', 1):
+            self.assertEqual(self.streamed(self.get(url)), whole)
+
+    def test_without_the_flag_the_list_is_paginated(self):
+        response = self.get('/api/nested/countries/')
+        self.assertFalse(response.streaming)
+        self.assertIn('next', response.json())
+
+    def test_sync_view_under_asgi_streams_an_async_iterator(self):
+        token = Token.objects.get_or_create(user=self.user)[0].key
+        request = AsyncRequestFactory().get('/api/nested/countries/?stream=1', headers={'Authorization': 'Token ' + token})
+        response = views.NestedCountryListCreateView.as_view()(request)
+        self.assertTrue(response.is_async)
+        self.assertEqual(self.streamed(response), self.streamed(self.get('/api/nested/countries/?stream=1')))
+
+
+class FastReadTests(GeoTestCase):
+    urls = [
+        '/api/countries/', '/api/countries/US/states/', '/api/countries/US/states/CA/cities/',
+        '/api/nested/countries/', '/api/countries/US/states/CA/', '/api/nested/countries/IN/',
+    ]
+
+    def test_same_output_as_the_serializers(self):
+        for url in self.urls:
+            fast = self.get(url).json()
+            reset_process_state()
+            with mock.patch('ex1.fastread.FAST_READS', False), mock.patch('ex1.async_reads.FAST_READS', False):
+                slow = self.get(url).json()
+            reset_process_state()
+            self.assertEqual(fast, slow, url)
+
+    def test_plans_only_what_it_can_read(self):
+        self.assertIsNotNone(fastread.read_plan_for(NestedCountrySerializer))
+
+        class Custom(serializers.ModelSerializer):
+            label = serializers.SerializerMethodField()
+
+            class Meta:
+                model = StateModel
+                fields = ['name', 'label']
+
+            def get_label(self, obj):
+                return obj.name.upper()
+
+        self.assertIsNone(fastread.read_plan_for(Custom))
+
+
+class RendererTests(GeoTestCase):
+    def test_same_bytes_as_drf(self):
+        data = {
+            'id': uuid.uuid4(), 'when': timezone.now(), 'price': Decimal('1.50'), 'ratio': 0.1,
+            'name': 'Zürich  ', 'nested': [1, None, True],
+        }
+        self.assertEqual(renderers.dumps(data), JSONRenderer().render(data))
+        self.assertEqual(renderers.FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_floats_in_exponent_form(self):
+        data = {'big': 1e16, 'small': 1e-7, 'tiny': 0.00001, 'neg': -2.5e-300, 'near': 10.00001, 'mid': 0.0001,
+                'strings': ['1e16', '0.00001', 'say "1e5"']}
+        self.assertEqual(renderers.dumps(data), JSONRenderer().render(data))
+        self.assertIn(b'"big":1e+16,"small":1e-07', renderers.dumps(data))
+
+    def test_indent_is_left_to_the_stdlib(self):
+        rendered = renderers.FastJSONRenderer().render({'a': 1}, 'application/json; indent=2')
+        self.assertEqual(rendered, b'{\n  "a": 1\n}')
+
+    def test_parser(self):
+        parser = renderers.FastJSONParser()
+        self.assertEqual(parser.parse(io.BytesIO('{"name": "Zürich", "n": 18446744073709551615}'.encode())),
+                         {'name': 'Zürich', 'n': 18446744073709551615})
+        # past 64 bits orjson gives a float, the stdlib keeps the int
+        self.assertEqual(parser.parse(io.BytesIO(b'[123456789012345678901234]')), [123456789012345678901234])
+        # below -2**63 too, still 19 digits
+        self.assertEqual(parser.parse(io.BytesIO(b'[-9223372036854775809, 18446744073709551616]')),
+                         [-9223372036854775809, 18446744073709551616])
+        self.assertEqual(parser.parse(io.BytesIO(b'[-9223372036854775808]')), [-9223372036854775808])
+        with self.assertRaises(ParseError):
+            parser.parse(io.BytesIO(b'{"name": '))
+
+    def test_malformed_body_is_a_400(self):
+        response = self.client.post('/api/countries/', b'{"name": ', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class ImportTests(GeoTestCase):
+    header = 'city_code,name,state_code,phone_code,population,avg_age,num_of_adults_males,num_of_adults_females\n'
+
+    def post(self, body, content_type='text/csv'):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/import/cities/', body.encode(), content_type=content_type)
+
+    def test_csv_rows_are_written_and_failures_reported_by_line(self):
+        response = self.post(self.header + ''.join([
+            'I1,Import one,KA,+0-I1,1000,30,10,10\n',
+            'I2,Import two,KA,%s,1000,30,10,10\n' % ('9' * 30),   # over max_length
+            'I3,Import three,KA,+91-22,1000,30,10,10\n',          # Mumbai's phone code
+            'I4,Import four,KA,+0-I4,1000,old,10,10\n',           # not a number
+            'I5,Import five,KA,+0-I5,1000,30,10,10\n',
+        ]))
+        self.assertEqual(response.status_code, 200, response.content)
+        report = response.json()
+        self.assertEqual(report['totals'], {'created': 2, 'updated': 0, 'unchanged': 0, 'error': 3})
+        self.assertEqual([(error['line'], list(error['errors'])) for error in report['errors']],
+                         [(3, ['phone_code']), (4, ['phone_code']), (5, ['avg_age'])])
+        self.assertNotIn('UNIQUE', json.dumps(report))
+        self.assertEqual(set(CityModel.objects.filter(city_code__startswith='I').values_list('city_code', flat=True)), {'I1', 'I5'})
+
+    def test_importing_twice_updates(self):
+        body = self.header + 'I1,Import one,KA,+0-I1,1000,30,10,10\n'
+        self.post(body)
+        self.assertEqual(self.post(body).json()['totals']['unchanged'], 1)
+
+    def test_ndjson_bad_lines(self):
+        response = self.post('{"city_code": "I1", "name": "Import one"}\nnot json\n[1]\n', 'application/x-ndjson')
+        self.assertEqual(sorted(error['line'] for error in response.json()['errors']), [1, 2, 3])
+
+    def test_unknown_format_is_a_415(self):
+        self.assertEqual(self.post('x', 'text/plain').status_code, 415)
+
+
+class ExportTests(GeoTestCase):
+    def export(self, output):
+        response = self.get('/api/export/?output=' + output)
+        self.assertEqual(response.status_code, 200)
+        return self.streamed(response).decode()
+
+    def test_csv_has_a_row_per_city_and_per_empty_parent(self):
+        CountryModel.objects.create(**country_data('E1'))
+        rows = list(csv.DictReader(io.StringIO(self.export('csv'))))
+        self.assertEqual(len(rows), CityModel.objects.count() + 1)
+        self.assertEqual(list(rows[0]), exports.COLUMN_NAMES)
+        empty = [row for row in rows if row['country_code'] == 'E1']
+        self.assertEqual((empty[0]['state_code'], empty[0]['city_code']), ('', ''))
+
+    def test_formats_carry_the_same_rows(self):
+        ndjson = [json.loads(line) for line in self.export('ndjson').splitlines()]
+        lines = self.export('columnar').splitlines()
+        columns = json.loads(lines[0])['columns']
+        columnar = [dict(zip(columns, row)) for chunk in lines[1:] for row in zip(*json.loads(chunk))]
+        self.assertEqual(ndjson, columnar)
+        self.assertEqual(sorted(row['city_code'] for row in ndjson), sorted(CityModel.objects.values_list('city_code', flat=True)))
+
+    def test_chunk_size_does_not_change_the_output(self):
+        whole = b''.join(exports.export_stream('ndjson'))
+        self.assertEqual(b''.join(exports.export_stream('ndjson', chunk_size=1)), whole)
+
+    def test_unknown_output_is_a_400(self):
+        self.assertEqual(self.get('/api/export/?output=xml').status_code, 400)
+
+    def test_asgi_export_is_pulled_chunk_by_chunk(self):
+        pulled = []
+
+        def stream(export_format):
+            for piece in exports.export_stream(export_format, chunk_size=1):
+                pulled.append(piece)
+                yield piece
+
+        token = Token.objects.get_or_create(user=self.user)[0].key
+        request = AsyncRequestFactory().get('/api/export/?output=ndjson', headers={'Authorization': 'Token ' + token})
+        with mock.patch('ex1.views.export_stream', stream):
+            response = views.ExportView.as_view()(request)
+        self.assertTrue(response.is_async)
+        self.assertEqual(pulled, [])
+
+        async def read():
+            content = aiter(response.streaming_content)
+            first = await anext(content)
+            pulled_then = len(pulled)
+            return first, pulled_then, first + b''.join([piece async for piece in content])
+
+        first, pulled_then, body = async_to_sync(read)()
+        self.assertEqual(pulled_then, 1)      # the rest is still in the db cursor
+        self.assertEqual(first.count(b'\n'), 1)
+        self.assertGreater(len(pulled), 1)
+        self.assertEqual(body, b''.join(exports.export_stream('ndjson')))
+
+
+class StatsTests(GeoTestCase):
+    def test_country_totals_match_its_cities(self):
+        data = self.get('/api/countries/US/stats/').json()
+        cities = CityModel.objects.filter(state__country__country_code='US')
+        self.assertEqual(data['city_count'], cities.count())
+        self.assertEqual(data['population'], sum(city.population for city in cities))
+        self.assertEqual(data['state_count'], 3)
+        self.assertEqual(len(data['states']), 3)
+
+    def test_rollups_and_cities_agree(self):
+        urls = ['/api/countries/US/stats/?ordering=-population', '/api/countries/IN/states/MH/stats/']
+        for url in urls:
+            from_rollups = self.get(url).json()
+            with mock.patch('ex1.stats.STATS_FROM_ROLLUPS', False):
+                from_cities = self.get(url).json()
+            self.assertEqual(from_rollups, from_cities, url)
+
+    def test_filter_and_ordering(self):
+        states = self.get('/api/countries/US/stats/?ordering=-population').json()['states']
+        populations = [state['population'] for state in states]
+        self.assertEqual(populations, sorted(populations, reverse=True))
+        bound = populations[1]
+        states = self.get('/api/countries/US/stats/?min_population=%d' % bound).json()['states']
+        self.assertEqual(len(states), 2)
+
+    def test_bad_parameters(self):
+        self.assertEqual(self.get('/api/countries/US/stats/?ordering=nope').status_code, 400)
+        self.assertEqual(self.get('/api/countries/US/stats/?min_population=x').status_code, 400)
+        self.assertEqual(self.get('/api/countries/ZZ/stats/').status_code, 404)
+
+
+class RollupTests(GeoTestCase):
+    def assert_in_sync(self):
+        for _, model, key, group_by in rebuild_rollups.ROLLUPS:
+            self.assertEqual(rollups.check_rollups(model, key, group_by), {}, model.__name__)
+
+    def test_writes_keep_the_rollups_in_sync(self):
+        ka = StateModel.objects.get(state_code='KA')
+        responses = [
+            self.request('post', '/api/countries/IN/states/KA/cities/', {**self.city_data('R1'), 'state': str(ka.pk)}),
+            self.request('patch', '/api/countries/IN/states/KA/cities/R1/', {'population': 5000}),
+            self.request('post', '/api/upsert/cities/', [
+                {'city_code': 'R1', 'state_code': 'MH'},                      # moves to another state
+                {**self.city_data('R2'), 'state_code': 'CA'},
+            ]),
+            self.request('post', '/api/upsert/states/', [{'state_code': 'KA', 'country_code': 'US'}]),   # another country
+            self.request('post', '/api/nested/countries/', nested_payload('RA', 2, 2)),
+            self.request('delete', '/api/countries/US/states/TX/'),             # with its cities
+        ]
+        self.assertEqual([response.status_code for response in responses], [201, 200, 200, 200, 201, 204])
+        self.assertEqual(CityModel.objects.get(city_code='R1').state.state_code, 'MH')
+        self.assertEqual(StateModel.objects.get(state_code='KA').country.country_code, 'US')
+        self.assert_in_sync()
+        self.assertEqual(StateRollup.objects.get(state__state_code='MH').population,
+                         sum(CityModel.objects.filter(state__state_code='MH').values_list('population', flat=True)))
+
+    def test_drift_is_found_and_repaired(self):
+        CityModel.objects.filter(city_code='MUM').update(population=1)   # around the ORM signals
+        out = io.StringIO()
+        with self.assertRaises(CommandError):
+            call_command('rebuild_rollups', '--check', stdout=out)
+        call_command('rebuild_rollups', stdout=out)
+        self.assertIn('states: 1 repaired', out.getvalue())
+        self.assert_in_sync()
+
+
+class SnapshotTests(GeoTestCase):
+    url = '/api/countries/IN/states/MH/cities/MUM/'
+
+    def fresh_get(self, url):
+        response_cache.response_cache.clear()   # past the response cache, to the snapshot
+        return self.get(url)
+
+    @mock.patch('ex1.etags.ETAGS_ENABLED', False)
+    def test_lookups_after_the_build_read_only_the_version(self):
+        self.fresh_get(self.url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.fresh_get('/api/countries/IN/states/MH/cities/PUN/')
+        self.assertEqual(response.json()['city_code'], 'PUN')
+        self.assertEqual([query['sql'] for query in queries.captured_queries if 'geoversion' not in query['sql']], [])
+
+    def test_write_moves_the_version(self):
+        self.fresh_get(self.url)
+        self.request('patch', self.url, {'name': 'Bombay'})
+        self.assertEqual(self.fresh_get(self.url).json()['name'], 'Bombay')
+
+    def test_writes_that_do_not_bump_show_after_max_age(self):
+        self.fresh_get(self.url)
+        CityModel.objects.filter(city_code='MUM').update(name='Bombay')
+        self.assertEqual(self.fresh_get(self.url).json()['name'], 'Mumbai')
+        with mock.patch('ex1.snapshot.time.monotonic', return_value=time.monotonic() + snapshot.SNAPSHOT_MAX_AGE + 1):
+            self.assertEqual(self.fresh_get(self.url).json()['name'], 'Bombay')
+
+    def test_missing_row_is_a_404(self):
+        self.fresh_get(self.url)
+        self.assertEqual(self.fresh_get('/api/countries/IN/states/MH/cities/ZZZ/').status_code, 404)
+
+
+class SearchTests(GeoTestCase):
+    def search(self, query, **params):
+        return self.get('/api/search/cities/', data={'q': query, **params})
+
+    def codes(self, response):
+        return [city['city_code'] for city in response.json()]
+
+    def test_prefix_is_ranked_by_population(self):
+        state = StateModel.objects.get(state_code='KA')
+        for code, population in (('MY1', 5000), ('MY2', 9000)):
+            CityModel.objects.create(state=state, **self.city_data(code, name='Quill ' + code, population=population))
+        self.assertEqual(self.codes(self.search('qui')), ['MY2', 'MY1'])
+
+    def test_fuzzy_finds_typos(self):
+        self.assertIn('MUM', self.codes(self.search('mumbay', fuzzy=1)))
+        self.assertEqual(self.codes(self.search('mumbay')), [])
+
+    def test_bad_parameters(self):
+        self.assertEqual(self.search(' ').status_code, 400)
+        self.assertEqual(self.search('mu', limit=0).status_code, 400)
+
+    def test_writes_of_another_worker_come_from_the_log(self):
+        index = search.get_index()
+        state = StateModel.objects.get(state_code='KA')
+        # no on-commit callbacks: this worker's index isn't told, like a write made elsewhere
+        CityModel.objects.create(state=state, **self.city_data('MY1', name='Quillon'))
+        CityModel.objects.filter(city_code='MUM').delete()
+        with mock.patch('ex1.search.start_rebuild') as rebuild:
+            self.assertEqual(self.codes(self.search('quillon')), ['MY1'])
+            self.assertEqual(self.codes(self.search('mumbai')), [])
+        rebuild.assert_not_called()
+        self.assertIs(search.get_index(), index)
+
+    def test_index_behind_the_log_is_rebuilt(self):
+        search.get_index()
+        CityModel.objects.create(state=StateModel.objects.get(state_code='KA'), **self.city_data('MY1', name='Quillon'))
+        with mock.patch('ex1.search.LOG_VERSIONS', 0), mock.patch('ex1.search.start_rebuild') as rebuild:
+            search.get_index()
+        rebuild.assert_called_once()
+
+    def test_log_is_pruned(self):
+        state = StateModel.objects.get(state_code='KA')
+        with mock.patch('ex1.search.LOG_VERSIONS', 2):
+            for i in range(5):
+                CityModel.objects.create(state=state, **self.city_data('MY%d' % i, name='Quillon %d' % i))
+        versions = sorted(CityChange.objects.values_list('version', flat=True))
+        self.assertEqual(len(versions), 2)
+        self.assertEqual(versions[-1], snapshot.read_version())
+
+    def test_version_is_not_bumped_when_nothing_reads_it(self):
+        before = snapshot.read_version()
+        with mock.patch('ex1.snapshot.VERSION_READ', False), self.assertNumQueries(0):
+            snapshot.bump_version()
+        self.assertEqual(snapshot.read_version(), before)
+
+
+class PathTests(GeoTestCase):
+    def test_state_moving_country_updates_its_cities(self):
+        ka = StateModel.objects.get(state_code='KA')
+        ka.country = CountryModel.objects.get(country_code='US')
+        with self.captureOnCommitCallbacks(execute=True):
+            ka.save()
+        self.assertEqual(set(CityModel.objects.filter(state=ka).values_list('state_code', 'country_code')), {('KA', 'US')})
+        self.assertEqual(self.get('/api/countries/US/states/KA/cities/').status_code, 200)
+        self.assertEqual(self.get('/api/countries/IN/states/KA/cities/MYS/').status_code, 404)
+
+    def test_cascade_is_one_update(self):
+        states = list(StateModel.objects.filter(state_code__in=['KA', 'MH']))
+        StateModel.objects.filter(pk__in=[state.pk for state in states]).update(country_code='XX')
+        with self.assertNumQueries(1):
+            StateModel.cascade_paths(states)
+        self.assertEqual(set(CityModel.objects.filter(state__in=states).values_list('country_code', flat=True)), {'XX'})
+        self.assertEqual(CityModel.objects.filter(country_code='XX').count(), 4)
+
+    def test_city_moving_state_updates_its_path(self):
+        ca = StateModel.objects.get(state_code='CA')
+        city = CityModel.objects.get(city_code='MUM')
+        city.state = ca
+        city.population = 10 ** 7
+        with self.captureOnCommitCallbacks(execute=True):
+            city.save()
+        self.assertEqual(CityModel.objects.filter(pk=city.pk).values_list('state_code', 'country_code').get(), ('CA', 'US'))
+        self.assertEqual(self.get('/api/countries/US/states/CA/cities/MUM/').status_code, 200)
+
+    def test_city_saved_without_being_loaded(self):
+        # built with its pk: the old state and the rollup columns come from its row
+        row = CityModel.objects.filter(city_code='PUN').values().get()
+        city = CityModel(**{**row, 'state_id': StateModel.objects.get(state_code='KA').pk, 'population': 10 ** 7})
+        city._state.adding = False
+        with self.captureOnCommitCallbacks(execute=True):
+            city.save()
+        self.assertEqual(CityModel.objects.filter(pk=city.pk).values_list('state_code', 'country_code').get(), ('KA', 'IN'))
+        for _, model, key, group_by in rebuild_rollups.ROLLUPS:
+            self.assertEqual(rollups.check_rollups(model, key, group_by), {}, model.__name__)
+
+
+class IdTests(GeoTestCase):
+    def test_uuid7_keys_are_ordered_and_unique(self):
+        keys = [ids.uuid7() for _ in range(5000)]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(set(keys)), len(keys))
+        self.assertEqual({(key.version, key.variant) for key in keys}, {(7, uuid.RFC_4122)})
+        self.assertLess(abs((keys[0].int >> 80) - time.time_ns() // 1000000), 1000)
+
+    def test_same_millisecond_and_clock_going_back(self):
+        with mock.patch('ex1.ids.time.time_ns', return_value=ids._last_ms * 1000000 + 10 ** 9):
+            keys = [ids.uuid7() for _ in range(5000)]   # more than the 4096 counter values of a millisecond
+        with mock.patch('ex1.ids.time.time_ns', return_value=0):
+            keys.append(ids.uuid7())
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(set(keys)), len(keys))
+
+    def test_new_rows_get_uuid7_keys(self):
+        city = CityModel.objects.create(state=StateModel.objects.get(state_code='KA'), **self.city_data('ID1'))
+        self.assertEqual(city.pk.version, 7)
+        with override_settings(PRIMARY_KEY_UUID='uuid4'):
+            self.assertEqual(ids.new_id().version, 4)
+
+
+class SqliteTests(GeoTestCase):
+    def open_connection(self):
+        # a connection of its own to a file db (the test db is in memory, where there's no WAL)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        wrapper = type(connections['default'])({**connection.settings_dict, 'NAME': os.path.join(directory.name, 'test.sqlite3')}, 'pragmas')
+        self.addCleanup(wrapper.close)
+        wrapper.ensure_connection()
+        return wrapper
+
+    def pragma(self, wrapper, name):
+        with wrapper.cursor() as cursor:
+            cursor.execute('PRAGMA %s' % name)
+            return cursor.fetchone()[0]
+
+    def test_pragmas_are_applied_to_new_connections(self):
+        wrapper = self.open_connection()
+        self.assertEqual(self.pragma(wrapper, 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma(wrapper, 'synchronous'), 1)        # NORMAL
+        self.assertEqual(self.pragma(wrapper, 'busy_timeout'), settings.SQLITE_PRAGMAS['busy_timeout'])
+        self.assertEqual(self.pragma(wrapper, 'cache_size'), settings.SQLITE_PRAGMAS['cache_size'])
+
+    @override_settings(SQLITE_PRAGMAS={})
+    def test_no_pragmas_keeps_the_defaults(self):
+        wrapper = self.open_connection()
+        self.assertEqual(self.pragma(wrapper, 'journal_mode'), 'delete')
+        self.assertEqual(self.pragma(wrapper, 'synchronous'), 2)        # FULL
+
+    def test_other_databases_are_left_alone(self):
+        other = mock.Mock(vendor='postgresql')
+        sqlite.configure_connection(other)
+        other.cursor.assert_not_called()
+        self.assertEqual(sqlite.pragma_statements({'synchronous': 'normal'}), ['PRAGMA synchronous = normal'])
+
+
+class ReplicaTests(GeoTestCase):
+    def routed(self, replica, wrote=False):
+        routing = replicas.RequestRouting()
+        routing.replica, routing.wrote = replica, wrote
+        token = replicas._routing.set(routing)
+        self.addCleanup(replicas._routing.reset, token)
+
+    def test_version_is_read_where_the_request_reads(self):
+        self.routed('replica')
+        self.assertEqual(snapshot._version_query().db, 'replica')
+        self.assertEqual(snapshot._version_query('default').db, 'default')
+        replicas._routing.get().wrote = True
+        self.assertEqual(snapshot._version_query().db, 'default')
+
+    def test_an_older_version_keeps_the_newer_snapshot(self):
+        current = snapshot.current_snapshot(5)
+        self.assertIs(snapshot.current_snapshot(4), current)      # a replica lagging behind
+        self.assertIsNot(snapshot.current_snapshot(6), current)
+
+    def test_replicas_need_a_shared_pin_cache(self):
+        with self.assertRaises(ImproperlyConfigured):
+            replicas.pin_cache({'DATABASES': ['replica'], 'ALIAS': None})
+        self.assertIsInstance(replicas.pin_cache({'DATABASES': ['replica'], 'ALIAS': 'default'}), DjangoCache)
+        self.assertIsInstance(replicas.pin_cache({'DATABASES': []}), LRUCache)
+
+    def test_writer_is_pinned_to_the_primary(self):
+        pins = DjangoCache('default', prefix='ex1:test-pin:')
+        self.addCleanup(django_caches['default'].clear)
+        with mock.patch('ex1.replicas.REPLICA_DATABASES', ['replica']), mock.patch('ex1.replicas._pins', pins):
+            self.assertFalse(replicas.is_pinned(self.user))
+            self.request('patch', '/api/countries/IN/states/KA/', {'name': 'Karnataka state'})
+            self.assertTrue(replicas.is_pinned(self.user))
+
+    def test_no_pins_without_replicas(self):
+        self.request('patch', '/api/countries/IN/states/KA/', {'name': 'Karnataka state'})
+        self.assertFalse(replicas.is_pinned(self.user))
+
+
+class OffLoopCache(DjangoCache):
+    # a shared cache that fails when it is read on the event loop
+    def __init__(self, prefix):
+        super().__init__('default', prefix=prefix)
+        self.reads = 0
+
+    def get(self, key, default=None):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.reads += 1
+            return super().get(key, default)
+        raise AssertionError('blocking cache read on the event loop')
+
+
+class AsyncReadTests(GeoTestCase):
+    url = '/api/countries/IN/states/MH/cities/MUM/'
+
+    def async_get(self, view_class, url, token=None, **kwargs):
+        with mock.patch('ex1.async_reads.ASYNC_READS', True):
+            view = view_class.as_view()
+        self.assertTrue(iscoroutinefunction(view))
+        token = token or Token.objects.get_or_create(user=self.user)[0].key
+        request = AsyncRequestFactory().get(url, headers={'Authorization': 'Token ' + token})
+        return async_to_sync(view)(request, **kwargs)
+
+    def shared_caches(self):
+        caches = [OffLoopCache('ex1:test-%s:' % name) for name in ('token', 'geo', 'pin')]
+        self.addCleanup(django_caches['default'].clear)
+        for target, cache in zip(('ex1.authentication.token_cache', 'ex1.response_cache.response_cache', 'ex1.replicas._pins'), caches):
+            patcher = mock.patch(target, cache)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return caches
+
+    def test_sync_views_by_default(self):
+        self.assertFalse(settings.GEO_ASYNC_READS)
+        self.assertFalse(iscoroutinefunction(resolve(self.url).func))
+        response = self.get('/api/nested/countries/?stream=1')
+        self.assertFalse(response.is_async)
+        self.assertEqual({row['country_code'] for row in json.loads(self.streamed(response))}, {'US', 'IN'})
+
+    def test_async_view_reads_shared_caches_in_a_thread(self):
+        token_cache, geo_cache, pins = self.shared_caches()
+        pins.set(str(self.user.pk), True)      # stays on the primary
+        routing = replicas.RequestRouting()
+        token = replicas._routing.set(routing)
+        self.addCleanup(replicas._routing.reset, token)
+        kwargs = {'country_code': 'IN', 'state_code': 'MH', 'city_code': 'MUM'}
+        with mock.patch('ex1.replicas.REPLICA_DATABASES', ['replica']):
+            first = self.async_get(views.CityRetrieveUpdateDestroyView, self.url, **kwargs)
+            second = self.async_get(views.CityRetrieveUpdateDestroyView, self.url, **kwargs)
+        self.assertEqual([first.status_code, second.status_code], [200, 200])
+        self.assertEqual(json.loads(second.content)['name'], 'Mumbai')
+        self.assertIsNone(routing.replica)
+        self.assertEqual([token_cache.reads, pins.reads], [2, 2])
+        self.assertEqual(geo_cache.reads, 2)
+
+    def test_async_view_rejects_a_bad_token(self):
+        token_cache, _, _ = self.shared_caches()
+        response = self.async_get(views.CityRetrieveUpdateDestroyView, self.url, token='nope',
+                                  country_code='IN', state_code='MH', city_code='MUM')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(token_cache.reads, 1)
+        self.assertIsNone(token_cache.get('nope'))
+
+    def test_async_stream(self):
+        response = self.async_get(views.NestedCountryListCreateView, '/api/nested/countries/?stream=1')
+        self.assertTrue(response.is_async)
+        self.assertEqual({row['country_code'] for row in json.loads(self.streamed(response))}, {'US', 'IN'})
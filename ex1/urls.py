@@ -1,10 +1,13 @@
 from django.urls import path
 from .views import (
-    CustomObtainAuthToken, SignOutView, UserListView, UserCreateView, UserRetrieveUpdateDestroyView,
+    CustomObtainAuthToken, SignInStatsView, SignOutView, UserListView, UserCreateView, UserRetrieveUpdateDestroyView,
     CountryListCreateView, CountryRetrieveUpdateDestroyView,
     StateListCreateView, StateRetrieveUpdateDestroyView,
     CityListCreateView, CityRetrieveUpdateDestroyView,
-    NestedCountryListCreateView, NestedCountryRetrieveUpdateDestroyView
+    NestedCountryListCreateView, NestedCountryRetrieveUpdateDestroyView,
+    CountryUpsertView, StateUpsertView, CityUpsertView,
+    StateImportView, CityImportView, ExportView,
+    CountryStatsView, StateStatsView, CitySearchView
 )
 from django.urls import path
 
@@ -13,6 +16,7 @@ app_name = 'ex1'
 urlpatterns = [
     # auth
     path('auth/signin/', CustomObtainAuthToken.as_view(), name='auth-signin'),
+    path('auth/signin/stats/', SignInStatsView.as_view(), name='auth-signin-stats'),
     path('auth/signout/', SignOutView.as_view(), name='auth-signout'),
     
     # user
@@ -24,13 +28,30 @@ urlpatterns = [
     path('nested/countries/', NestedCountryListCreateView.as_view(), name='nested-country-list-create'),
     path('nested/countries/<str:country_code>/', NestedCountryRetrieveUpdateDestroyView.as_view(), name='nested-country-retrieve-update-destroy'),
 
+    # bulk upserts keyed on country_code / state_code / city_code
+    path('upsert/countries/', CountryUpsertView.as_view(), name='country-upsert'),
+    path('upsert/states/', StateUpsertView.as_view(), name='state-upsert'),
+    path('upsert/cities/', CityUpsertView.as_view(), name='city-upsert'),
+
+    # CSV / NDJSON imports, same keys as the upserts
+    path('import/states/', StateImportView.as_view(), name='state-import'),
+    path('import/cities/', CityImportView.as_view(), name='city-import'),
+
+    # city name search, prefix or fuzzy
+    path('search/cities/', CitySearchView.as_view(), name='city-search'),
+
+    # full dump, streamed
+    path('export/', ExportView.as_view(), name='export'),
+
     # Individual entity endpoints
     path('countries/', CountryListCreateView.as_view(), name='country-list-create'),
     path('countries/<str:country_code>/', CountryRetrieveUpdateDestroyView.as_view(), name='country-retrieve-update-destroy'),
+    path('countries/<str:country_code>/stats/', CountryStatsView.as_view(), name='country-stats'),
 
     # state
     path('countries/<str:country_code>/states/', StateListCreateView.as_view(), name='state-list-create'),
     path('countries/<str:country_code>/states/<str:state_code>/', StateRetrieveUpdateDestroyView.as_view(), name='state-retrieve-update-destroy'),
+    path('countries/<str:country_code>/states/<str:state_code>/stats/', StateStatsView.as_view(), name='state-stats'),
 
     # city
     path('countries/<str:country_code>/states/<str:state_code>/cities/', CityListCreateView.as_view(), name='city-list-create'),
@@ -41,13 +41,56 @@ from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.authtoken.models import Token
 from rest_framework.views import APIView
 from rest_framework import permissions
-from rest_framework import authentication
+from .authentication import CachedTokenAuthentication
+from .prefetch import QueryPlanMixin
+from .response_cache import CachedResponseMixin
+from .streaming import StreamingListMixin, streaming_response
+from .fastread import FastReadMixin
+from .snapshot import SnapshotMixin
+from .queries import upsert_countries, upsert_states, upsert_cities
+from .hashing import password_pool
+from .imports import READERS, import_format, import_rows
+from .exports import CONTENT_TYPES, STREAMS, export_stream
+from .stats import METRICS, filter_and_order, metrics
+from .search import TOP_K, search_cities
+from .rollups import RollupBatchMixin
+from .replicas import ReplicaReadMixin
+from .async_reads import AsyncCursorPaginationMixin, AsyncReadMixin
+from django.db.models import Count
+from rest_framework.exceptions import NotFound, UnsupportedMediaType
+from rest_framework.parsers import MultiPartParser
+from django.conf import settings
+
+# POST a list instead of a single object to create many rows at once
+# the list is validated as one batch (see BatchUniqueListSerializer) and written with bulk_create
+class BulkCreateMixin:
+    def get_serializer(self, *args, **kwargs):
+        if isinstance(kwargs.get('data'), list):
+            kwargs['many'] = True
+        return super().get_serializer(*args, **kwargs)
+
+
+# Cursor pagination for the geography lists, ordered on (name, id)
+# ?cursor= is DRF's: the name of the last row of the previous page plus an offset past the rows
+# that share that name, so a page is a name > position range scan on the (name, id) /
+# (country, name, id) / (state, name, id) indexes that skips at most the repeated names - no
+# COUNT(*), no OFFSET growing with the page number. id only makes the order total.
+# ?page_size= overrides GEO_PAGE_SIZE, up to GEO_MAX_PAGE_SIZE
+class GeoCursorPagination(AsyncCursorPaginationMixin, CursorPagination):
+    page_size = getattr(settings, 'GEO_PAGE_SIZE', 100)
+    page_size_query_param = 'page_size'
+    max_page_size = getattr(settings, 'GEO_MAX_PAGE_SIZE', 1000)
+    ordering = ('name', 'id')
+
 
 # Auth - Token based signin/signout for CustomUser model
 # https://www.django-rest-framework.org/api-guide/authentication/
 
 # POST /signin/  with {username, password} in body
+# the password check runs in a bounded pool (hashing.py), 503 when too many are already waiting
 class CustomObtainAuthToken(ObtainAuthToken):
+    serializer_class = SignInSerializer
+
     def post(self, request, *args, **kwargs):
         serializer = self.serializer_class(data=request.data, context={'request': request})
         serializer.is_valid(raise_exception=True)
@@ -59,21 +102,33 @@ class CustomObtainAuthToken(ObtainAuthToken):
             'email': user.email
         })
 
+# GET /signin/stats/ - queue depth and timings of the signin hashing pool
+class SignInStatsView(APIView):
+    def get(self, request):
+        return Response(password_pool.stats())
+
 # POST /signout/ with 'Authorization: Token <user-token>' in headers
 class SignOutView(APIView):
     def post(self, request):
         if request.auth:
+            # the post_delete signal evicts it from the token cache too (signals.py)
             request.auth.delete()
             return Response({'detail': 'Signed out successfully.'}, status=status.HTTP_200_OK)
         return Response({'detail': 'Not authenticated.'}, status=status.HTTP_400_BAD_REQUEST)
 
 
 
+# GET lists are built from .values() rows instead of the serializers when they allow it (fastread.py)
+# GET endpoints of the geography views send an ETag, a request with a matching If-None-Match
+# gets an empty 304 (see etags.py). etag_related/etag_children list what else shows up in a detail row.
+# Under ASGI their GETs run as async views (async_reads.py), the other methods as before
+
 # GET/POST /countries/
-class CountryListCreateView(generics.ListCreateAPIView):
-    authentication_classes = [authentication.TokenAuthentication]
+class CountryListCreateView(ReplicaReadMixin, CachedResponseMixin, FastReadMixin, QueryPlanMixin, BulkCreateMixin, AsyncReadMixin, generics.ListCreateAPIView):
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = CountrySerializer
+    pagination_class = GeoCursorPagination
         
     def get_queryset(self):
         return CountryModel.objects.all()
@@ -82,23 +137,26 @@ class CountryListCreateView(generics.ListCreateAPIView):
         serializer.save(my_user=self.request.user)
 
 # GET/PUT/DELETE /countries/<country_code>/
-class CountryRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
-    authentication_classes = [authentication.TokenAuthentication]
+class CountryRetrieveUpdateDestroyView(ReplicaReadMixin, RollupBatchMixin, CachedResponseMixin, SnapshotMixin, QueryPlanMixin, AsyncReadMixin, generics.RetrieveUpdateDestroyAPIView):
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = CountrySerializer
+    snapshot_key = {'country_code': 'country_code'}
     lookup_field = 'country_code'
     
     def get_queryset(self):
         return CountryModel.objects.all()
 
-class StateListCreateView(generics.ListCreateAPIView):
-    authentication_classes = [authentication.TokenAuthentication]
+class StateListCreateView(ReplicaReadMixin, RollupBatchMixin, CachedResponseMixin, FastReadMixin, QueryPlanMixin, BulkCreateMixin, AsyncReadMixin, generics.ListCreateAPIView):
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = StateSerializer
+    pagination_class = GeoCursorPagination
+    etag_related = ('country',)
     
     def get_queryset(self):
         country_code = self.kwargs.get('country_code')
-        return StateModel.objects.filter(country__country_code=country_code)
+        return StateModel.objects.filter(country_code=country_code)
     
     def get_serializer_context(self):
         context = super().get_serializer_context()
@@ -106,41 +164,47 @@ class StateListCreateView(generics.ListCreateAPIView):
         context['country_code'] = country_code
         return context
 
-class StateRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
-    authentication_classes = [authentication.TokenAuthentication]
+class StateRetrieveUpdateDestroyView(ReplicaReadMixin, RollupBatchMixin, CachedResponseMixin, SnapshotMixin, QueryPlanMixin, AsyncReadMixin, generics.RetrieveUpdateDestroyAPIView):
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = StateSerializer
+    etag_related = ('country',)
+    snapshot_key = {'country_code': 'country_code', 'state_code': 'state_code'}
     lookup_field = 'state_code'
     
     def get_queryset(self):
         country_code = self.kwargs.get('country_code')
-        return StateModel.objects.filter(country__country_code=country_code)
+        return StateModel.objects.filter(country_code=country_code)
 
-class CityListCreateView(generics.ListCreateAPIView):
-    authentication_classes = [authentication.TokenAuthentication]
+class CityListCreateView(ReplicaReadMixin, RollupBatchMixin, CachedResponseMixin, FastReadMixin, QueryPlanMixin, BulkCreateMixin, AsyncReadMixin, generics.ListCreateAPIView):
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = CitySerializer
+    pagination_class = GeoCursorPagination
+    etag_related = ('state',)
     
     def get_queryset(self):
         country_code = self.kwargs.get('country_code')
         state_code = self.kwargs.get('state_code')
         return CityModel.objects.filter(
-            state__state_code=state_code, 
-            state__country__country_code=country_code
+            country_code=country_code,
+            state_code=state_code,
         )
 
-class CityRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
-    authentication_classes = [authentication.TokenAuthentication]
+class CityRetrieveUpdateDestroyView(ReplicaReadMixin, RollupBatchMixin, CachedResponseMixin, SnapshotMixin, QueryPlanMixin, AsyncReadMixin, generics.RetrieveUpdateDestroyAPIView):
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = CitySerializer
+    etag_related = ('state',)
+    snapshot_key = {'country_code': 'country_code', 'state_code': 'state_code', 'city_code': 'city_code'}
     lookup_field = 'city_code'
     
     def get_queryset(self):
         country_code = self.kwargs.get('country_code')
         state_code = self.kwargs.get('state_code')
         return CityModel.objects.filter(
-            state__state_code=state_code, 
-            state__country__country_code=country_code
+            country_code=country_code,
+            state_code=state_code,
         )
 
 
@@ -148,8 +212,8 @@ class UserCursorPagination(CursorPagination):
     page_size = 2
     ordering = 'email'
 
-class UserListView(generics.ListAPIView):
-    authentication_classes = [authentication.TokenAuthentication]
+class UserListView(ReplicaReadMixin, generics.ListAPIView):
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     queryset = CustomUser.objects.all()
     serializer_class = UserSerializer
@@ -161,30 +225,175 @@ class UserCreateView(generics.CreateAPIView):
     permission_classes = [permissions.AllowAny]
 
 class UserRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
-    authentication_classes = [authentication.TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     queryset = CustomUser.objects.all()
     serializer_class = UserSerializer
     lookup_field = 'id'
 
 
-class NestedCountryListCreateView(generics.ListCreateAPIView):
-    authentication_classes = [authentication.TokenAuthentication]
+# GET /nested/countries/?stream=1 - every country with its states and cities, streamed (streaming.py)
+class NestedCountryListCreateView(ReplicaReadMixin, StreamingListMixin, CachedResponseMixin, FastReadMixin, QueryPlanMixin, AsyncReadMixin, generics.ListCreateAPIView):
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = NestedCountrySerializer
+    pagination_class = GeoCursorPagination
+    etag_children = ('states', 'states__cities')
     
     def get_queryset(self):
-        return CountryModel.objects.all().prefetch_related('states__cities')
+        return CountryModel.objects.all()
     
     def perform_create(self, serializer):
         serializer.save(my_user=self.request.user)
 
 
-class NestedCountryRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
-    authentication_classes = [authentication.TokenAuthentication]
+class NestedCountryRetrieveUpdateDestroyView(ReplicaReadMixin, RollupBatchMixin, CachedResponseMixin, QueryPlanMixin, AsyncReadMixin, generics.RetrieveUpdateDestroyAPIView):
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = NestedCountrySerializer
+    etag_children = ('states', 'states__cities')
     lookup_field = 'country_code'
     
     def get_queryset(self):
-        return CountryModel.objects.all().prefetch_related('states__cities')
\ No newline at end of file
+        return CountryModel.objects.all()
+
+
+# Upserts - POST a list of rows keyed on their natural code, existing rows are updated, new ones created
+# responds with a status per row (created/updated/unchanged/error) and the totals
+# see queries.py for how the rows are matched
+class UpsertView(APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+    upsert = None
+
+    def post(self, request):
+        if not isinstance(request.data, list):
+            return Response({'detail': 'Expected a list of items.'}, status=status.HTTP_400_BAD_REQUEST)
+        # rows that clash with stored ones come back with status error, the others are written
+        results = type(self).upsert(request)
+        totals = {key: 0 for key in ('created', 'updated', 'unchanged', 'error')}
+        for result in results:
+            totals[result['status']] += 1
+        return Response({'totals': totals, 'results': results}, status=status.HTTP_200_OK)
+
+# POST /upsert/countries/
+class CountryUpsertView(UpsertView):
+    upsert = upsert_countries
+
+# POST /upsert/states/ - rows carry country_code
+class StateUpsertView(UpsertView):
+    upsert = upsert_states
+
+# POST /upsert/cities/ - rows carry state_code
+class CityUpsertView(UpsertView):
+    upsert = upsert_cities
+
+
+# Imports - POST a CSV or NDJSON file, as the raw body (Content-Type: text/csv / application/x-ndjson)
+# or as the `file` field of a multipart form; read as a stream and written in batches (imports.py)
+# responds with the totals and the rows that failed, with their line number
+class ImportView(APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+    # only multipart is parsed, a raw body is read straight from request.stream
+    parser_classes = [MultiPartParser]
+    model = None
+
+    def post(self, request):
+        if request.content_type.startswith('multipart/form-data'):
+            upload = request.FILES.get('file')
+            if upload is None:
+                return Response({'detail': 'Expected a `file` field.'}, status=status.HTTP_400_BAD_REQUEST)
+            lines, file_format = upload, import_format(upload.content_type or '', upload.name)
+        else:
+            lines, file_format = request.stream or [], import_format(request.content_type)
+        if file_format is None:
+            raise UnsupportedMediaType(request.content_type)
+
+        report = import_rows(self.model, READERS[file_format](lines))
+        return Response(report, status=status.HTTP_200_OK)
+
+# POST /import/states/ - rows carry country_code
+class StateImportView(ImportView):
+    model = StateModel
+
+# POST /import/cities/ - rows carry state_code
+class CityImportView(ImportView):
+    model = CityModel
+
+
+# GET /export/?output=csv|ndjson|columnar - every country, state and city in one streamed file (exports.py)
+class ExportView(APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        export_format = request.query_params.get('output', 'csv')
+        if export_format not in STREAMS:
+            return Response({'detail': 'output must be one of: %s.' % ', '.join(STREAMS)}, status=status.HTTP_400_BAD_REQUEST)
+        response = streaming_response(request, export_stream(export_format), CONTENT_TYPES[export_format])
+        extension = 'csv' if export_format == 'csv' else 'ndjson'
+        response['Content-Disposition'] = f'attachment; filename="geography.{extension}"'
+        return response
+
+
+# GET /search/cities/?q=san&limit=10 - cities whose name starts with q, most populated first
+# &fuzzy=1 matches similar names instead (typos), see search.py
+class CitySearchView(APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        query = request.query_params.get('q', '')
+        if not query.strip():
+            return Response({'q': ['This field is required.']}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = int(request.query_params.get('limit', 10))
+        except ValueError:
+            limit = 0
+        if not 1 <= limit <= TOP_K:
+            return Response({'limit': ['Must be a number between 1 and %d.' % TOP_K]}, status=status.HTTP_400_BAD_REQUEST)
+        fuzzy = request.query_params.get('fuzzy') in ('1', 'true')
+        return Response(search_cities(query, limit, fuzzy=fuzzy))
+
+
+# Stats - population totals read from the rollup tables (or added up by the db), see stats.py for the metrics
+
+# GET /countries/<country_code>/stats/ - the country's totals, and the same metrics per state
+# the states take ?min_<metric>=, ?max_<metric>= and ?ordering=<metric>,-<metric>
+class CountryStatsView(ReplicaReadMixin, APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, country_code):
+        country = (
+            CountryModel.objects.filter(country_code=country_code)
+            .annotate(state_count=Count('states', distinct=True), **metrics('states__cities__'))
+            .values('country_code', 'name', 'state_count', *METRICS)
+            .first()
+        )
+        if country is None:
+            raise NotFound()
+        states = filter_and_order(
+            StateModel.objects.filter(country_code=country_code).annotate(**metrics('cities__')),
+            request.query_params, extra_ordering=('name', 'state_code'), default_ordering=('name',),
+        )
+        country['states'] = list(states.values('state_code', 'name', *METRICS))
+        return Response(country)
+
+# GET /countries/<country_code>/states/<state_code>/stats/ - the state's totals
+class StateStatsView(ReplicaReadMixin, APIView):
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, country_code, state_code):
+        state = (
+            StateModel.objects.filter(country_code=country_code, state_code=state_code)
+            .annotate(**metrics('cities__'))
+            .values('state_code', 'name', *METRICS)
+            .first()
+        )
+        if state is None:
+            raise NotFound()
+        return Response(state)
+